@@ -0,0 +1,160 @@
+# encoding: utf-8
+"""
+astroTime.py
+============
+
+Vectorised time conversions, for working with arrays of timestamps at once.
+These are named in the same a2b() format as astroCoords.py.
+
+pyEphem does all of this (and more), but one timestamp at a time, which is
+slow for a long observation with thousands of dumps. Here the sidereal time
+is computed in numpy, and pyEphem is only used for the apparent position of
+the source, which changes slowly, at a coarse cadence.
+
+Module listing
+~~~~~~~~~~~~~~
+
+"""
+
+import sys, os, ephem, datetime
+import numpy as np
+
+# Julian date of the unix epoch, 1970-01-01 00:00:00 UTC
+unix_epoch_jd = 2440587.5
+
+# Julian date of the J2000 epoch, 2000-01-01 12:00:00 TT
+j2000_jd = 2451545.0
+
+
+def unix2jd(timestamps):
+  """ Converts unix timestamps (seconds since 1970) to julian dates
+
+  Parameters
+  ----------
+  timestamps: float or numpy array
+    unix timestamps, in seconds, UTC
+  """
+  return np.asarray(timestamps, dtype='float64') / 86400.0 + unix_epoch_jd
+
+def jd2gmst(jd):
+  """ Converts julian dates to Greenwich mean sidereal time, in radians
+
+  Uses the IAU 1982 expression (Aoki et al.), taking UT1 = UTC.
+
+  Parameters
+  ----------
+  jd: float or numpy array
+    julian dates
+  """
+  jd = np.asarray(jd, dtype='float64')
+
+  # Split into julian date at 0h UT and hours since, to keep precision
+  jd0 = np.floor(jd - 0.5) + 0.5
+  hours = (jd - jd0) * 24.0
+
+  d0 = jd0 - j2000_jd
+  t = (jd - j2000_jd) / 36525.0
+
+  gmst = 6.697374558 + 0.06570982441908 * d0 + 1.00273790935 * hours \
+         + 0.000026 * t**2
+
+  return np.deg2rad(np.mod(gmst, 24.0) * 15.0)
+
+def jd2eqeq(jd):
+  """ Equation of the equinoxes (apparent - mean sidereal time), in radians
+
+  Uses the four largest nutation terms, which is good to about 0.01 seconds
+  of time.
+
+  Parameters
+  ----------
+  jd: float or numpy array
+    julian dates
+  """
+  d = np.asarray(jd, dtype='float64') - j2000_jd
+
+  # Longitude of the ascending node of the Moon, and mean longitudes of the Sun and Moon
+  omega = np.deg2rad(125.04452 - 0.052954 * d)
+  l_sun = np.deg2rad(280.4665 + 0.98564736 * d)
+  l_moon = np.deg2rad(218.3165 + 13.17639648 * d)
+
+  # Nutation in longitude, in arcseconds, and obliquity of the ecliptic
+  dpsi = -17.20 * np.sin(omega) - 1.32 * np.sin(2*l_sun) \
+         - 0.23 * np.sin(2*l_moon) + 0.21 * np.sin(2*omega)
+  eps = np.deg2rad(23.4393 - 0.0000004 * d)
+
+  return np.deg2rad(dpsi / 3600.0) * np.cos(eps)
+
+def jd2last(jd, longitude):
+  """ Converts julian dates to local apparent sidereal time, in radians (0 to 2pi)
+
+  Parameters
+  ----------
+  jd: float or numpy array
+    julian dates
+  longitude: float
+    east longitude of observer, in radians
+  """
+  last = jd2gmst(jd) + jd2eqeq(jd) + float(longitude)
+  return np.mod(last, 2*np.pi)
+
+def interpRaDec(source, observer, timestamps, cadence=300):
+  """ Apparent RA and DEC of a source at many times, with pyEphem only called at a coarse cadence
+
+  The apparent position (precession, nutation, aberration) changes slowly, so
+  it is computed with pyEphem every cadence seconds and linearly interpolated
+  in between.
+
+  Parameters
+  ----------
+  source: ephem.Body
+    source to compute position for (e.g. from makeSource())
+  observer: ephem.Observer
+    observer to compute the (topocentric) position for. Its date is changed.
+  timestamps: numpy array
+    unix timestamps, in seconds, UTC
+  cadence: float
+    seconds between pyEphem calls
+
+  Returns
+  -------
+  (ra, dec), in radians, each with the same shape as timestamps
+  """
+
+  timestamps = np.asarray(timestamps, dtype='float64')
+
+  # Sample times, covering the full range of the timestamps
+  t_start, t_stop = timestamps.min(), timestamps.max()
+  num_samples = int(np.ceil((t_stop - t_start) / cadence)) + 1
+  samples = t_start + cadence * np.arange(num_samples)
+
+  ra = np.zeros(num_samples)
+  dec = np.zeros(num_samples)
+  for i, sample in enumerate(samples):
+    observer.date = datetime.datetime.utcfromtimestamp(sample)
+    source.compute(observer)
+    ra[i], dec[i] = source.ra, source.dec
+
+  # RA may wrap through 2pi between samples
+  ra = np.unwrap(ra)
+
+  if num_samples == 1:
+    return ra[0] + np.zeros_like(timestamps), dec[0] + np.zeros_like(timestamps)
+
+  ra = np.mod(np.interp(timestamps, samples, ra), 2*np.pi)
+  dec = np.interp(timestamps, samples, dec)
+
+  return ra, dec
+
+def main():
+
+  # A quick example
+  now = 1303740000.0
+  jd = unix2jd(now)
+
+  print "JD: ", jd, ephem.julian_date(datetime.datetime.utcfromtimestamp(now))
+  print "LAST (Medicina): ", ephem.hours(jd2last(jd, ephem.degrees('11:38:45.56')))
+
+
+if __name__ == '__main__':
+  main()
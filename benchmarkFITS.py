@@ -0,0 +1,1515 @@
+# encoding: utf-8
+"""
+benchmarkFITS.py
+================
+
+Benchmarks for the HDF5 -> FITS IDI conversion. A synthetic correlator
+dataset is written to a HDF5 file with the same layout as the Medicina
+output (xeng_raw0, timestamp0 and bl_order), so that timings can be
+reproduced without access to real data.
+
+The size of the dataset is set on the command line, e.g.::
+
+  python benchmarkFITS.py --ants 64 --chans 512 --stokes 2 --dumps 16 --stages --json stages.json
+
+Module listing
+~~~~~~~~~~~~~~
+
+"""
+
+import sys, os, time, datetime, tempfile, multiprocessing, threading, resource, json
+import numpy as np, tables as tb
+import ephem
+from lxml import etree
+
+import pyFitsidi
+from pyFitsidi import *
+from createMedicinaFITS import *
+
+
+def make_synthetic_h5(filename, t_len=8, num_ants=32, chan_len=1024, pol_len=1):
+  """ Writes a synthetic correlator dataset to a HDF5 file.
+
+  Parameters
+  ----------
+  filename: string
+    name of HDF5 file to create
+  t_len: int
+    number of time dumps
+  num_ants: int
+    number of antennas; all num_ants*(num_ants+1)/2 baselines are generated
+  chan_len: int
+    number of frequency channels
+  pol_len: int
+    number of polarisation products
+  """
+
+  bl_order = [(i, j) for i in range(num_ants) for j in range(i, num_ants)]
+  bl_len = len(bl_order)
+
+  h5 = tb.openFile(filename, 'w')
+  xeng = h5.createCArray('/', 'xeng_raw0', tb.Int32Atom(),
+                         (t_len, chan_len, bl_len, pol_len, 2))
+  for t in range(t_len):
+    xeng[t] = np.random.randint(-128, 128, size=(chan_len, bl_len, pol_len, 2))
+  h5.createArray('/', 'timestamp0', 1303740000.0 + 3 * np.arange(t_len))
+  h5.createArray('/', 'bl_order', np.array(bl_order, dtype='int32'))
+  h5.close()
+
+  return filename
+
+def make_synthetic_config(filename, chan_len=1024, pol_len=1, band_len=1, complex_len=2, weight_len=2,
+                          config='config/medicina.xml'):
+  """ Writes a copy of a config file, with PARAMETERS set to match a synthetic dataset.
+
+  Parameters
+  ----------
+  filename: string
+    name of xml configuration file to create
+  chan_len: int
+    number of frequency channels in the dataset, split evenly between bands
+  pol_len: int
+    number of polarisation products, NSTOKES
+  band_len: int
+    number of bands, NBAND
+  complex_len: int
+    length of the FLUX complex axis, NCOMPLEX
+  weight_len: int
+    number of WEIGHT values per channel, NWEIGHT
+  config: string
+    xml configuration file to copy
+  """
+
+  if chan_len % band_len:
+    raise ValueError('%i channels cannot be split into %i bands'%(chan_len, band_len))
+
+  root = etree.parse(config).getroot()
+  params = root.find('PARAMETERS')
+  params.find('NCHAN').text = ' %i '%(chan_len / band_len)
+  params.find('NSTOKES').text = ' %i '%pol_len
+  params.find('NBAND').text = ' %i '%band_len
+  for tagname, value in (('NCOMPLEX', complex_len), ('NWEIGHT', weight_len)):
+    if params.find(tagname) is None:
+      etree.SubElement(params, tagname)
+    params.find(tagname).text = ' %i '%value
+  etree.ElementTree(root).write(filename)
+
+  return filename
+
+def synthetic_antennas(num_ants=32):
+  """ Antenna positions in metres, for any number of antennas.
+
+  The first 32 are the Medicina antennas from ant_array(). Any more carry on
+  the same grid of four cylinders, one row of four further out at a time.
+  """
+
+  antennas = ant_array()
+  if num_ants <= len(antennas):
+    return antennas[:num_ants]
+
+  # Grid spacings of ant_array(), in nanoseconds
+  i = np.arange(num_ants)
+  xyz_ns = np.array([-11.69 - 23.39 * (i / 4),
+                     -26.68 - 19.607 * (i % 4),
+                      11.89 + 23.78 * (i / 4)], dtype='float32').T
+  xyz_m = xyz_ns * 10**-9 * 299792458
+  xyz_m[:len(antennas)] = antennas
+
+  return xyz_m
+
+def _bench_array(num_ants=32):
+  """ The Medicina Array, with synthetic_antennas() """
+  return Array(lat='44:31:24.88', long='11:38:45.56', elev=28,
+               date=datetime.datetime.now(), antennas=synthetic_antennas(num_ants))
+
+def _num_ants(h5file):
+  """ Number of antennas in a HDF5 file, from its bl_order """
+  reader = HDF5Reader(h5file)
+  num_ants = reader.bl_order.max() + 1
+  reader.close()
+  return num_ants
+
+def _bench_tables(config, antenna_array, source):
+  """ The PRIMARY HDU and the tables written before UV_DATA, as in createMedicinaFITS.py """
+  names = ['MED_%i'%i for i in range(len(antenna_array.antennas))]
+  return [make_primary(config=config),
+          build_array_geometry(antenna_array.antennas, names, config=config),
+          config_frequency(make_frequency(config=config, num_rows=1)),
+          config_source(make_source(config=config, num_rows=1), source),
+          build_antenna(names, config=config)]
+
+def _fill_uv_data_rowwise(tbl_uv_data, h5data, uvws, bl_ids, julian_midnight, elapsed):
+  """ Row by row UV_DATA fill, as done before fill_uv_data(). Used as a reference. """
+
+  (t_len, chan_len, bl_len, pol_len, ri_len) = h5data.shape
+  stokes_len = tbl_uv_data.data.field('FLUX').shape[1] / (chan_len*ri_len)
+  flux = np.ndarray(shape=(chan_len,stokes_len,ri_len))
+
+  for t in range(0,t_len):
+    for bl in range(0,bl_len):
+      i = t*bl_len + bl
+      flux[:,:,0] = h5data[t,:,bl,:stokes_len,1]
+      flux[:,:,1] = h5data[t,:,bl,:stokes_len,0]
+
+      tbl_uv_data.data[i]['FLUX']     = flux.ravel()
+      tbl_uv_data.data[i]['WEIGHT']   = 1
+      tbl_uv_data.data[i]['UU']       = uvws[t][bl][0]
+      tbl_uv_data.data[i]['VV']       = uvws[t][bl][1]
+      tbl_uv_data.data[i]['WW']       = uvws[t][bl][2]
+      tbl_uv_data.data[i]['BASELINE'] = bl_ids[bl]
+      tbl_uv_data.data[i]['DATE']     = julian_midnight
+      tbl_uv_data.data[i]['TIME']     = elapsed[t]
+      tbl_uv_data.data[i]['SOURCE']   = 1
+      tbl_uv_data.data[i]['FREQID']   = 1
+      tbl_uv_data.data[i]['INTTIM']   = 3
+
+  return tbl_uv_data
+
+def bench_uv_fill(h5file, config='config/medicina.xml'):
+  """ Compares rows/second of the row by row and bulk UV_DATA fills.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to read, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file
+  """
+
+  reader = HDF5Reader(h5file)
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
+  num_rows = t_len * bl_len
+
+  uvws = np.random.random((t_len, bl_len, 3))
+  bl_ids = baselineIds(reader.bl_order)
+  elapsed = np.linspace(0, 0.1, t_len)
+
+  results = {}
+  for name, fill, data in (('rowwise', _fill_uv_data_rowwise, reader.xeng),
+                           ('bulk', fill_uv_data, reader)):
+    tbl_uv_data = make_uv_data(config=config, num_rows=num_rows)
+    t_start = time.time()
+    fill(tbl_uv_data, data, uvws, bl_ids, 2455677, elapsed)
+    t_elapsed = time.time() - t_start
+    results[name] = num_rows / t_elapsed
+    print('%-8s %8i rows in %6.2fs: %10.1f rows/s'%(name, num_rows, t_elapsed, results[name]))
+
+  print('Speedup: %.1fx'%(results['bulk'] / results['rowwise']))
+  print(reader.report())
+  reader.close()
+
+  return results
+
+def _config_metadata_rowwise(tbl_antenna, tbl_array_geometry, tbl_system_temperature,
+                             positions, times, tsys):
+  """ Row by row ANTENNA, ARRAY_GEOMETRY and SYSTEM_TEMPERATURE fills, as done before
+  build_antenna() and friends. Used as a reference. """
+
+  for i in range(tbl_antenna.data.size):
+    antenna = tbl_antenna.data[i]
+    antenna['ANNAME']     = 'MED_%i'%i
+    antenna['ANTENNA_NO'] = i + 1
+    antenna['ARRAY']      = 1
+    antenna['FREQID']     = 1
+    antenna['NO_LEVELS']  = 12
+    antenna['POLTYA']     = 'R'
+    antenna['POLTYB']     = 'R'
+    antenna['POLAA']      = 0
+    antenna['POLAB']      = 0
+
+  for i in range(tbl_array_geometry.data.size):
+    geometry = tbl_array_geometry.data[i]
+    geometry['ANNAME']   = 'MED_%i'%i
+    geometry['STABXYZ']  = positions[i]
+    geometry['DERXYZ']   = 0
+    geometry['NOSTA']    = i + 1
+    geometry['MNTSTA']   = 1
+    geometry['STAXOF']   = np.array([0,0,0])
+    geometry['DIAMETER'] = 0
+
+  (t_len, ant_len) = tsys.shape
+  time_interval = times[1] - times[0] if t_len > 1 else 365
+  for t in range(t_len):
+    for ant in range(ant_len):
+      system_temp = tbl_system_temperature.data[t*ant_len + ant]
+      system_temp['TIME']          = times[t]
+      system_temp['TIME_INTERVAL'] = time_interval
+      system_temp['SOURCE_ID']     = 1
+      system_temp['ANTENNA_NO']    = ant + 1
+      system_temp['ARRAY']         = 1
+      system_temp['FREQID']        = 1
+      system_temp['TSYS_1']        = tsys[t, ant]
+      system_temp['TANT_1']        = 47
+
+def bench_metadata(config='config/medicina.xml', num_ants=256, t_len=20):
+  """ Compares row by row and whole column fills of ANTENNA, ARRAY_GEOMETRY and
+  SYSTEM_TEMPERATURE, with a Tsys measurement for every antenna and dump.
+
+  Parameters
+  ----------
+  config: string
+    filename of xml configuration file
+  num_ants: int
+    number of antennas
+  t_len: int
+    number of Tsys measurements per antenna
+  """
+
+  positions = synthetic_antennas(num_ants)
+  names = ['MED_%i'%i for i in range(num_ants)]
+  times = np.arange(t_len) * 3.0 / 86400
+  tsys = 80 + 10 * np.random.random((t_len, num_ants))
+  num_rows = 2 * num_ants + t_len * num_ants
+
+  results = {}
+
+  t_start = time.time()
+  tbls = (make_antenna(config=config, num_rows=num_ants),
+          make_array_geometry(config=config, num_rows=num_ants),
+          make_system_temperature(config=config, num_rows=t_len*num_ants))
+  _config_metadata_rowwise(*(tbls + (positions, times, tsys)))
+  results['rowwise'] = time.time() - t_start
+
+  t_start = time.time()
+  vector_tbls = (build_antenna(names, config=config),
+                 build_array_geometry(positions, names, config=config),
+                 build_system_temperature(times, tsys, config=config))
+  results['columns'] = time.time() - t_start
+
+  for tbl, vector_tbl in zip(tbls, vector_tbls):
+    assert (tbl.data == vector_tbl.data).all(), '%s does not match'%tbl.header['EXTNAME']
+
+  for name in ('rowwise', 'columns'):
+    print('%-8s %8i rows in %6.3fs: %10.1f rows/s'%(name, num_rows, results[name], num_rows / results[name]))
+  print('Speedup: %.1fx'%(results['rowwise'] / results['columns']))
+
+  return results
+
+def bench_metadata_stream(config='config/medicina.xml', num_ants=256, t_len=4000, chunk_size=65536):
+  """ Times and measures the peak memory of streaming a per-second Tsys record for
+  every antenna to a growing SYSTEM_TEMPERATURE table, compared with building it in
+  memory with build_system_temperature().
+
+  Parameters
+  ----------
+  config: string
+    filename of xml configuration file
+  num_ants: int
+    number of antennas
+  t_len: int
+    number of seconds of Tsys measurements
+  chunk_size: int
+    number of records to write at once
+  """
+
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+  num_rows = num_ants * t_len
+
+  def records():
+    for t in xrange(t_len):
+      for ant in xrange(num_ants):
+        yield (t / 86400.0, ant + 1, 80.0, 47.0)
+
+  def in_memory():
+    times = np.arange(t_len) / 86400.0
+    tsys = 80 + np.zeros((t_len, num_ants))
+    hdus = [make_primary(config=config), build_system_temperature(times, tsys, config=config)]
+    pf.HDUList(hdus).writeto(fitsfile, clobber=True)
+
+  def streamed():
+    pf.HDUList([make_primary(config=config)]).writeto(fitsfile, clobber=True)
+    with TableWriter(fitsfile, 'SYSTEM_TEMPERATURE', config) as writer:
+      stream_system_temperature(writer, records(), chunk_size=chunk_size)
+
+  results = {}
+  for name, func in (('memory', in_memory), ('stream', streamed)):
+    results[name] = _peak_memory(func)
+    print('%-8s %8i rows in %6.2fs: %10.1f rows/s, peak memory +%.1f MB'
+          %(name, num_rows, results[name][0], num_rows / results[name][0], results[name][1]))
+
+  os.remove(fitsfile)
+
+  return results
+
+def _peak_memory(func, *args):
+  """ Runs func(*args) in a child process, returning (seconds, increase in peak RSS in MB) """
+
+  def child(queue):
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    t_start = time.time()
+    func(*args)
+    t_elapsed = time.time() - t_start
+    queue.put((t_elapsed, (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start) / 1024.0))
+
+  queue = multiprocessing.Queue()
+  proc = multiprocessing.Process(target=child, args=(queue,))
+  proc.start()
+  result = queue.get()
+  proc.join()
+
+  return result
+
+def bench_allocation(config='config/medicina.xml', t_len=16, num_ants=32, slab_size=4):
+  """ Compares time and peak memory of the ways of building UV_DATA rows and writing them.
+
+  * zeros: zero filled native rows, converted to big endian FITS on write
+  * empty: uninitialised FITS rows from new_rows(zero=False), written as they are
+  * mmap:  rows reserved in the file with allocate(), filled in place with map_rows()
+
+  Parameters
+  ----------
+  config: string
+    filename of xml configuration file
+  t_len: int
+    number of time dumps
+  num_ants: int
+    number of antennas
+  slab_size: int
+    number of time dumps to build at once
+  """
+
+  params = getConfig(config)['PARAMETERS']
+  chan_len = params['NCHAN'] * params['NBAND']
+  bl_len = num_ants * (num_ants + 1) / 2
+  slab = np.random.randint(-2**31, 2**31, size=(slab_size, chan_len, bl_len, params['NSTOKES'], 2)).astype('int32')
+  uvws = np.random.random((slab_size, bl_len, 3))
+  bl_ids = np.arange(bl_len)
+  elapsed = np.linspace(0, 0.1, slab_size)
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+
+  def zeros():
+    writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config, index=False)
+    for t0 in range(0, t_len, slab_size):
+      rows = np.rec.array(np.zeros(slab_size*bl_len, dtype=writer.native_dtype))
+      fill_uv_slab(rows, slab, uvws, bl_ids, 2455677, elapsed, writer.complex_len)
+      writer.write(rows)
+      del rows
+    writer.close()
+
+  def empty():
+    writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config, index=False)
+    for t0 in range(0, t_len, slab_size):
+      rows = writer.new_rows(slab_size*bl_len, zero=False)
+      fill_uv_slab(rows, slab, uvws, bl_ids, 2455677, elapsed, writer.complex_len)
+      writer.write(rows)
+      del rows
+    writer.close()
+
+  def mmap():
+    writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config, index=False)
+    start_row = writer.allocate(t_len*bl_len)
+    for t0 in range(0, t_len, slab_size):
+      rows = writer.map_rows(start_row + t0*bl_len, slab_size*bl_len)
+      fill_uv_slab(rows.view(np.recarray), slab, uvws, bl_ids, 2455677, elapsed, writer.complex_len)
+      rows.flush()
+      del rows
+    writer.close()
+
+  num_rows = t_len * bl_len
+  results = {}
+  for name, func in (('zeros', zeros), ('empty', empty), ('mmap', mmap)):
+    results[name] = _peak_memory(func)
+    print('%-6s %8i rows in %6.2fs: %10.1f rows/s, peak memory +%.1f MB'
+          %(name, num_rows, results[name][0], num_rows / results[name][0], results[name][1]))
+
+  os.remove(fitsfile)
+
+  return results
+
+def bench_reader(h5file, config='config/medicina.xml'):
+  """ Compares opening a FITS IDI file and scanning its FLUX with pyfits and with FitsidiReader.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to convert and read back, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file
+  """
+
+  fitsfile = _convert_h5(h5file, config)
+
+  results = {}
+
+  t_start = time.time()
+  hdulist = pf.open(fitsfile)
+  flux = hdulist['UV_DATA'].data.field('FLUX')
+  flux_max = np.abs(flux).max()
+  results['pyfits'] = time.time() - t_start
+  hdulist.close()
+
+  t_start = time.time()
+  reader = FitsidiReader(fitsfile)
+  flux = reader.flux()
+  assert np.abs(flux).max() == flux_max
+  results['reader'] = time.time() - t_start
+  del flux
+  reader.close()
+
+  for name in ('pyfits', 'reader'):
+    print('%-8s open and scan FLUX in %6.3fs'%(name, results[name]))
+  print('Speedup: %.1fx'%(results['pyfits'] / results['reader']))
+
+  os.remove(fitsfile)
+  os.remove(indexFilename(fitsfile))
+
+  return results
+
+def bench_index(h5file, config='config/medicina.xml', repeats=20):
+  """ Compares finding a baseline's time series by scanning UV_DATA with using the index.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to convert and read back, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file
+  repeats: int
+    number of baselines to fetch
+  """
+
+  fitsfile = _convert_h5(h5file, config)
+  reader = FitsidiReader(fitsfile)
+  uv_data = reader.uv_data()
+  baselines = np.unique(reader.index().baseline)[:repeats]
+
+  results = {}
+
+  t_start = time.time()
+  for baseline in baselines:
+    scanned = uv_data[uv_data.field('BASELINE') == baseline].copy()
+  results['scan'] = (time.time() - t_start) / len(baselines)
+
+  t_start = time.time()
+  for baseline in baselines:
+    indexed = reader.read_baseline(baseline)
+  results['index'] = (time.time() - t_start) / len(baselines)
+  assert (scanned == indexed).all()
+
+  for name in ('scan', 'index'):
+    print('%-8s %6i rows per baseline in %8.5fs'%(name, len(indexed), results[name]))
+  print('Speedup: %.1fx'%(results['scan'] / results['index']))
+
+  del uv_data
+  reader.close()
+  os.remove(fitsfile)
+  os.remove(indexFilename(fitsfile))
+
+  return results
+
+def _convert_h5(h5file, config, averager=None):
+  """ Converts h5file to a FITS IDI file in the temp directory, returning its filename """
+
+  medicina = _bench_array(_num_ants(h5file))
+  source = makeSource(name="CygA", ra='19:59:28', dec='40:44:02', flux='1')
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+
+  reader = HDF5Reader(h5file)
+  if averager is not None:
+    config = averager.config(config)
+    reader.slab_size = int(np.ceil(float(reader.slab_size) / averager.time_avg)) * averager.time_avg
+
+  writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config)
+  stream_uv_data(reader, writer, medicina, source, averager=averager)
+  writer.close()
+
+  return fitsfile
+
+def _read_uv_data(fitsfile):
+  """ Reads the UV_DATA rows of a FITS IDI file into memory, to compare with other conversions """
+  hdulist = pf.open(fitsfile)
+  uv_data = np.array(hdulist['UV_DATA'].data)
+  hdulist.close()
+  return uv_data
+
+def _io_bytes():
+  """ Bytes read and written by this process so far, from /proc/self/io (Linux only) """
+  counts = dict(line.split(':') for line in open('/proc/self/io'))
+  return int(counts['rchar']) + int(counts['wchar'])
+
+def bench_append(h5file, config='config/medicina.xml', append_lens=(1, 4), overhead=256*1024):
+  """ Checks that appending k dumps to a FITS IDI file costs O(k) I/O, whatever the size of the file.
+
+  Files of two lengths are written, then k dumps are appended to each with
+  UVDataWriter(append=True). The bytes read and written by the append are
+  counted from /proc/self/io. The rows to append are filled from h5file
+  beforehand, as reading them through the HDF5 chunk cache costs more or
+  less depending on what was read before, which has nothing to do with
+  the append.
+
+  The append must cost no more than the new rows, their index and a fixed
+  overhead (for the headers, config and so on), whatever the length of the file.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to read, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file
+  append_lens: tuple
+    numbers of dumps to append
+  overhead: int
+    bytes of I/O allowed on top of the new rows and their index
+  """
+
+  reader = HDF5Reader(h5file, slab_size=1)
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
+  uvws = np.random.random((t_len, bl_len, 3))
+  bl_ids = baselineIds(reader.bl_order)
+  elapsed = np.linspace(0, 0.1, t_len)
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+
+  def read_dumps(writer, num_dumps):
+    slabs = []
+    for t0, t1, slab in reader.slabs(0, num_dumps):
+      rows = writer.new_rows((t1-t0)*bl_len, zero=False)
+      fill_uv_slab(rows, slab, uvws[t0:t1], bl_ids, 2455677, elapsed[t0:t1], writer.complex_len)
+      slabs.append(rows)
+    return slabs
+
+  results = {}
+  for base_len in (max(t_len / 4, 1), t_len):
+    for k in append_lens:
+      writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config)
+      for rows in read_dumps(writer, base_len):
+        writer.write(rows)
+      writer.close()
+      slabs = read_dumps(writer, k)
+
+      io_start, t_start = _io_bytes(), time.time()
+      writer = UVDataWriter(fitsfile, None, config=config, append=True)
+      for rows in slabs:
+        writer.write(rows)
+      writer.close()
+      results[(base_len, k)] = (_io_bytes() - io_start, time.time() - t_start)
+      del slabs
+
+      io_bytes, t_elapsed = results[(base_len, k)]
+      data_bytes = k * bl_len * (writer.dtype.itemsize + pyFitsidi._index_dtype.itemsize)
+      print('Append %2i dumps to %3i: %8.2f MB I/O (%.2fx the new rows and index) in %6.3fs'
+            %(k, base_len, io_bytes / 1e6, float(io_bytes) / data_bytes, t_elapsed))
+      assert io_bytes <= data_bytes + overhead, \
+        'appending %i dumps to %i cost %i bytes of I/O, more than %i'%(k, base_len, io_bytes, data_bytes + overhead)
+
+  reader.close()
+  os.remove(fitsfile)
+  os.remove(indexFilename(fitsfile))
+
+  return results
+
+def bench_ingest(h5file, config='config/medicina.xml'):
+  """ Times ingesting the dumps in h5file as a packet stream, from memory, into a FITS IDI file,
+  and checks it writes the same UV_DATA as stream_uv_data.
+
+  The packets are then shuffled, some are repeated, one is lost, one runs
+  past the end of its dump and one dump is lost whole, and the dumps
+  DumpAssembler puts together, and the losses it counts, are checked.
+  h5file must have at least 3 dumps.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to take the dumps from, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file
+  """
+
+  from casperIngest import packetize, ingest, packet_header, DumpAssembler
+
+  reader = HDF5Reader(h5file)
+  dumps, timestamps = reader.xeng[:], reader.timestamps
+  packets = list(packetize(dumps, timestamps))
+  bl_order, dump_shape = reader.bl_order, reader.shape[1:]
+  num_rows = reader.shape[0] * reader.shape[2]
+  reader.close()
+
+  medicina = _bench_array(bl_order.max() + 1)
+  source = makeSource(name="CygA", ra='19:59:28', dec='40:44:02', flux='1')
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+
+  writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config)
+  t_start = time.time()
+  ingest(packets, writer, medicina, source, bl_order, dump_shape)
+  writer.close()
+  t_elapsed = time.time() - t_start
+
+  uv_data = _read_uv_data(fitsfile)
+  expected = _read_uv_data(_convert_h5(h5file, config))
+  assert len(uv_data) == len(expected) and (uv_data == expected).all(), 'ingest does not match stream_uv_data'
+
+  print('ingest %8i rows from %i packets in %6.2fs: %10.1f rows/s'
+        %(num_rows, len(packets), t_elapsed, num_rows / t_elapsed))
+
+  # A lossy stream: packets reordered by up to a dump's worth, every 7th
+  # packet repeated, the last packet of dump 0 and all of dump t_len / 2
+  # lost, and one packet that doesn't fit in dump 1
+  t_len = len(dumps)
+  assert t_len >= 3, 'the lossy stream needs at least 3 dumps'
+  packets_per_dump = len(packets) / t_len
+  heaps = np.repeat(np.arange(t_len), packets_per_dump)
+  lost = (np.arange(len(packets)) == packets_per_dump - 1) | (heaps == t_len / 2)
+  order = np.argsort(np.arange(len(packets)) + np.random.uniform(0, packets_per_dump, len(packets)))
+  lossy = [packets[i] for i in order if not lost[i]]
+  repeats = lossy[::7]
+  lossy += repeats
+  dump_size = dumps[0].nbytes
+  lossy.append(packet_header.pack(1, timestamps[1], dump_size - 8, dump_size) + packets[0][packet_header.size:])
+  order = np.argsort(np.arange(len(lossy)) + np.random.uniform(0, packets_per_dump, len(lossy)))
+  lossy = [lossy[i] for i in order]
+
+  assembler = DumpAssembler(dump_shape)
+  assembled = []
+  for packet in lossy:
+    assembled += assembler.add(packet)
+  assembled += assembler.finish()
+
+  kept = [t for t in range(t_len) if t not in (0, t_len / 2)]
+  assert [heap_cnt for heap_cnt, timestamp, dump in assembled] == kept, 'wrong dumps assembled'
+  for heap_cnt, timestamp, dump in assembled:
+    assert timestamp == timestamps[heap_cnt] and (dump == dumps[heap_cnt]).all(), \
+      'dump %i assembled wrongly'%heap_cnt
+  assert (assembler.dumps, assembler.dropped, assembler.rejected) == (len(kept), 2, 1), \
+    '%i dumps, %i dropped and %i rejected packets'%(assembler.dumps, assembler.dropped, assembler.rejected)
+  # A repeat is late if its dump was already out, or a duplicate if not
+  assert assembler.duplicates + assembler.late == len(repeats), \
+    '%i duplicate and %i late packets, for %i repeats'%(assembler.duplicates, assembler.late, len(repeats))
+  print('lossy stream: %i dumps assembled, %i dropped, %i late, %i duplicate and %i rejected packets'
+        %(assembler.dumps, assembler.dropped, assembler.late, assembler.duplicates, assembler.rejected))
+
+  os.remove(fitsfile)
+  os.remove(indexFilename(fitsfile))
+
+  return num_rows / t_elapsed
+
+def bench_pipeline(h5file, config='config/medicina.xml', queue_depths=(1, 2, 4), timeout=10.0):
+  """ Compares the sequential stream conversion with the threaded pipeline, for a few queue depths.
+  Checks the pipeline writes the same UV_DATA rows, in the same order, as stream_uv_data, and
+  that an exception in any stage reaches the caller rather than leaving the pipeline hung.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to read, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file
+  queue_depths: tuple
+    queue depths to try
+  timeout: float
+    seconds to wait for a pipeline with a failing stage to stop
+  """
+
+  medicina = _bench_array(_num_ants(h5file))
+  source = makeSource(name="CygA", ra='19:59:28', dec='40:44:02', flux='1')
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+
+  results = {}
+  for queue_depth in (0,) + tuple(queue_depths):
+    reader = HDF5Reader(h5file, slab_size=2)
+    num_rows = reader.shape[0] * reader.shape[2]
+    writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config)
+    t_start = time.time()
+    if queue_depth == 0:
+      stream_uv_data(reader, writer, medicina, source)
+    else:
+      pipeline_uv_data(reader, writer, medicina, source, queue_depth)
+    writer.close()
+    results[queue_depth] = time.time() - t_start
+
+    uv_data = _read_uv_data(fitsfile)
+    if queue_depth == 0:
+      expected = uv_data
+    else:
+      assert len(uv_data) == len(expected) and (uv_data == expected).all(), \
+        'pipeline with queue depth %i does not match stream_uv_data'%queue_depth
+
+  for queue_depth in (0,) + tuple(queue_depths):
+    name = 'depth %i'%queue_depth if queue_depth else 'stream'
+    print('%-8s %8i rows in %6.2fs: %10.1f rows/s, %4.2fx'
+          %(name, num_rows, results[queue_depth], num_rows / results[queue_depth],
+            results[0] / results[queue_depth]))
+
+  # A failing source, middle or last stage, with the other stages still
+  # blocked on full queues. Each run is in a thread, so a hang shows up as
+  # the thread still being alive after the timeout.
+  class StageError(Exception):
+    pass
+  def fail_at(n):
+    def func(item):
+      if item == n:
+        raise StageError(n)
+      return item
+    return func
+  def failing_source(n):
+    for item in range(100):
+      if item == n:
+        raise StageError(n)
+      yield item
+  for name, source_items, stages in (
+      ('source', failing_source(5), [('compute', fail_at(-1)), ('write', fail_at(-1))]),
+      ('compute', range(100), [('compute', fail_at(5)), ('write', fail_at(-1))]),
+      ('write', range(100), [('compute', fail_at(-1)), ('write', fail_at(5))])):
+    pipeline = Pipeline(source_items, stages, queue_depth=1)
+    errors = []
+    def run():
+      try:
+        pipeline.run()
+      except StageError, e:
+        errors.append(e)
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'pipeline hung after an exception in its %s stage'%name
+    assert len(errors) == 1, 'exception in the %s stage did not reach the caller'%name
+
+  os.remove(fitsfile)
+  os.remove(indexFilename(fitsfile))
+
+  return results
+
+def bench_config(config='config/medicina.xml', repeats=20):
+  """ Times the header config lookups for a full set of tables, with and without the config cache.
+
+  Each table builder looks up PARAMETERS, its own tag and COMMON. Without the
+  cache, each lookup parses and evaluates the config file again.
+
+  Parameters
+  ----------
+  config: string
+    filename of xml configuration file
+  repeats: int
+    number of times to look up the full set of tables
+  """
+
+  tags = ('PRIMARY', 'ARRAY_GEOMETRY', 'FREQUENCY', 'SOURCE', 'ANTENNA', 'UV_DATA')
+
+  results = {}
+  for name, lookup in (('uncached', lambda tag: Config(config)[tag]),
+                       ('cached', lambda tag: getConfig(config)[tag])):
+    pyFitsidi._config_cache.clear()
+    t_start = time.time()
+    for i in range(repeats):
+      for tag in tags:
+        for tagname in ('PARAMETERS', tag, 'COMMON'):
+          lookup(tagname)
+    results[name] = (time.time() - t_start) / repeats
+    print('%-8s %8.3f ms per table set'%(name, results[name] * 1e3))
+
+  print('Speedup: %.1fx'%(results['uncached'] / results['cached']))
+
+  return results
+
+def bench_uvw(t_len=100, num_ants=32):
+  """ Compares the per-baseline computeUVW() loop with computeUVWs() and
+  computeBaselineUVWs(), and checks they all agree.
+
+  Parameters
+  ----------
+  t_len: int
+    number of time dumps
+  num_ants: int
+    number of antennas; all num_ants*(num_ants+1)/2 baselines are used
+  """
+
+  antennas = ant_array()[:num_ants]
+  bl_order = np.array([(i, j) for i in range(num_ants) for j in range(i, num_ants)])
+  bl_vectors = antennas[bl_order[:,1]] - antennas[bl_order[:,0]]
+  H = np.linspace(-np.pi, np.pi, t_len)
+  d = np.deg2rad(40.73) + np.zeros(t_len)
+
+  t_start = time.time()
+  uvws_loop = []
+  for t in range(t_len):
+    for vector in bl_vectors:
+      uvws_loop.append(computeUVW(vector, H[t], d[t]))
+  uvws_loop = np.array(uvws_loop).reshape(t_len, len(bl_vectors), 3)
+  t_loop = time.time() - t_start
+
+  t_start = time.time()
+  uvws = computeUVWs(bl_vectors, H, d)
+  t_vector = time.time() - t_start
+
+  t_start = time.time()
+  uvws_ant = computeBaselineUVWs(antennas, bl_order, H, d)
+  t_antenna = time.time() - t_start
+
+  assert uvws.shape == (t_len, len(bl_vectors), 3)
+  assert np.allclose(uvws, uvws_loop, rtol=1e-10, atol=1e-9), 'computeUVWs does not match computeUVW'
+  # Baseline vectors above are differenced in float32, antenna UVWs in float64
+  assert np.allclose(uvws_ant, uvws_loop, rtol=1e-6, atol=1e-5), 'computeBaselineUVWs does not match computeUVW'
+
+  num_uvws = uvws.shape[0] * uvws.shape[1]
+  print('%-8s %8i UVWs in %6.3fs: %12.1f UVW/s'%('loop', num_uvws, t_loop, num_uvws / t_loop))
+  print('%-8s %8i UVWs in %6.3fs: %12.1f UVW/s'%('vector', num_uvws, t_vector, num_uvws / t_vector))
+  print('%-8s %8i UVWs in %6.3fs: %12.1f UVW/s'%('antenna', num_uvws, t_antenna, num_uvws / t_antenna))
+  print('Speedup: %.1fx vector, %.1fx antenna, max difference %.3g m'
+        %(t_loop / t_vector, t_loop / t_antenna, np.abs(uvws_ant - uvws_loop).max()))
+
+  return t_loop, t_vector, t_antenna
+
+def bench_time(t_len=10000):
+  """ Compares per-timestamp pyEphem time and source position calls with astroTime.
+
+  Parameters
+  ----------
+  t_len: int
+    number of time dumps, 3 seconds apart
+  """
+
+  (latitude, longitude, elevation) = ('44:31:24.88', '11:38:45.56', 28)
+  medicina = Array(lat=latitude, long=longitude, elev=elevation,
+                   date=datetime.datetime.now(), antennas=ant_array())
+  source = makeSource(name="CygA", ra='19:59:28', dec='40:44:02', flux='1')
+  timestamps = 1303740000.0 + 3 * np.arange(t_len)
+
+  t_start = time.time()
+  H_ephem = np.zeros(t_len)
+  d_ephem = np.zeros(t_len)
+  jd_ephem = np.zeros(t_len)
+  for i, timestamp in enumerate(timestamps):
+    jd_ephem[i] = ephem.julian_date(time.gmtime(timestamp)[:6])
+    medicina.update(datetime.datetime.utcfromtimestamp(timestamp))
+    source.compute(medicina)
+    H_ephem[i], d_ephem[i] = (medicina.sidereal_time() - source.ra, source.dec)
+  t_ephem = time.time() - t_start
+
+  t_start = time.time()
+  jd = unix2jd(timestamps)
+  ra, dec = interpRaDec(source, medicina, timestamps)
+  H = jd2last(jd, medicina.long) - ra
+  t_numpy = time.time() - t_start
+
+  # Compare angles modulo 2pi, in arcseconds
+  dH = np.abs(np.angle(np.exp(1j * (H - H_ephem)))).max() * 206264.8
+  dd = np.abs(dec - d_ephem).max() * 206264.8
+  djd = np.abs(jd - jd_ephem).max() * 86400
+
+  # jd2last and pyEphem's sidereal time differ by ~0.2 arcsec; a float64 JD resolves ~40 us
+  assert dH < 1.0, 'hour angle differs from pyEphem by %.3f arcsec'%dH
+  assert dd < 0.1, 'declination differs from pyEphem by %.3f arcsec'%dd
+  assert djd < 1e-3, 'Julian date differs from pyEphem by %.3g s'%djd
+
+  print('%-8s %8i dumps in %6.3fs: %12.1f dumps/s'%('ephem', t_len, t_ephem, t_len / t_ephem))
+  print('%-8s %8i dumps in %6.3fs: %12.1f dumps/s'%('numpy', t_len, t_numpy, t_len / t_numpy))
+  print('Speedup: %.1fx, max difference H %.3f arcsec, dec %.3f arcsec, JD %.3g s'
+        %(t_ephem / t_numpy, dH, dd, djd))
+
+  return t_ephem, t_numpy
+
+def bench_parallel(h5file, config='config/medicina.xml', max_procs=None):
+  """ Times the full UV_DATA conversion with 1, 2, 4... processes, up to max_procs.
+  Always tries 2 processes, even on a single CPU, and checks that every run writes
+  the same UV_DATA as stream_uv_data.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to read, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file
+  max_procs: int
+    largest number of processes to try, defaults to the number of CPUs
+  """
+
+  if max_procs is None:
+    max_procs = multiprocessing.cpu_count()
+
+  medicina = _bench_array(_num_ants(h5file))
+  source = makeSource(name="CygA", ra='19:59:28', dec='40:44:02', flux='1')
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+
+  num_procs = [1, 2]
+  while num_procs[-1] * 2 <= max_procs:
+    num_procs.append(num_procs[-1] * 2)
+  if num_procs[-1] < max_procs:
+    num_procs.append(max_procs)
+
+  results = {}
+  for n in num_procs:
+    reader = HDF5Reader(h5file, slab_size=4)
+    num_rows = reader.shape[0] * reader.shape[2]
+    writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config)
+    t_start = time.time()
+    if n == 1:
+      stream_uv_data(reader, writer, medicina, source)
+    else:
+      parallel_uv_data(reader, writer, medicina, source, num_procs=n)
+    writer.close()
+    results[n] = time.time() - t_start
+
+    uv_data = _read_uv_data(fitsfile)
+    if n == 1:
+      expected = uv_data
+    else:
+      assert len(uv_data) == len(expected) and (uv_data == expected).all(), \
+        '%i procs does not match stream_uv_data'%n
+
+  for n in num_procs:
+    print('%2i procs %8i rows in %6.2fs: %10.1f rows/s, %4.1fx'
+          %(n, num_rows, results[n], num_rows / results[n], results[1] / results[n]))
+
+  os.remove(fitsfile)
+  os.remove(indexFilename(fitsfile))
+
+  return results
+
+def bench_weights(h5file, config='config/medicina.xml'):
+  """ Compares the size and conversion time of the UV_DATA weight layouts.
+
+  * full:     WEIGHT has a value for every FLUX value (NCOMPLEX 2, NWEIGHT 2)
+  * channel:  WEIGHT has a value for each channel, stokes and band (NCOMPLEX 2, NWEIGHT 1)
+  * embedded: weights are the third value of the FLUX complex axis, no WEIGHT column
+              (NCOMPLEX 3, NWEIGHT 0)
+
+  Each layout is read back and checked against the full layout: the same
+  FLUX, and the same weight for every FLUX value.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to convert, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file to base the layouts on, matching h5file
+  """
+
+  params = getConfig(config)['PARAMETERS']
+  layouts = (('full', 2, 2), ('channel', 2, 1), ('embedded', 3, 0))
+  weights_config = os.path.join(tempfile.gettempdir(), 'pyfitsidi_weights.xml')
+
+  results = {}
+  for name, complex_len, weight_len in layouts:
+    make_synthetic_config(weights_config, chan_len=params['NCHAN']*params['NBAND'],
+                          pol_len=params['NSTOKES'], band_len=params['NBAND'],
+                          complex_len=complex_len, weight_len=weight_len, config=config)
+    t_start = time.time()
+    fitsfile = _convert_h5(h5file, weights_config)
+    t_elapsed = time.time() - t_start
+    reader = FitsidiReader(fitsfile)
+    results[name] = (reader.uv_data().dtype.itemsize, os.path.getsize(fitsfile), t_elapsed)
+
+    # Weights as (row, band, channel, stokes, 1 or 2 values), to compare across layouts
+    flux = reader.flux()
+    if weight_len:
+      weights = np.array(reader.uv_data().field('WEIGHT')).reshape(flux.shape[:4] + (weight_len,))
+    else:
+      weights = np.array(flux[...,2:])
+    flux = np.array(flux[...,:2])
+    reader.close()
+    if name == 'full':
+      expected_flux, expected_weights = flux, weights
+    else:
+      assert (flux == expected_flux).all(), '%s layout FLUX does not match the full layout'%name
+      assert (weights == expected_weights).all(), '%s layout weights do not match the full layout'%name
+    os.remove(fitsfile)
+    os.remove(indexFilename(fitsfile))
+
+  for name, complex_len, weight_len in layouts:
+    row_bytes, file_bytes, t_elapsed = results[name]
+    print('%-8s %8i bytes per row, file %8.2f MB (%3.0f%%), converted in %6.2fs'
+          %(name, row_bytes, file_bytes / 1e6, 100.0 * file_bytes / results['full'][1], t_elapsed))
+
+  os.remove(weights_config)
+
+  return results
+
+def bench_average(h5file, config='config/medicina.xml', factors=((1, 1), (2, 1), (1, 16), (4, 16), (3, 4))):
+  """ Compares the size and conversion time of UV_DATA averaged by different factors.
+
+  Each averaged file is checked against the same averages taken directly
+  from the HDF5 file: FLUX, WEIGHT, TIME and INTTIM, including a short last
+  bin if time_avg doesn't divide the number of dumps, and the NO_CHAN and
+  CHAN_BW the averaged config gives. averageSlab() is also checked with
+  uneven (and some zero) weights.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to convert, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file, matching h5file
+  factors: list
+    (dumps, channels) to average over for each conversion. (1, 1) is full
+    resolution, and sizes are given relative to the first.
+  """
+
+  reader = HDF5Reader(h5file)
+  dumps = reader.xeng[:].astype('float64')
+  reader.close()
+  (t_len, chan_len, bl_len, pol_len, ri_len) = dumps.shape
+  common = getConfig(config)['COMMON']
+
+  # Weighted averages of a small slab, with a short last bin
+  slab = dumps[:, :16, :4]
+  weights = np.random.randint(0, 3, size=slab.shape[:3])
+  for time_avg, chan_avg in ((1, 1), (2, 4), (3, 16)):
+    averages, weight_sums = averageSlab(slab, time_avg, chan_avg, weights)
+    for k, t0 in enumerate(range(0, t_len, time_avg)):
+      for c in range(16 / chan_avg):
+        sample = (slice(t0, t0 + time_avg), slice(c * chan_avg, (c + 1) * chan_avg))
+        w = weights[sample]
+        expected = (slab[sample] * w[...,None,None]).sum(axis=(0, 1)) / np.maximum(w.sum(axis=(0, 1)), 1)[:,None,None]
+        assert np.allclose(weight_sums[k, c], w.sum(axis=(0, 1))) and \
+          np.allclose(averages[k, c], expected, rtol=1e-5, atol=1e-3), \
+          'averageSlab over %i dumps x %i chans does not match numpy for bin (%i, %i)'%(time_avg, chan_avg, k, c)
+
+  results = []
+  times = None
+  for time_avg, chan_avg in factors:
+    averager = UVAverager(time_avg, chan_avg) if time_avg * chan_avg > 1 else None
+    t_start = time.time()
+    fitsfile = _convert_h5(h5file, config, averager)
+    t_elapsed = time.time() - t_start
+    results.append((time_avg, chan_avg, os.path.getsize(fitsfile), t_elapsed))
+
+    reader = FitsidiReader(fitsfile)
+    header = reader.header('UV_DATA')
+    uv_data = reader.uv_data()
+    flux = np.array(reader.flux())
+    (num_rows, band_len, band_chans, stokes_len, complex_len) = flux.shape
+
+    # Direct averages of the dumps, with rows and FLUX ordered as fill_uv_slab() does
+    starts = np.arange(0, t_len, time_avg)
+    counts = np.diff(np.append(starts, t_len))
+    expected = np.array([dumps[t0:t0+time_avg].reshape(-1, chan_len / chan_avg, chan_avg, bl_len, pol_len, ri_len)
+                         .mean(axis=(0, 2)) for t0 in starts])
+    expected = expected[:,:,:,:stokes_len,::-1].transpose((0,2,1,3,4)).reshape(flux[...,:ri_len].shape)
+
+    assert header['NO_CHAN'] * band_len == chan_len / chan_avg, 'NO_CHAN %i not averaged'%header['NO_CHAN']
+    assert np.allclose(header['CHAN_BW'], common['CHAN_BW'] * chan_avg), 'CHAN_BW %g not averaged'%header['CHAN_BW']
+    assert num_rows == len(starts) * bl_len, '%i rows, expected %i'%(num_rows, len(starts) * bl_len)
+    assert np.allclose(flux[...,:ri_len], expected, rtol=1e-5, atol=1e-3), \
+      'FLUX averaged over %i dumps x %i chans does not match numpy'%(time_avg, chan_avg)
+    assert (uv_data['INTTIM'] == np.repeat(3.0 * counts, bl_len)).all(), 'INTTIM does not cover each bin'
+    assert (np.array(uv_data['WEIGHT']) == np.repeat(counts * chan_avg, bl_len)[:,None]).all(), \
+      'WEIGHT is not the number of samples in each bin'
+    if averager is None:
+      times = np.array(uv_data['TIME'][::bl_len])
+    elif times is not None:
+      expected_times = np.add.reduceat(times, starts) / counts
+      assert np.allclose(uv_data['TIME'][::bl_len], expected_times, rtol=0, atol=1e-9), \
+        'TIME is not the mean of each bin'
+    reader.close()
+
+    os.remove(fitsfile)
+    os.remove(indexFilename(fitsfile))
+
+  for time_avg, chan_avg, file_bytes, t_elapsed in results:
+    print('%3i dumps x %3i chans: file %8.2f MB (%5.1fx smaller), converted in %6.2fs'
+          %(time_avg, chan_avg, file_bytes / 1e6, float(results[0][2]) / file_bytes, t_elapsed))
+
+  return results
+
+def bench_compression(h5file, config='config/medicina.xml', slab_size=4):
+  """ Compares file size, write and read throughput of compressed UV_DATA with the uncompressed paths.
+
+  The same UV_DATA rows are written with hdulist.writeto, streamed with
+  UVDataWriter, and streamed tile compressed with CompressedUVDataWriter
+  using each compression algorithm. Each file is then read back a tile at a
+  time with FitsidiReader.tiles() and checked against the rows written.
+  Throughputs are of uncompressed UV_DATA bytes.
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to read, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file, matching h5file
+  slab_size: int
+    number of dumps in each write, for the streamed paths
+  """
+
+  reader = HDF5Reader(h5file)
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
+  num_rows = t_len * bl_len
+
+  uvws = np.random.random((t_len, bl_len, 3))
+  bl_ids = baselineIds(reader.bl_order)
+  elapsed = np.linspace(0, 0.1, t_len)
+  tbl_uv_data = make_uv_data(config=config, num_rows=num_rows)
+  fill_uv_data(tbl_uv_data, reader, uvws, bl_ids, 2455677, elapsed)
+  reader.close()
+
+  rows = np.asarray(tbl_uv_data.data)
+  data_bytes = float(rows.nbytes)
+  chunk_len = slab_size * bl_len
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+
+  def writeto():
+    pf.HDUList([make_primary(config=config), tbl_uv_data]).writeto(fitsfile, clobber=True)
+
+  def streamed(writer_class, **kwargs):
+    def write():
+      writer = writer_class(fitsfile, [make_primary(config=config)], config=config, index=False, **kwargs)
+      for start_row in range(0, num_rows, chunk_len):
+        writer.write(rows[start_row:start_row+chunk_len])
+      writer.close()
+    return write
+
+  results = []
+  for name, write in (('writeto', writeto),
+                      ('stream', streamed(UVDataWriter)),
+                      ('GZIP_1', streamed(CompressedUVDataWriter, algorithm='GZIP_1')),
+                      ('GZIP_2', streamed(CompressedUVDataWriter, algorithm='GZIP_2'))):
+    t_start = time.time()
+    write()
+    t_write = time.time() - t_start
+
+    t_start = time.time()
+    fits_reader = FitsidiReader(fitsfile)
+    for start_row, tile in fits_reader.tiles('UV_DATA'):
+      assert (tile.FLUX == rows['FLUX'][start_row:start_row+len(tile)]).all()
+    t_read = time.time() - t_start
+    fits_reader.close()
+
+    results.append((name, os.path.getsize(fitsfile), t_write, t_read))
+    os.remove(fitsfile)
+
+  print('%i rows of UV_DATA, %.2f MB'%(num_rows, data_bytes / 1e6))
+  for name, file_bytes, t_write, t_read in results:
+    print('%-8s file %8.2f MB (%4.1fx smaller), write %8.1f MB/s, read %8.1f MB/s'
+          %(name, file_bytes / 1e6, float(results[0][1]) / file_bytes,
+            data_bytes / 1e6 / t_write, data_bytes / 1e6 / t_read))
+
+  return results
+
+def bench_rfi(t_len=16, num_ants=32, chan_len=1024, threshold=5.0):
+  """ Times RFI flagging of a slab, against reading and filling it, and checks injected RFI is found.
+
+  Three bursts are injected into Gaussian noise: a few channels on one
+  baseline for several dumps, the same across the middle channel on
+  another baseline, and one channel on every baseline for one dump. Each
+  should come back as flagged ranges covering it. Where they go is scaled to
+  t_len and chan_len, so any size of slab can be used.
+
+  The flags are then written to the FLAG table of a file with the channels
+  split into two bands, which should split the burst across the middle
+  channel in two, and number the channels of each part from the start of
+  its band. chan_len must be even.
+
+  Parameters
+  ----------
+  t_len: int
+    number of time dumps in the slab
+  num_ants: int
+    number of antennas; all num_ants*(num_ants+1)/2 baselines are generated
+  chan_len: int
+    number of frequency channels
+  threshold: float
+    number of (MAD estimated) standard deviations to flag at
+  """
+
+  bl_len = num_ants * (num_ants + 1) / 2
+  burst_bl = bl_len / 2
+  burst_t = (t_len / 4, t_len / 2)
+  burst_chan = (chan_len / 10, chan_len / 10 + max(1, min(4, chan_len / 16)))
+  edge_bl = bl_len / 4
+  edge_chan = (chan_len / 2 - (burst_chan[1] - burst_chan[0]), chan_len / 2 + (burst_chan[1] - burst_chan[0]))
+  spike_t, spike_chan = t_len * 5 / 8, chan_len / 2
+  
+  slab = np.random.normal(0, 100, size=(t_len, chan_len, bl_len, 1, 2)).astype('int32')
+  slab[burst_t[0]:burst_t[1], burst_chan[0]:burst_chan[1], burst_bl] += 10000
+  slab[burst_t[0]:burst_t[1], edge_chan[0]:edge_chan[1], edge_bl] += 10000
+  slab[spike_t, spike_chan, :] += 10000
+
+  t_start = time.time()
+  flagger = RFIFlagger(threshold)
+  flagger.add(0, slab, 3 * np.arange(t_len) / 86400.0)
+  ranges = flagger.ranges()
+  t_flag = time.time() - t_start
+
+  # The same slab through fill_uv_slab(), for scale
+  rows = np.rec.array(np.zeros(t_len * bl_len, dtype=[('UU', 'f4'), ('VV', 'f4'), ('WW', 'f4'),
+    ('BASELINE', 'i4'), ('DATE', 'f8'), ('TIME', 'f8'), ('SOURCE', 'i4'), ('FREQID', 'i4'),
+    ('INTTIM', 'f4'), ('FLUX', 'f4', chan_len * 2)]))
+  t_start = time.time()
+  fill_uv_slab(rows, slab, np.zeros((t_len, bl_len, 3)), np.arange(bl_len), 0, np.zeros(t_len))
+  t_fill = time.time() - t_start
+
+  # Noise flagged next to the RFI can widen a range, but not split it
+  def covering(t, chan):
+    return ranges[(ranges['t_start'] <= t) & (ranges['t_stop'] > t) &
+                  (ranges['chan_start'] <= chan) & (ranges['chan_stop'] > chan)]
+  burst = covering(burst_t[0], burst_chan[0])
+  burst = burst[burst['baseline'] == burst_bl]
+  assert len(burst) == 1 and burst['t_stop'][0] >= burst_t[1] and burst['chan_stop'][0] >= burst_chan[1], \
+    'burst on baseline %i not flagged as one range'%burst_bl
+  assert len(np.unique(covering(spike_t, spike_chan)['baseline'])) == bl_len, \
+    'spike in channel %i not flagged on every baseline'%spike_chan
+  edge = covering(burst_t[0], edge_chan[0])
+  edge = edge[edge['baseline'] == edge_bl]
+  assert len(edge) == 1 and edge['chan_stop'][0] >= edge_chan[1], \
+    'burst on baseline %i not flagged as one range'%edge_bl
+
+  # Through FLAG, with two bands of chan_len / 2 channels
+  band_chans = chan_len / 2
+  band_config = make_synthetic_config(os.path.join(tempfile.gettempdir(), 'pyfitsidi_rfi.xml'),
+                                      chan_len=chan_len, band_len=2)
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_rfi.fits')
+  writer = UVDataWriter(fitsfile, [make_primary(config=band_config), make_flag(config=band_config, num_rows=0)],
+                        config=band_config, index=False, reserve={'FLAG': 2 * len(ranges)})
+  writer.close()
+  bl_order = np.array([(i, j) for i in range(num_ants) for j in range(i, num_ants)])
+  write_rfi_flags(fitsfile, flagger, bl_order, config=band_config)
+  reader = FitsidiReader(fitsfile)
+  flags = np.array(reader.table('FLAG'))
+  reader.close()
+  os.remove(fitsfile)
+
+  assert ((flags['BANDS'] >= 1) & (flags['BANDS'] <= 2)).all() and \
+    ((flags['CHANS'] >= 1) & (flags['CHANS'] <= band_chans)).all(), 'FLAG channels not numbered within their band'
+  edge_ants = antennaNumbers(bl_order)[edge_bl]
+  times = flagger.times()
+  edge = flags[(flags['ANTS'] == edge_ants).all(axis=1) &
+               (flags['TIMERANG'][:,0] < times[burst_t[0]]) & (flags['TIMERANG'][:,1] > times[burst_t[0]]) &
+               (((flags['BANDS'] == 1) & (flags['CHANS'][:,1] == band_chans)) |
+                ((flags['BANDS'] == 2) & (flags['CHANS'][:,0] == 1)))]
+  edge = edge[np.argsort(edge['BANDS'])]
+  assert len(edge) == 2 and list(edge['BANDS']) == [1, 2] and \
+    edge['CHANS'][0,0] <= edge_chan[0] + 1 and edge['CHANS'][1,1] >= edge_chan[1] - band_chans, \
+    'burst across the band edge not split into bands: BANDS %s, CHANS %s'%(edge['BANDS'], edge['CHANS'].tolist())
+  spike = flags[(flags['TIMERANG'][:,0] < times[spike_t]) & (flags['TIMERANG'][:,1] > times[spike_t]) &
+                (flags['BANDS'] == 2) & (flags['CHANS'][:,0] == 1)]
+  assert len(np.unique(spike['ANTS'][:,0] * 256 + spike['ANTS'][:,1])) == bl_len, \
+    'spike in channel %i not flagged as the first channel of band 2 on every baseline'%spike_chan
+
+  num_samples = t_len * chan_len * bl_len
+  print('flag     %8i samples in %6.3fs: %12.1f samples/s'%(num_samples, t_flag, num_samples / t_flag))
+  print('fill     %8i samples in %6.3fs: %12.1f samples/s'%(num_samples, t_fill, num_samples / t_fill))
+  print(flagger.report())
+  print('%i flagged ranges (%i FLAG rows in two bands) for %i flagged samples, %i of them from the injected RFI'
+        %(len(ranges), len(flags), flagger.flagged, 2 + bl_len))
+
+  return t_flag, t_fill, ranges
+
+def bench_stages(h5file, config='config/medicina.xml', slab_size=4, stats_file=None):
+  """ Times the full conversion, and each of its stages on its own, with the peak memory of each.
+
+  Each stage runs in its own process, so its peak memory is not hidden by
+  the stages before it:
+
+  * tables: building the PRIMARY HDU and the tables before UV_DATA
+  * uvw:    computing UVWs, times and baseline IDs for every dump
+  * read:   reading xeng_raw0, a slab at a time
+  * fill:   reformatting slabs into UV_DATA rows, from a slab already in memory
+  * write:  writing UV_DATA rows that are already filled
+  * full:   the whole conversion, as createMedicinaFITS.py does it
+
+  Parameters
+  ----------
+  h5file: string
+    HDF5 file to read, e.g. from make_synthetic_h5()
+  config: string
+    filename of xml configuration file, matching h5file (see make_synthetic_config())
+  slab_size: int
+    number of time dumps to read, fill and write at once
+  stats_file: string
+    filename to write the results to, as JSON
+  """
+
+  reader = HDF5Reader(h5file, slab_size=slab_size)
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
+  bl_order, timestamps = reader.bl_order, reader.timestamps
+  slab = reader.read(0, min(slab_size, t_len))
+  bytes_read = t_len * slab.nbytes / len(slab)
+  reader.close()
+
+  medicina = _bench_array(bl_order.max() + 1)
+  source = makeSource(name="CygA", ra='19:59:28', dec='40:44:02', flux='1')
+  fitsfile = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.fits')
+
+  uvws, bl_ids, julian_midnight, elapsed = uv_geometry(timestamps, bl_order, medicina, source)
+  num_rows = t_len * bl_len
+  template = make_uv_data(config=config, num_rows=1)
+  dtype = template.data.dtype.newbyteorder('>')
+  complex_len = template.header['MAXIS1']
+  bytes_written = num_rows * dtype.itemsize
+
+  def tables():
+    _bench_tables(config, medicina, source)
+
+  def uvw():
+    uv_geometry(timestamps, bl_order, medicina, source)
+
+  def read():
+    reader = HDF5Reader(h5file, slab_size=slab_size)
+    for t0, t1, data in reader.slabs():
+      pass
+    reader.close()
+
+  def fill():
+    rows = np.rec.array(np.empty(len(slab)*bl_len, dtype=dtype))
+    for t0 in range(0, t_len, slab_size):
+      t1 = min(t0 + slab_size, t_len)
+      fill_uv_slab(rows[:(t1-t0)*bl_len], slab[:t1-t0], uvws[t0:t1], bl_ids,
+                   julian_midnight, elapsed[t0:t1], complex_len)
+
+  def write():
+    rows = np.rec.array(np.empty(len(slab)*bl_len, dtype=dtype))
+    fill_uv_slab(rows, slab, uvws[:len(slab)], bl_ids, julian_midnight, elapsed[:len(slab)],
+                 complex_len)
+    writer = UVDataWriter(fitsfile, [make_primary(config=config)], config=config, index=False)
+    for t0 in range(0, t_len, slab_size):
+      t1 = min(t0 + slab_size, t_len)
+      writer.write(rows[:(t1-t0)*bl_len])
+    writer.close()
+
+  def full():
+    writer = UVDataWriter(fitsfile, _bench_tables(config, medicina, source), config=config)
+    stream_uv_data(HDF5Reader(h5file, slab_size=slab_size), writer, medicina, source)
+    writer.close()
+
+  stats = ConversionStats()
+  memory = {}
+  for name, func, rows, nread, nwritten in (('tables', tables, 0, 0, 0),
+                                            ('uvw', uvw, num_rows, 0, 0),
+                                            ('read', read, num_rows, bytes_read, 0),
+                                            ('fill', fill, num_rows, 0, 0),
+                                            ('write', write, num_rows, 0, bytes_written),
+                                            ('full', full, num_rows, bytes_read, bytes_written)):
+    seconds, memory[name] = _peak_memory(func)
+    stats.add(name, seconds=seconds, calls=1, rows=rows, bytes_read=nread, bytes_written=nwritten)
+
+  summary = stats.summary()
+  summary['dataset'] = {'dumps': t_len, 'channels': chan_len, 'baselines': bl_len,
+                        'stokes': pol_len, 'rows': num_rows, 'slab_size': slab_size}
+  for stage in summary['stages']:
+    stage['peak_memory_mb'] = memory[stage['name']]
+
+  print('%i dumps, %i channels, %i baselines, %i stokes: %i rows of %.1f kB'
+        %(t_len, chan_len, bl_len, pol_len, num_rows, dtype.itemsize / 1e3))
+  print('%-10s %9s %12s %10s %10s %12s'%('stage', 'time (s)', 'rows/s', 'MB/s in', 'MB/s out', 'memory (MB)'))
+  for stage in summary['stages']:
+    print('%-10s %9.3f %12.1f %10.1f %10.1f %12.1f'
+          %(stage['name'], stage['seconds'], stage['rows_per_s'], stage['mb_read_per_s'],
+            stage['mb_written_per_s'], stage['peak_memory_mb']))
+
+  if stats_file:
+    fh = open(stats_file, 'w')
+    fh.write(json.dumps(summary, indent=2, sort_keys=True) + '\n')
+    fh.close()
+    print('Results written to %s'%stats_file)
+
+  os.remove(fitsfile)
+  os.remove(indexFilename(fitsfile))
+
+  return summary
+
+def main():
+  """
+  Run the benchmarks on a synthetic dataset.
+
+  The size of the dataset is set on the command line. With --stages, only
+  the full conversion and its stages are timed (see bench_stages()).
+  """
+
+  from optparse import OptionParser
+  parser = OptionParser(usage='%prog [options]')
+  parser.add_option('-a', '--ants', dest='num_ants', type='int', default=32,
+                    help='number of antennas (default 32)')
+  parser.add_option('-c', '--chans', dest='chan_len', type='int', default=1024,
+                    help='number of frequency channels (default 1024)')
+  parser.add_option('-p', '--stokes', dest='pol_len', type='int', default=1,
+                    help='number of polarisation products (default 1)')
+  parser.add_option('-b', '--bands', dest='band_len', type='int', default=1,
+                    help='number of bands to split the channels between (default 1)')
+  parser.add_option('-t', '--dumps', dest='t_len', type='int', default=4,
+                    help='number of time dumps (default 4)')
+  parser.add_option('-s', '--slab', dest='slab_size', type='int', default=4,
+                    help='number of time dumps to convert at once (default 4)')
+  parser.add_option('--stages', dest='stages', action='store_true', default=False,
+                    help='only time the full conversion and its stages')
+  parser.add_option('--json', dest='stats_file', default=None,
+                    help='write the stage timings to this file, as JSON')
+  (options, args) = parser.parse_args()
+
+  h5file = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.h5')
+  config = os.path.join(tempfile.gettempdir(), 'pyfitsidi_bench.xml')
+
+  print('\nGenerating synthetic dataset')
+  print('------------------------------------')
+  make_synthetic_h5(h5file, t_len=options.t_len, num_ants=options.num_ants,
+                    chan_len=options.chan_len, pol_len=options.pol_len)
+  make_synthetic_config(config, chan_len=options.chan_len, pol_len=options.pol_len,
+                        band_len=options.band_len)
+  print('Written to %s and %s'%(h5file, config))
+
+  print('\nConversion stages')
+  print('------------------------------------')
+  bench_stages(h5file, config, slab_size=options.slab_size, stats_file=options.stats_file)
+
+  if options.stages:
+    os.remove(h5file)
+    os.remove(config)
+    return
+
+  print('\nConfig parsing')
+  print('------------------------------------')
+  bench_config(config)
+
+  print('\nMetadata tables')
+  print('------------------------------------')
+  bench_metadata(config)
+  bench_metadata_stream(config)
+
+  print('\nTime and source position')
+  print('------------------------------------')
+  bench_time()
+
+  print('\nUVW computation')
+  print('------------------------------------')
+  bench_uvw(num_ants=min(options.num_ants, 32))
+
+  print('\nUV_DATA fill')
+  print('------------------------------------')
+  bench_uv_fill(h5file, config)
+
+  print('\nUV_DATA allocation')
+  print('------------------------------------')
+  bench_allocation(config, num_ants=options.num_ants)
+
+  print('\nParallel conversion')
+  print('------------------------------------')
+  bench_parallel(h5file, config)
+
+  print('\nThreaded pipeline')
+  print('------------------------------------')
+  bench_pipeline(h5file, config)
+
+  print('\nWeight layouts')
+  print('------------------------------------')
+  bench_weights(h5file, config)
+
+  print('\nAveraging')
+  print('------------------------------------')
+  bench_average(h5file, config)
+
+  print('\nCompression')
+  print('------------------------------------')
+  bench_compression(h5file, config, slab_size=options.slab_size)
+
+  print('\nRFI flagging')
+  print('------------------------------------')
+  bench_rfi(num_ants=options.num_ants, chan_len=options.chan_len)
+
+  print('\nReading back')
+  print('------------------------------------')
+  bench_reader(h5file, config)
+
+  print('\nIndexed queries')
+  print('------------------------------------')
+  bench_index(h5file, config)
+
+  print('\nAppending')
+  print('------------------------------------')
+  bench_append(h5file, config)
+
+  print('\nPacket stream ingest')
+  print('------------------------------------')
+  bench_ingest(h5file, config)
+
+  os.remove(h5file)
+  os.remove(config)
+
+
+if __name__ == '__main__':
+  main()
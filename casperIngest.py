@@ -0,0 +1,397 @@
+# encoding: utf-8
+"""
+casperIngest.py
+===============
+
+Ingests X-engine dumps straight from a CASPER correlator into a FITS IDI
+file, without writing them to a HDF5 file first. Packets are assembled into
+whole dumps, a few dumps at a time are converted to UV_DATA rows (UVWs and
+all), and the rows are streamed to a UVDataWriter as they arrive.
+
+Packet format
+~~~~~~~~~~~~~
+
+A cut down, SPEAD-like format. Each dump is sent as a heap, split over as
+many packets as needed. Each packet has a 32 byte header, followed by part
+of the dump::
+
+  heap_cnt     uint64   dump number, counting up from the start of the observation
+  timestamp    float64  unix timestamp of the dump
+  heap_offset  uint64   byte offset of this packet's payload within the dump
+  heap_size    uint64   size in bytes of the whole dump
+
+All big endian. The dump itself is the X-engine output for one integration,
+with axes (channels, baselines, polarisation, real/imag), as big endian int32.
+
+Packet sources
+~~~~~~~~~~~~~~
+
+Anything that can be iterated over to give packets (as strings) is a packet
+source. UDPSource reads packets from a UDP socket; ReplaySource replays
+packets saved to a file with recordPackets(). packetize() makes packets
+from an array of dumps, e.g. from a HDF5 file, for testing.
+
+Module listing
+~~~~~~~~~~~~~~
+
+"""
+
+import sys, os, struct, socket
+import numpy as np
+
+from pyFitsidi import *
+from createMedicinaFITS import *
+
+# Packet header: heap_cnt, timestamp, heap_offset, heap_size
+packet_header = struct.Struct('>QdQQ')
+
+# X-engine output is big endian int32
+xeng_dtype = np.dtype('>i4')
+
+
+class UDPSource(object):
+  """ Packet source that reads packets from a UDP socket.
+
+  Iteration stops when no packet arrives for timeout seconds.
+
+  Parameters
+  ----------
+  port: int
+    UDP port to listen on
+  host: string
+    address to bind to, defaults to all interfaces
+  timeout: float
+    seconds to wait for a packet before stopping, None to wait forever
+  max_packet: int
+    largest packet to accept, in bytes
+  """
+
+  def __init__(self, port, host='', timeout=10.0, max_packet=9000):
+    self.max_packet = max_packet
+    self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 64 * 1024 * 1024)
+    self.sock.bind((host, port))
+    self.sock.settimeout(timeout)
+
+  def __iter__(self):
+    while True:
+      try:
+        yield self.sock.recv(self.max_packet)
+      except socket.timeout:
+        return
+
+  def close(self):
+    self.sock.close()
+
+class ReplaySource(object):
+  """ Packet source that replays packets saved with recordPackets()
+
+  Parameters
+  ----------
+  filename: string
+    file of packets to replay
+  """
+
+  def __init__(self, filename):
+    self.filename = filename
+
+  def __iter__(self):
+    fh = open(self.filename, 'rb')
+    try:
+      while True:
+        size = fh.read(4)
+        if len(size) < 4:
+          return
+        yield fh.read(struct.unpack('>I', size)[0])
+    finally:
+      fh.close()
+
+def recordPackets(filename, packets):
+  """ Saves packets to a file, for replay with ReplaySource. Each packet is prefixed with its length. """
+
+  fh = open(filename, 'wb')
+  try:
+    for packet in packets:
+      fh.write(struct.pack('>I', len(packet)))
+      fh.write(packet)
+  finally:
+    fh.close()
+
+def packetize(dumps, timestamps, first_heap=0, payload_size=8192):
+  """ Splits dumps into packets, as the correlator would send them.
+
+  Parameters
+  ----------
+  dumps: numpy.array
+    dumps with axes (time, channels, baselines, polarisation, real/imag),
+    e.g. xeng_raw0 from a HDF5 file
+  timestamps: numpy.array
+    unix timestamp of each dump
+  first_heap: int
+    heap_cnt of the first dump
+  payload_size: int
+    bytes of dump data in each packet
+  """
+
+  for i in range(len(dumps)):
+    data = np.asarray(dumps[i], dtype=xeng_dtype).tostring()
+    for offset in range(0, len(data), payload_size):
+      header = packet_header.pack(first_heap + i, timestamps[i], offset, len(data))
+      yield header + data[offset:offset+payload_size]
+
+class DumpAssembler(object):
+  """ Assembles packets into whole dumps.
+
+  Packets may arrive in any order, and more than once. Dumps are returned
+  in order, as soon as they and all the dumps before them are complete. A
+  dump is only complete once every byte of it has arrived, so repeated
+  packets can't stand in for missing ones. If a dump is still incomplete (or hasn't arrived at
+  all) when max_pending newer dumps have started arriving, its missing
+  packets are taken to be lost, and the dump is dropped.
+
+  Parameters
+  ----------
+  dump_shape: tuple
+    shape of a dump, (channels, baselines, polarisation, real/imag)
+  max_pending: int
+    number of incomplete dumps to wait for before dropping the oldest
+
+  Attributes
+  ----------
+  dumps: int
+    number of dumps completed
+  dropped: int
+    number of dumps dropped as incomplete, including any that never arrived
+  late: int
+    number of packets that arrived after their dump was completed or dropped
+  duplicates: int
+    number of packets ignored as repeats of one already received
+  rejected: int
+    number of packets ignored as their payload runs past the end of the dump
+  """
+
+  def __init__(self, dump_shape, max_pending=4):
+    self.dump_shape = tuple(dump_shape)
+    self.dump_size = int(np.prod(self.dump_shape)) * xeng_dtype.itemsize
+    self.max_pending = max_pending
+
+    self.dumps = 0
+    self.dropped = 0
+    self.late = 0
+    self.duplicates = 0
+    self.rejected = 0
+
+    self._next_heap = None
+    self._pending = {}
+
+  def add(self, packet):
+    """ Adds a packet, returning a list of (heap_cnt, timestamp, dump) for any dumps completed """
+
+    heap_cnt, timestamp, offset, size = packet_header.unpack_from(packet)
+    payload = packet[packet_header.size:]
+
+    if size != self.dump_size:
+      raise ValueError('Dump of %i bytes does not match the dump shape %s'%(size, self.dump_shape))
+
+    if offset + len(payload) > size:
+      self.rejected += 1
+      return []
+
+    if self._next_heap is not None and heap_cnt < self._next_heap:
+      self.late += 1
+      return []
+
+    # Each heap is [timestamp, data, bytes received, {offset: length} of the packets received]
+    if heap_cnt not in self._pending:
+      self._pending[heap_cnt] = [timestamp, np.empty(size, dtype='uint8'), 0, {}]
+    heap = self._pending[heap_cnt]
+    if heap[3].get(offset, -1) >= len(payload):
+      self.duplicates += 1
+      return []
+
+    heap[1][offset:offset+len(payload)] = np.frombuffer(payload, dtype='uint8')
+    heap[2] += len(payload) - heap[3].get(offset, 0)
+    heap[3][offset] = len(payload)
+
+    return self._flush()
+
+  def finish(self):
+    """ Called at the end of the stream: drops any incomplete dumps, returning any complete ones """
+    return self._flush(final=True)
+
+  def _complete(self, heap):
+    """ True if the packets received for a heap cover the whole dump """
+
+    if heap[2] < self.dump_size:
+      return False
+
+    # Enough bytes, but packets might overlap, so check for gaps
+    covered = 0
+    for offset in sorted(heap[3]):
+      if offset > covered:
+        return False
+      covered = max(covered, offset + heap[3][offset])
+    return covered >= self.dump_size
+
+  def _flush(self, final=False):
+    """ Returns the complete dumps at the front of the queue, dropping old incomplete ones.
+    If final, every dump still pending is either returned or dropped. """
+
+    completed = []
+    while self._pending:
+      heap_cnt = min(self._pending)
+
+      # Heaps before this one haven't arrived at all
+      if self._next_heap is not None and heap_cnt > self._next_heap:
+        if final or len(self._pending) >= self.max_pending:
+          self.dropped += heap_cnt - self._next_heap
+          self._next_heap = heap_cnt
+          continue
+        break
+
+      heap = self._pending[heap_cnt]
+      if self._complete(heap):
+        completed.append((heap_cnt, heap[0], heap[1].view(xeng_dtype).reshape(self.dump_shape)))
+        self.dumps += 1
+      elif final or len(self._pending) > self.max_pending:
+        self.dropped += 1
+      else:
+        break
+
+      del self._pending[heap_cnt]
+      self._next_heap = heap_cnt + 1
+
+    return completed
+
+def ingest(packets, writer, antenna_array, source, bl_order, dump_shape, dumps_per_write=4, max_pending=4):
+  """ Streams packets from a correlator into UV_DATA rows.
+
+  Dumps are converted and written a few at a time, as soon as they are
+  complete, so only a few dumps are ever held in memory.
+
+  Parameters
+  ----------
+  packets: iterable
+    packet source, e.g. UDPSource or ReplaySource
+  writer: UVDataWriter
+    writer for the output FITS IDI file
+  antenna_array: Array
+    antenna array (pyEphem observer)
+  source: ephem.FixedBody
+    source to be phased to (use makeSource())
+  bl_order: numpy.array
+    (ant1, ant2) pair for each baseline, in X-engine order
+  dump_shape: tuple
+    shape of a dump, (channels, baselines, polarisation, real/imag)
+  dumps_per_write: int
+    number of dumps to convert and write at once
+  max_pending: int
+    number of incomplete dumps to wait for, see DumpAssembler
+
+  Returns
+  -------
+  assembler: DumpAssembler, which has counts of the dumps completed and dropped
+  """
+
+  assembler = DumpAssembler(dump_shape, max_pending)
+  batch = []
+  julian_midnight = None
+
+  for packet in packets:
+    for heap_cnt, timestamp, dump in assembler.add(packet):
+      batch.append((timestamp, dump))
+      if len(batch) == dumps_per_write:
+        julian_midnight = write_dumps(writer, batch, antenna_array, source, bl_order, julian_midnight)
+        print('ingested %i dumps, %i dropped'%(assembler.dumps, assembler.dropped))
+        batch = []
+
+  for heap_cnt, timestamp, dump in assembler.finish():
+    batch.append((timestamp, dump))
+  if batch:
+    write_dumps(writer, batch, antenna_array, source, bl_order, julian_midnight)
+
+  print('ingested %i dumps, %i dropped, %i late, %i duplicate and %i rejected packets'
+        %(assembler.dumps, assembler.dropped, assembler.late, assembler.duplicates, assembler.rejected))
+
+  return assembler
+
+def write_dumps(writer, dumps, antenna_array, source, bl_order, julian_midnight=None):
+  """ Converts a list of (timestamp, dump) to UV_DATA rows and writes them.
+
+  Returns the julian date at midnight the times are measured from, which
+  should be passed back in for the following dumps.
+  """
+
+  timestamps = np.array([timestamp for timestamp, dump in dumps])
+  slab = np.array([dump for timestamp, dump in dumps])
+  bl_len = slab.shape[2]
+
+  uvws, bl_ids, julian_midnight, elapsed = uv_geometry(timestamps, bl_order, antenna_array,
+                                                       source, julian_midnight)
+
+  rows = writer.new_rows(len(dumps)*bl_len, zero=False)
+  fill_uv_slab(rows, slab, uvws, bl_ids, julian_midnight, elapsed, writer.complex_len)
+  writer.write(rows)
+
+  return julian_midnight
+
+def main():
+  """
+  Ingests a stream of dumps into a FITS IDI file.
+
+  Packets are read from a UDP port, or replayed from a file. The baseline
+  order and dump shape are taken from a HDF5 file from the same correlator.
+  With --record, the dumps in the HDF5 file are saved as packets instead,
+  to be replayed later.
+  """
+
+  from optparse import OptionParser
+  parser = OptionParser(usage='%prog [options] reference.h5 out.fits')
+  parser.add_option('-p', '--port', dest='port', type='int', default=7148,
+                    help='UDP port to listen on (default 7148)')
+  parser.add_option('-r', '--replay', dest='replay', default=None,
+                    help='replay packets from this file, rather than listening')
+  parser.add_option('--record', dest='record', default=None,
+                    help='save the dumps in reference.h5 to this file as packets, then exit')
+  parser.add_option('-c', '--config', dest='config', default='config/medicina.xml',
+                    help='xml config file (default config/medicina.xml)')
+  (options, args) = parser.parse_args()
+
+  if len(args) != 2:
+    parser.error('need a reference HDF5 file and an output FITS file')
+  (hdffile, fitsfile) = args
+
+  reader = HDF5Reader(hdffile)
+  if options.record:
+    recordPackets(options.record, packetize(reader.xeng, reader.timestamps))
+    print('Saved %i dumps to %s'%(len(reader), options.record))
+    reader.close()
+    return
+
+  bl_order, dump_shape = reader.bl_order, reader.shape[1:]
+  reader.close()
+
+  medicina = Array(lat='44:31:24.88', long='11:38:45.56', elev=28,
+                   date=datetime.datetime.now(), antennas=ant_array())
+  source = makeSource(name="CygA", ra='19:59:28', dec='40:44:02', flux='1')
+
+  if options.replay:
+    packets = ReplaySource(options.replay)
+  else:
+    packets = UDPSource(options.port)
+
+  # The other tables, as for createMedicinaFITS.py
+  config = options.config
+  hdus = [make_primary(config=config),
+          config_array_geometry(make_array_geometry(config=config, num_rows=32), ant_array()),
+          config_frequency(make_frequency(config=config, num_rows=1)),
+          config_source(make_source(config=config, num_rows=1), source),
+          config_antenna(make_antenna(config=config, num_rows=32))]
+
+  writer = UVDataWriter(fitsfile, hdus, config=config)
+  ingest(packets, writer, medicina, source, bl_order, dump_shape)
+  writer.close()
+
+
+if __name__ == '__main__':
+  main()
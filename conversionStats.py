@@ -0,0 +1,133 @@
+# encoding: utf-8
+"""
+conversionStats.py
+==================
+
+Timing and throughput counters for the stages of a conversion (config
+parsing, table creation, UVW computation, reading, FLUX reformatting,
+writing...), with a JSON summary at the end and an optional progress
+callback along the way.
+
+Each stage is timed by wrapping it in a ``with stats.stage(name):`` block,
+and its rows and bytes are counted with add(). to_json() gives the summary.
+
+Module listing
+~~~~~~~~~~~~~~
+
+"""
+
+import sys, os, time, json, resource
+from contextlib import contextmanager
+
+
+class ConversionStats(object):
+  """ Per-stage wall time, row and byte counters for a conversion.
+
+  Stages are created as they are first used, and are reported in that order.
+
+  Parameters
+  ----------
+  progress: function
+    called as progress(done, total, stats) at most once every interval
+    seconds from progress(), e.g. printProgress
+  interval: float
+    seconds between calls to the progress function
+  """
+
+  def __init__(self, progress=None, interval=5.0):
+    self.progress_func = progress
+    self.interval = interval
+
+    self.stages = {}
+    self.order = []
+    self.t_start = time.time()
+    self._t_progress = self.t_start
+
+  def _stage(self, name):
+    if name not in self.stages:
+      self.stages[name] = {'seconds': 0.0, 'calls': 0, 'rows': 0,
+                           'bytes_read': 0, 'bytes_written': 0}
+      self.order.append(name)
+    return self.stages[name]
+
+  @contextmanager
+  def stage(self, name):
+    """ Times the body of a with statement, adding it to a stage """
+    t_start = time.time()
+    try:
+      yield
+    finally:
+      self.add(name, seconds=time.time() - t_start, calls=1)
+
+  def add(self, name, seconds=0.0, calls=0, rows=0, bytes_read=0, bytes_written=0):
+    """ Adds to the counters of a stage """
+    stage = self._stage(name)
+    stage['seconds'] += seconds
+    stage['calls'] += calls
+    stage['rows'] += rows
+    stage['bytes_read'] += bytes_read
+    stage['bytes_written'] += bytes_written
+
+  def progress(self, done, total):
+    """ Reports progress through the conversion, calling the progress function if it is due """
+    now = time.time()
+    if self.progress_func is not None and (now - self._t_progress >= self.interval or done >= total):
+      self._t_progress = now
+      self.progress_func(done, total, self)
+
+  def summary(self):
+    """ Returns the counters as a dictionary, with rates and peak memory use """
+
+    elapsed = time.time() - self.t_start
+    stages = []
+    for name in self.order:
+      stage = dict(self.stages[name])
+      stage['name'] = name
+      seconds = stage['seconds']
+      stage['rows_per_s'] = stage['rows'] / seconds if seconds else 0.0
+      stage['mb_read_per_s'] = stage['bytes_read'] / 1e6 / seconds if seconds else 0.0
+      stage['mb_written_per_s'] = stage['bytes_written'] / 1e6 / seconds if seconds else 0.0
+      stages.append(stage)
+
+    return {'elapsed': elapsed,
+            'stages': stages,
+            'peak_rss_mb': peakRSS(),
+            'peak_rss_children_mb': peakRSS(children=True)}
+
+  def to_json(self, filename=None):
+    """ Returns the summary as JSON, and writes it to filename if one is given """
+    text = json.dumps(self.summary(), indent=2, sort_keys=True)
+    if filename is not None:
+      fh = open(filename, 'w')
+      fh.write(text + '\n')
+      fh.close()
+    return text
+
+  def report(self):
+    """ Returns a table of the stage counters, one line per stage """
+
+    summary = self.summary()
+    lines = ['%-10s %9s %10s %12s %10s %10s'%('stage', 'time (s)', 'rows', 'rows/s', 'MB/s in', 'MB/s out')]
+    for stage in summary['stages']:
+      lines.append('%-10s %9.3f %10i %12.1f %10.1f %10.1f'
+                   %(stage['name'], stage['seconds'], stage['rows'], stage['rows_per_s'],
+                     stage['mb_read_per_s'], stage['mb_written_per_s']))
+    lines.append('Total %.3fs, peak RSS %.1f MB'%(summary['elapsed'], summary['peak_rss_mb']))
+
+    return '\n'.join(lines)
+
+def peakRSS(children=False):
+  """ Peak resident memory of this process (or of its finished child processes), in MB """
+  who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+  maxrss = resource.getrusage(who).ru_maxrss
+
+  # Linux reports kilobytes, OS X bytes
+  if sys.platform == 'darwin':
+    return maxrss / 1024.0**2
+  return maxrss / 1024.0
+
+def printProgress(done, total, stats):
+  """ A progress function for ConversionStats, printing a one line summary """
+  elapsed = time.time() - stats.t_start
+  print('progress: %i/%i (%.0f%%) in %.1fs, peak RSS %.1f MB'
+        %(done, total, 100.0 * done / max(total, 1), elapsed, peakRSS()))
@@ -8,18 +8,29 @@ An XML file is used to generate the table headers, and the table
 data is either generated from functions within this file, or from
 a HDF5 file (i.e. the raw output of a correlator).
 
+Antennas are numbered from 1 in every table written (ANTENNA_NO, NOSTA,
+UV_DATA BASELINE and FLAG ANTS), as FITS IDI requires, although the HDF5
+baseline order counts them from 0. Files written by earlier versions
+numbered them from 0, and can't be appended to (see checkAntennaNumbers()).
+
 Created by Danny Price on 2011-04-21.
 Copyright (c) 2011 The University of Oxford. All rights reserved.
 
 """
 
-import sys, os, datetime, time
+import sys, os, datetime, time, multiprocessing
 import pyfits as pf, numpy as np,  tables as tb
 import ephem
 
 # FITS IDI python module imports
 from pyFitsidi import *
 from astroCoords import *
+from astroTime import *
+from hdf5Reader import *
+from threadedPipeline import *
+from conversionStats import *
+from rfiFlag import *
+from uvAverage import *
 
 # Some global definitions that I don't think I really use
 global earth_radius, light_speed, pi, freq
@@ -113,9 +124,75 @@ def computeUVW(xyz,H,d):
   uvw = trans * xyz.T
   
   uvw = np.array(uvw)
-  
+
   return uvw[:,0]
 
+def computeUVWs(xyz,H,d):
+  """ Converts X-Y-Z coordinates into U-V-W, for many baselines and times at once
+
+  Array version of computeUVW(), using the same transform. The rotation matrix
+  is built for every time, then applied to every baseline with broadcasting.
+
+  Parameters
+  ----------
+  xyz: numpy array
+    baseline vectors, with shape (nbl, 3)
+  H: numpy array
+    hour angles of the phase reference position, with shape (ntime,)
+  d: float or numpy array
+    declination, either a single value or one for each time, shape (ntime,)
+
+  Returns
+  -------
+  uvw: numpy array, with shape (ntime, nbl, 3)
+  """
+  sin = np.sin
+  cos = np.cos
+
+  H = np.atleast_1d(np.asarray(H, dtype='float64'))
+  d = np.asarray(d, dtype='float64') * np.ones_like(H)
+
+  # Shape (ntime, 3, 3), one matrix per time
+  trans = np.array([
+    [sin(H),         cos(H),         np.zeros_like(H)],
+    [-sin(d)*cos(H), sin(d)*sin(H),  cos(d)],
+    [cos(d)*cos(H),  -cos(d)*sin(H), sin(H)]
+  ]).transpose((2,0,1))
+
+  return np.einsum('tij,bj->tbi', trans, np.asarray(xyz, dtype='float64'))
+
+def computeBaselineUVWs(antennas,bl_order,H,d):
+  """ Computes baseline U-V-W coordinates from antenna positions
+  
+  As the transform is linear, baseline UVWs are just the difference of the
+  antenna UVWs. So each antenna is rotated once per time, and baselines are
+  made by indexing, rather than rotating every baseline vector. This scales
+  with the number of antennas, not the number of baselines.
+  
+  Parameters
+  ----------
+  antennas: numpy array
+    antenna positions, with shape (nant, 3)
+  bl_order: numpy array
+    (ant1, ant2) pairs for each baseline, with shape (nbl, 2)
+  H: numpy array
+    hour angles of the phase reference position, with shape (ntime,)
+  d: float or numpy array
+    declination, either a single value or one for each time, shape (ntime,)
+  
+  Returns
+  -------
+  uvw: numpy array, with shape (ntime, nbl, 3)
+  """
+  
+  ant_uvws = computeUVWs(antennas, H, d)
+  
+  # From CASA measurement set definition
+  # uvw coordinates for the baseline from ANTENNE2 to ANTENNA1, 
+  # i.e. the baseline is equal to the difference POSITION2 - POSITION1. 
+  bl_order = np.asarray(bl_order)
+  return ant_uvws[:,bl_order[:,1]] - ant_uvws[:,bl_order[:,0]]
+
 
 def ant_array():
   """ The antenna array for Medicina. 
@@ -176,32 +253,32 @@ def ant_array():
 #   CONFIG FUNCTIONS   #
 ########################
 
-def config_antenna(tbl):
+def config_antenna(tbl, names=None):
   """ Configures the antenna table.
   
   Parameters
   ----------
   tbl: pyfits.hdu
     table to be configured
+  names: list
+    antenna names, one for each row. Defaults to MED_0, MED_1...
   """
 
-  antenna = tbl.data
-  for i in range(0,tbl.data.size):
-    
-    antenna[i]['ANNAME']      = 'MED_%i'%i
-    antenna[i]['ANTENNA_NO']  = i
-    antenna[i]['ARRAY']       = 1
-    antenna[i]['FREQID']      = 1
-    antenna[i]['NO_LEVELS']   = 12
-    antenna[i]['POLTYA']      = 'R'
-    antenna[i]['POLTYB']      = 'R'
-    antenna[i]['POLAA']       = 0
-    antenna[i]['POLAB']       = 0
-    
-    
-  tbl.data = antenna
+  num_ants = tbl.data.size
+  if names is None:
+    names = ['MED_%i'%i for i in range(num_ants)]
 
-  return tbl
+  return fill_columns(tbl, {
+    'ANNAME':     names,
+    'ANTENNA_NO': np.arange(1, num_ants + 1),
+    'ARRAY':      1,
+    'FREQID':     1,
+    'NO_LEVELS':  12,
+    'POLTYA':     'R',
+    'POLTYB':     'R',
+    'POLAA':      0,
+    'POLAB':      0,
+  })
 
 def config_source(tbl, source):
   """  Configures the source table.
@@ -255,18 +332,23 @@ def config_frequency(tbl):
   """
 
   frequency = tbl.data[0]
+  ch_width = tbl.header['CHAN_BW']
+
+  # Bands are consecutive runs of NO_CHAN channels, so each band starts
+  # NO_CHAN channels after the one before
+  band_offsets = np.arange(tbl.header['NO_BAND']) * tbl.header['NO_CHAN'] * ch_width
 
   frequency['FREQID']         = 1
-  frequency['BANDFREQ']       = 0         # This is offset from REF_FREQ, so zero!
-  frequency['CH_WIDTH']       = 20.0/1024.0 * 10**6
-  frequency['TOTAL_BANDWIDTH']= 20*10**6
+  frequency['BANDFREQ']       = band_offsets  # This is offset from REF_FREQ, so zero for the first band!
+  frequency['CH_WIDTH']       = ch_width
+  frequency['TOTAL_BANDWIDTH']= tbl.header['NO_CHAN'] * ch_width
   frequency['SIDEBAND']       = 1
 
   tbl.data[0] = frequency
 
   return tbl  
 
-def config_array_geometry(tbl, antenna_array):
+def config_array_geometry(tbl, antenna_array, names=None, mount=1):
   """  Configures the array_geometry table with Medicina values
 
   Parameters
@@ -277,188 +359,964 @@ def config_array_geometry(tbl, antenna_array):
     an array of xyz coordinates of the antenna locations (offsets) in METERS
     from the array centre (this is a keyword in the header unit)
     e.g. 
+  names: list
+    antenna names, one for each row. Defaults to MED_0, MED_1...
+  mount: int or numpy.array
+    antenna mount code, for all antennas or one for each. 
+    NOTE: Aperture arrays are given code 6, but not supported by CASA
   """
   
-  geometry = tbl.data
+  num_ants = tbl.data.size
+  if names is None:
+    names = ['MED_%i'%i for i in range(num_ants)]
 
   # X-Y-Z in metres
-  xyz_m = antenna_array
-
-  for i in range(0,tbl.data.size):
-    geometry[i]['ANNAME']  = 'MED_%i'%i
-    geometry[i]['STABXYZ'] = xyz_m[i]
-    geometry[i]['DERXYZ']  =  0
-    #geometry[i]['ORBPARM'] = 0
-    geometry[i]['NOSTA']   = i
-    geometry[i]['MNTSTA']  = 1 
-    # NOTE: Aperture arrays are given code 6, but not supported by CASA
-    geometry[i]['STAXOF']  = np.array([0,0,0])
-    geometry[i]['DIAMETER'] = 0
+  xyz_m = np.asarray(antenna_array)[:num_ants]
 
-  tbl.data = geometry
-
-  return tbl
+  return fill_columns(tbl, {
+    'ANNAME':   names,
+    'STABXYZ':  xyz_m,
+    'DERXYZ':   0,
+    'NOSTA':    np.arange(1, num_ants + 1),
+    'MNTSTA':   mount,
+    'STAXOF':   0,
+    'DIAMETER': 0,
+  })
 
-def config_system_temperature(tbl):
+def config_system_temperature(tbl, times=0, time_interval=365, antenna_nos=None, tsys=87, tant=47):
   """
   Configures the system_temperature table with values for Medicina.
   Casa currently doesn't support this table in any way.
+  
+  By default there is one row per antenna, with a constant Tsys. For a
+  Tsys time series, use build_system_temperature().
+  
+  Parameters
+  ----------
+  tbl: pyfits.hdu
+    table to be configured
+  times, time_interval, antenna_nos, tsys, tant:
+    TIME, TIME_INTERVAL, ANTENNA_NO, TSYS_1 and TANT_1 columns, each a single
+    value for all rows or an array with one for each row. antenna_nos
+    defaults to 1, 2, 3... 
   """
-    
-  system_temp = tbl.data
   
-  for i in range(0, tbl.data.size): 
-    system_temp[i]['TIME'] = 0
-    system_temp[i]['TIME_INTERVAL'] = 365 
-    system_temp[i]['SOURCE_ID']  = 1 
-    system_temp[i]['ANTENNA_NO'] = i 
-    system_temp[i]['ARRAY'] = 1
-    system_temp[i]['FREQID'] = 1
-    system_temp[i]['TSYS_1'] = 87 
-    system_temp[i]['TANT_1'] = 47
+  if antenna_nos is None:
+    antenna_nos = np.arange(1, tbl.data.size + 1)
+
+  return fill_columns(tbl, system_temperature_columns(times, time_interval, antenna_nos, tsys, tant))
+
+def system_temperature_columns(times, time_interval, antenna_nos, tsys, tant):
+  """ SYSTEM_TEMPERATURE column values, for fill_columns() or fill_rows(). See config_system_temperature(). """
+  return {
+    'TIME':          times,
+    'TIME_INTERVAL': time_interval,
+    'SOURCE_ID':     1,
+    'ANTENNA_NO':    antenna_nos,
+    'ARRAY':         1,
+    'FREQID':        1,
+    'TSYS_1':        tsys,
+    'TANT_1':        tant,
+  }
+
+def flag_columns(t_start, t_stop, ant1, ant2=0, chan_start=0, chan_stop=0, band=0, reason='', severity=-1):
+  """ FLAG column values, for fill_columns() or fill_rows().
+  
+  Each argument is a single value for all rows, or an array with one for
+  each row. Following FITS IDI, antennas, bands and channels are numbered
+  from 1, and an antenna, band or channel of 0 means all of them.
+  
+  Parameters
+  ----------
+  t_start, t_stop: float
+    time range flagged, in days (as UV_DATA TIME)
+  ant1, ant2: int
+    baseline flagged, as ANTENNA_NO (see antennaNumbers() for bl_order).
+    With ant2 = 0, every baseline with ant1 is flagged.
+  chan_start, chan_stop: int
+    first and last channel flagged, counted within the band
+  band: int
+    band flagged
+  reason: string
+    reason for flagging, up to 24 characters
+  severity: int
+    severity code, -1 if not given
+  """
+  if np.any(np.asarray(ant1) < 0) or np.any(np.asarray(ant2) < 0):
+    raise ValueError('FLAG antennas are numbered from 1, with 0 for all antennas')
+  
+  return {
+    'SOURCE_ID': 1,
+    'ARRAY':     1,
+    'ANTS':      np.array([ant1 + np.zeros_like(ant2), ant2 + np.zeros_like(ant1)]).T,
+    'FREQID':    1,
+    'TIMERANG':  np.array([t_start + np.zeros_like(t_stop), t_stop + np.zeros_like(t_start)]).T,
+    'BANDS':     band,
+    'CHANS':     np.array([chan_start + np.zeros_like(chan_stop), chan_stop + np.zeros_like(chan_start)]).T,
+    'PFLAGS':    1,
+    'REASON':    reason,
+    'SEVERITY':  severity,
+  }
+
+# Records in monitoring streams, see stream_system_temperature() and stream_flag()
+tsys_record_dtype = [('time', 'float64'), ('antenna', 'int32'), ('tsys', 'float32'), ('tant', 'float32')]
+flag_record_dtype = [('time', 'float64'), ('antenna', 'int32'), ('chan_start', 'int32'), ('chan_stop', 'int32')]
+
+def stream_table(writer, chunks, make_columns, queue_depth=0):
+  """ Streams chunks of records to a growing table.
+  
+  Parameters
+  ----------
+  writer: TableWriter
+    writer for the table
+  chunks: iterable
+    record arrays, e.g. from batchRecords()
+  make_columns: function
+    called with each chunk, returning a dictionary of column values for
+    fill_rows(), e.g. from flag_columns()
+  queue_depth: int
+    if more than 0, chunks are batched, converted and written in separate
+    threads (see threadedPipeline), with queues this deep between them
+  
+  Returns
+  -------
+  num_rows: int, the number of rows in the table
+  """
+  
+  def fill_chunk(chunk):
+    return fill_rows(writer.new_rows(len(chunk)), make_columns(chunk))
   
-  tbl.data = system_temp
+  if queue_depth > 0:
+    pipeline = Pipeline(chunks, [('fill', fill_chunk), ('write', writer.write)],
+                        queue_depth, source_name='batch')
+    pipeline.run()
+    print(pipeline.report())
+  else:
+    for chunk in chunks:
+      writer.write(fill_chunk(chunk))
   
-  return tbl 
+  return writer.num_rows
 
+def stream_system_temperature(writer, records, time_interval=1.0/86400, chunk_size=65536, queue_depth=0):
+  """ Streams Tsys measurements to a growing SYSTEM_TEMPERATURE table.
+  
+  Parameters
+  ----------
+  writer: TableWriter
+    writer for the SYSTEM_TEMPERATURE table
+  records: iterable
+    (time, antenna, tsys, tant) for each measurement, see tsys_record_dtype.
+    Times are in days, as UV_DATA TIME; temperatures in KELVIN. Antennas
+    are numbered from 1, as ANTENNA_NO.
+  time_interval: float
+    time each measurement covers, in days
+  chunk_size: int
+    number of records to convert and write at once
+  queue_depth: int
+    see stream_table()
+  """
+  
+  def make_columns(chunk):
+    return system_temperature_columns(chunk.time, time_interval, chunk.antenna, chunk.tsys, chunk.tant)
+  
+  return stream_table(writer, batchRecords(records, tsys_record_dtype, chunk_size), make_columns, queue_depth)
 
-def config_uv_data(h5, tbl_uv_data, antenna_array, source):
+def stream_flag(writer, records, time_interval=1.0/86400, reason='', chunk_size=65536, queue_depth=0):
+  """ Streams flags to a growing FLAG table.
+  
+  Parameters
+  ----------
+  writer: TableWriter
+    writer for the FLAG table
+  records: iterable
+    (time, antenna, chan_start, chan_stop) for each flag, see flag_record_dtype.
+    Each flags every baseline with the antenna, from time (in days, as
+    UV_DATA TIME) for time_interval. Antennas are numbered from 1, as
+    ANTENNA_NO, and antenna 0 flags all of them; channels likewise.
+  time_interval: float
+    time each flag covers, in days
+  reason: string
+    reason for flagging, up to 24 characters
+  chunk_size: int
+    number of records to convert and write at once
+  queue_depth: int
+    see stream_table()
+  """
+  
+  def make_columns(chunk):
+    return flag_columns(chunk.time, chunk.time + time_interval, chunk.antenna,
+                        chan_start=chunk.chan_start, chan_stop=chunk.chan_stop, reason=reason)
+  
+  return stream_table(writer, batchRecords(records, flag_record_dtype, chunk_size), make_columns, queue_depth)
+
+def build_antenna(names, config='config.xml'):
+  """ Creates a configured ANTENNA table, with a row for each antenna name """
+  return config_antenna(make_antenna(config=config, num_rows=len(names)), names)
+
+def build_array_geometry(positions, names=None, mount=1, config='config.xml'):
+  """ Creates a configured ARRAY_GEOMETRY table.
+  
+  Parameters
+  ----------
+  positions: numpy.array
+    antenna positions in METERS from the array centre, with shape (nant, 3)
+  names: list
+    antenna names, defaults to MED_0, MED_1...
+  mount: int or numpy.array
+    antenna mount code, for all antennas or one for each
+  config: string
+    filename of xml configuration file
+  """
+  
+  positions = np.asarray(positions)
+  tbl = make_array_geometry(config=config, num_rows=len(positions))
+  return config_array_geometry(tbl, positions, names, mount)
+
+def build_system_temperature(times, tsys, tant=47, time_interval=None, antenna_nos=None,
+                             config='config.xml'):
+  """ Creates a configured SYSTEM_TEMPERATURE table from a Tsys time series.
+  
+  There is one row for each time and antenna, time-major.
+  
+  Parameters
+  ----------
+  times: numpy.array
+    time of each measurement, in days (as UV_DATA TIME), shape (ntime,)
+  tsys: numpy.array
+    system temperatures in KELVIN, shape (ntime, nant)
+  tant: float or numpy.array
+    antenna temperatures in KELVIN, a single value or shape (ntime, nant)
+  time_interval: float or numpy.array
+    time each measurement covers, in days. Defaults to the time between
+    the first two measurements, or a year if there is only one.
+  antenna_nos: numpy.array
+    antenna number of each column of tsys, defaults to 1, 2, 3...
+  config: string
+    filename of xml configuration file
+  """
+  
+  times = np.atleast_1d(np.asarray(times, dtype='float64'))
+  tsys = np.asarray(tsys)
+  (t_len, ant_len) = tsys.shape
+  
+  if time_interval is None:
+    time_interval = times[1] - times[0] if t_len > 1 else 365
+  if antenna_nos is None:
+    antenna_nos = np.arange(1, ant_len + 1)
+  
+  tbl = make_system_temperature(config=config, num_rows=t_len*ant_len)
+  return config_system_temperature(tbl,
+                                   times=np.repeat(times, ant_len),
+                                   time_interval=np.repeat(np.zeros(t_len) + time_interval, ant_len),
+                                   antenna_nos=np.tile(antenna_nos, t_len),
+                                   tsys=tsys.ravel(),
+                                   tant=(np.zeros(tsys.shape) + tant).ravel())
+
+
+def uv_metadata(reader, antenna_array, source):
+  """ Generates the per-dump and per-baseline UV_DATA values from a HDF5 file.
+  
+  Parameters
+  ----------
+  reader: HDF5Reader
+    reader for a HDF5 file with xeng_raw0, timestamp0 and bl_order nodes
+  antenna_array: Array
+    antenna array (pyEphem observer), used as the UVW reference
+  source: ephem.FixedBody
+    source to be phased to (use makeSource())
+  
+  Returns
+  -------
+  (uvws, bl_ids, julian_midnight, elapsed), where uvws has shape (t_len, bl_len, 3)
+  and units of SECONDS, bl_ids has one baseline ID for each baseline, julian_midnight
+  is the julian date at midnight and elapsed is the day fraction of each dump.
+  """
   
   print('\nGenerating file metadata')
   print('--------------------------')
+  
+  return uv_geometry(reader.timestamps, reader.bl_order, antenna_array, source, verbose=True)
 
-  # Data is stored in multidimensional array called xeng_raw0
-  # time, channels, baselines, polarisation, then data=(real, imaginary) 
-  (t_len, chan_len, bl_len, pol_len, ri_len) = h5.root.xeng_raw0.shape
-  h5data = h5.root.xeng_raw0
-    
-  timestamps = []
-  baselines = []
-  weights = [1  in range(0,2048)]
+def antennaNumbers(bl_order):
+  """ FITS IDI antenna numbers (ant1, ant2) of each baseline in bl_order.
   
-  print('Retrieving timestamps...')
-  for t in range(0,t_len):
-    timestamp = h5.root.timestamp0[t]
-    timestamps.append(timestamp)
+  bl_order counts antennas from 0, but FITS IDI counts them from 1 (as in
+  ANTENNA_NO and NOSTA), and uses antenna 0 in FLAG to mean all antennas.
+  """
+  return np.asarray(bl_order) + 1
+
+def baselineIds(bl_order):
+  """ UV_DATA BASELINE of each baseline in bl_order """
+  # Baseline is in stupid 256*baseline1 + baseline2 format
+  ants = antennaNumbers(bl_order)
+  return 256*ants[:,0] + ants[:,1]
+
+def checkAntennaNumbers(fitsfile, bl_order):
+  """ Raises ValueError unless an existing FITS IDI file numbers its antennas from 1,
+  as baselineIds() does, so that more dumps can be appended to it.
+  
+  Both the ANTENNA table and the first dump of UV_DATA are checked, as files
+  written before antennas were numbered from 1 have antenna 0 in both.
+  """
+  
+  reader = FitsidiReader(fitsfile)
+  try:
+    if 'ANTENNA' in reader.extnames and reader.num_rows('ANTENNA'):
+      if reader.table('ANTENNA')['ANTENNA_NO'].min() < 1:
+        raise ValueError('%s numbers its antennas from 0, so dumps numbered from 1 cannot be appended'
+                         %fitsfile)
+    baselines = reader.uv_data()['BASELINE'][:len(bl_order)]
+    if len(baselines) and (baselines / 256).min() < 1:
+      raise ValueError('%s has UV_DATA baselines with antenna 0, so baselines numbered from 1 '
+                       'cannot be appended'%fitsfile)
+  finally:
+    reader.close()
 
+def uv_geometry(timestamps, bl_order, antenna_array, source, julian_midnight=None, verbose=False):
+  """ Generates the per-dump and per-baseline UV_DATA values for a set of dumps.
+  
+  Parameters
+  ----------
+  timestamps: numpy.array
+    unix timestamp of each dump
+  bl_order: numpy.array
+    (ant1, ant2) pair for each baseline
+  antenna_array: Array
+    antenna array (pyEphem observer), used as the UVW reference
+  source: ephem.FixedBody
+    source to be phased to (use makeSource())
+  julian_midnight: int
+    julian date at midnight to measure times from. Defaults to midnight
+    before the first dump; pass it in to carry on from earlier dumps.
+  verbose: bool
+    print progress messages
+  
+  Returns
+  -------
+  (uvws, bl_ids, julian_midnight, elapsed), as for uv_metadata()
+  """
+  
+  if verbose: print('Retrieving timestamps...')
+  timestamps = np.asarray(timestamps, dtype='float64')
 
   # Date and time
   # Date is julian date at midnight that day
   # The time is DAYS since midnight
-  firststamp = timestamps[0]
-  julian = ephem.julian_date(time.gmtime(firststamp)[:6])
+  julian = unix2jd(timestamps)
   
-  midnight = int(firststamp)
+  # Julian dates start at NOON, we need at MIDNIGHT
+  if julian_midnight is None:
+    julian_midnight = int(julian[0])+1
+  elapsed = julian - julian_midnight
+    
+  if verbose: print('Creating baseline IDs...')
+  bl_ids = baselineIds(bl_order)
+    
+  if verbose: print('Computing UVW coordinates...\n')
+  # Use the source as our phase centre. Sidereal time is computed for every
+  # timestamp in numpy; the apparent source position changes slowly, so is
+  # only computed with pyEphem every few minutes and interpolated
+  ra, dec = interpRaDec(source, antenna_array, timestamps)
+  H = jd2last(julian, antenna_array.long) - ra
+  d = dec
+
+  # This array has shape t_len, bl_len, 3
+  # and units of SECONDS
+  uvws = computeBaselineUVWs(antenna_array.antennas, bl_order, H, d) / light_speed
   
-  # Ephem returns julian date at NOON, we need at MIDNIGHT
-  julian_midnight = int(julian)+1
+  return uvws, bl_ids, julian_midnight, elapsed
 
-  elapsed = []
-  for timestamp in timestamps:
-    # time = ephem.julian_date(datetime.datetime.fromtimestamp(timestamp))
-    # t = ephem.julian_date(time.gmtime(timestamps[0])[:6])
-    elapsed.append((ephem.julian_date(time.gmtime(timestamp)[:6]) - julian_midnight))
+def fill_uv_slab(rows, slab, uvws, bl_ids, julian_midnight, elapsed, complex_len=2, int_time=3,
+                 weights=None):
+  """ Fills a block of UV_DATA rows from a slab of time dumps.
 
+  Rather than setting each row field by field, the slab is reformatted with
+  array operations and whole columns of the block are assigned at once.
+
+  FLUX is packed in FITS IDI order, (band, channel, stokes, real/imag) within
+  each row. Bands are consecutive runs of the HDF5 channels, so the band and
+  channel axes flatten to the HDF5 channel axis, and every polarisation is
+  packed with one transpose of the slab. If the rows have room for fewer
+  stokes than the slab has polarisations (NSTOKES in the config file), only
+  the first NSTOKES polarisations are kept.
+
+  Weights are all set to 1, in the WEIGHT column if the rows have one, and as
+  the third value of the complex axis if complex_len is 3.
+
+  Parameters
+  ----------
+  rows: pyfits.FITS_rec or numpy.recarray
+    block of n_t * bl_len UV_DATA rows to be filled, time-major
+  slab: numpy.array
+    n_t dumps of xeng_raw0, with axes (time, channels, baselines, polarisation, real/imag)
+  uvws: numpy.array
+    UVW coordinates in SECONDS, with shape (n_t, bl_len, 3)
+  bl_ids: numpy.array
+    baseline IDs (256*ant1 + ant2), one for each baseline
+  julian_midnight: int
+    julian date at midnight on the day of observation
+  elapsed: list
+    fraction of day since midnight, one for each dump in the slab
+  complex_len: int
+    length of the FLUX complex axis, MAXIS1 (NCOMPLEX in the config file):
+    2 for (real, imag) or 3 for (real, imag, weight)
+  int_time: float or numpy.array
+    integration time in SECONDS, for all dumps or one for each
+  weights: numpy.array
+    weight of each sample, with axes (time, channels, baselines), e.g. from
+    UVAverager. Defaults to 1 for every sample.
+  """
+
+  (t_len, chan_len, bl_len, pol_len, ri_len) = slab.shape
+
+  # Number of stokes (polarisations) that fit in each row
+  flux_len = rows.field('FLUX').shape[1]
+  stokes_len = flux_len / (chan_len * complex_len)
+  if stokes_len * chan_len * complex_len != flux_len or not 0 < stokes_len <= pol_len:
+    raise ValueError('UV_DATA rows with FLUX of %i values cannot hold %i channels of %i polarisations'
+                     %(flux_len, chan_len, pol_len))
+
+  # Per-row values, one row per (time, baseline)
+  rows.field('UU')[:]       = uvws[:,:,0].ravel()
+  rows.field('VV')[:]       = uvws[:,:,1].ravel()
+  rows.field('WW')[:]       = uvws[:,:,2].ravel()
+  rows.field('BASELINE')[:] = np.tile(bl_ids, t_len)
+
+  # Date and time
+  # Date is julian date at midnight that day
+  # The time is days since midnight
+  rows.field('DATE')[:]     = julian_midnight
+  rows.field('TIME')[:]     = np.repeat(elapsed, bl_len)
+
+  rows.field('SOURCE')[:]   = 1
+  rows.field('FREQID')[:]   = 1
+  rows.field('INTTIM')[:]   = np.repeat(np.zeros(t_len) + int_time, bl_len)
+
+  # Swap real and imaginary, then reorder to (time, baseline, chan, stokes,
+  # real/imag) so channels, stokes and complex values are flattened into each
+  # row. Assigning through a view of the FLUX column avoids a temporary copy
+  # of the whole slab.
+  flux = slab[:,:,:,:stokes_len,::-1].transpose((0,2,1,3,4))
+  rows_flux = rows.field('FLUX').view()
+  rows_flux.shape = (t_len, bl_len, chan_len, stokes_len, complex_len)
+  rows_flux[...,:ri_len] = flux
+  
+  # Weights are the same for every stokes, and in the same order as FLUX
+  if weights is None:
+    weights = 1
+  else:
+    weights = weights.transpose((0,2,1))[...,None]
+  if 'WEIGHT' in rows.dtype.names:
+    rows_weight = rows.field('WEIGHT').view()
+    rows_weight.shape = (t_len, bl_len, chan_len, -1)
+    rows_weight[...] = weights
+  if complex_len > ri_len:
+    rows_flux[...,ri_len] = weights
+
+  return rows
+
+def fill_uv_data(tbl_uv_data, reader, uvws, bl_ids, julian_midnight, elapsed):
+  """ Fills the UV_DATA table from the xeng_raw0 array, a slab of dumps at a time.
+
+  A whole slab of time dumps is read from the HDF5 file in one go, and
+  assigned to a contiguous block of rows with fill_uv_slab().
+
+  Parameters
+  ----------
+  tbl_uv_data: pyfits.hdu
+    UV_DATA table to be filled, with t_len * bl_len rows
+  reader: HDF5Reader
+    reader for the xeng_raw0 array, which sets the slab size
+  uvws, bl_ids, julian_midnight, elapsed:
+    as returned by uv_metadata()
+  """
+
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
+
+  for t0, t1, slab in reader.slabs():
+    print('processing time sample sets %i-%i/%i'%(t0+1, t1, t_len))
     
-  print('Creating baseline IDs...')
-  bl_order = h5.root.bl_order
-  antennas = antenna_array.antennas
-  for bl in range(0,bl_len):
-    # Baseline is in stupid 256*baseline1 + baseline2 format
-    ant1, ant2 = bl_order[bl][0], bl_order[bl][1] 
-    bl_id = 256*ant1 + ant2
-    
-    # Generate the XYZ vectors too
-    # From CASA measurement set definition
-    # uvw coordinates for the baseline from ANTENNE2 to ANTENNA1, 
-    # i.e. the baseline is equal to the difference POSITION2 - POSITION1. 
-    bl_vector = antennas[ant2] - antennas[ant1]
-    baselines.append((bl_id,bl_vector))  
-    
-  print('Computing UVW coordinates...\n')
-  # Extract the timestamps and use these to make source our phase centre
-  uvws = []
-  for timestamp in timestamps:
-    t = datetime.datetime.utcfromtimestamp(timestamp)
-    print t
-    antenna_array.update(t)
-    source.compute(antenna_array)
-  
-    for baseline in baselines:
-      vector = baseline[1]
-      H, d = (antenna_array.sidereal_time() - source.ra, source.dec)
-      uvws.append(computeUVW(vector,H,d))
-
-  # This array has shape t_len, num_ants, 3
-  # and units of SECONDS
-  uvws = np.array(uvws)
-  uvws = uvws.reshape(uvws.size/bl_len/3,bl_len,3) / light_speed
+    fill_uv_slab(tbl_uv_data.data[t0*bl_len:t1*bl_len], slab,
+                 uvws[t0:t1], bl_ids, julian_midnight, elapsed[t0:t1],
+                 tbl_uv_data.header['MAXIS1'])
+
+  return tbl_uv_data
 
+def config_uv_data(reader, tbl_uv_data, antenna_array, source):
+  """ Configures the UV_DATA table from a HDF5 file, all in memory.
+  
+  Parameters
+  ----------
+  reader: HDF5Reader
+    reader for a HDF5 file with xeng_raw0, timestamp0 and bl_order nodes
+  tbl_uv_data: pyfits.hdu
+    UV_DATA table to be configured, with t_len * bl_len rows
+  antenna_array: Array
+    antenna array (pyEphem observer)
+  source: ephem.FixedBody
+    source to be phased to (use makeSource())
+  """
+  
+  uvws, bl_ids, julian_midnight, elapsed = uv_metadata(reader, antenna_array, source)
 
   print('\nReformatting HDF5 format -> FITS IDI UV_DATA')
   print('--------------------------------------------')
-   
-  # The actual data matrix is stored per row as a multidimensional matrix
-  # with the following mandatory axes:
-  # COMPLEX     Real, imaginary, (weight)
-  # STOKES      Stokes parameter
-  # FREQ        Frequency (spectral channel)
-  # RA          Right ascension of the phase center
-  # DEC         Declination of the phase center 
-  flux = np.ndarray(shape=(chan_len,1,ri_len))
-   
-  # This step takes ages.
-  # I imagine there is some way to massage the hdf5 array
-  # to do this a lot quicker than iterating over the indexes 
+  
   print('\nCreating multidimensional UV matrix...')
-  for t in range(0,t_len):
-    print('processing time sample set %i/%i'%(t+1,t_len))
-    for bl in range(0,bl_len):
-      
-      # Create a 1D index for the uv_data table
-      i = t*bl_len + bl
-      
-      # Swap real and imaginary
-      flux[:,0,0] = h5data[t,:,bl,0,1]
-      flux[:,0,1] = h5data[t,:,bl,0,0]
-      
-      tbl_uv_data.data[i]['FLUX']     = flux.ravel()
-      tbl_uv_data.data[i]['WEIGHT']   = weights
-      
-      tbl_uv_data.data[i]['UU']       = uvws[t][bl][0]
-      tbl_uv_data.data[i]['VV']       = uvws[t][bl][1]
-      tbl_uv_data.data[i]['WW']       = uvws[t][bl][2]
-      
-      # baselines is a list: [ (id, vec), (id,vec) ... ]
-      tbl_uv_data.data[i]['BASELINE'] = baselines[bl][0]
-      
-      # Date and time
-      # Date is julian date at midnight that day
-      # The time is seconds since midnight
-      tbl_uv_data.data[i]['DATE']     = julian_midnight
-      tbl_uv_data.data[i]['TIME']     = elapsed[t]
-
-      tbl_uv_data.data[i]['SOURCE']   = 1
-      tbl_uv_data.data[i]['FREQID']   = 1
-      tbl_uv_data.data[i]['INTTIM']   = 3
+  fill_uv_data(tbl_uv_data, reader, uvws, bl_ids, julian_midnight, elapsed)
     
   print('\nData reformatting complete')
+  print(reader.report())
   
-  h5.close()
+  reader.close()
   
   return tbl_uv_data  
-  print('DONE.')
+
+def _average_slab(averager, slab, uvws, elapsed, mask=None):
+  """ Averages a slab with a UVAverager, or passes it through as it is if there isn't one.
+  Samples flagged in mask (e.g. from RFIFlagger.add()) are left out of the averages.
+  Returns (slab, uvws, elapsed, int_time, weights), for fill_uv_slab(). """
+  if averager is None:
+    return slab, uvws, elapsed, 3, None
+  weights = None if mask is None else (~mask).astype('float32')
+  return averager.average(slab, uvws, elapsed, weights)
+
+def stream_uv_data(reader, writer, antenna_array, source, stats=None, flagger=None, averager=None):
+  """ Streams UV_DATA rows from a HDF5 file to a FITS IDI file.
+  
+  Rows are appended a slab of time dumps at a time, so memory use is
+  bounded by one slab rather than by the length of the observation.
+  
+  Parameters
+  ----------
+  reader: HDF5Reader
+    reader for a HDF5 file with xeng_raw0, timestamp0 and bl_order nodes,
+    which sets the number of time dumps to read and write at once
+  writer: UVDataWriter
+    writer for the output FITS IDI file
+  antenna_array: Array
+    antenna array (pyEphem observer)
+  source: ephem.FixedBody
+    source to be phased to (use makeSource())
+  stats: ConversionStats
+    counters to add the uvw, read, fill and write stage timings to
+  flagger: RFIFlagger
+    if given, each slab is flagged for RFI as it goes past, see write_rfi_flags()
+  averager: UVAverager
+    if given, each slab is averaged in time and frequency before it is
+    written, leaving out any samples flagged. The writer must be made with
+    averager.config().
+  """
+  
+  if stats is None:
+    stats = ConversionStats()
+  if averager is not None:
+    averager.check_slab_size(reader.slab_size)
+  
+  with stats.stage('uvw'):
+    uvws, bl_ids, julian_midnight, elapsed = uv_metadata(reader, antenna_array, source)
+  
+  print('\nStreaming HDF5 format -> FITS IDI UV_DATA')
+  print('--------------------------------------------')
+  
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
+  
+  for t0 in range(0, t_len, reader.slab_size):
+    t1 = min(t0 + reader.slab_size, t_len)
+    print('processing time sample sets %i-%i/%i'%(t0+1, t1, t_len))
+    
+    with stats.stage('read'):
+      slab = reader.read(t0, t1)
+    stats.add('read', rows=(t1-t0)*bl_len, bytes_read=slab.nbytes)
+    
+    mask = None
+    if flagger is not None:
+      with stats.stage('flag'):
+        mask = flagger.add(t0, slab, elapsed[t0:t1])
+      stats.add('flag', rows=(t1-t0)*bl_len)
+    
+    if averager is not None:
+      with stats.stage('average'):
+        values = _average_slab(averager, slab, uvws[t0:t1], elapsed[t0:t1], mask)
+      stats.add('average', rows=(t1-t0)*bl_len)
+    else:
+      values = _average_slab(None, slab, uvws[t0:t1], elapsed[t0:t1])
+    (slab, slab_uvws, slab_elapsed, int_time, weights) = values
+    
+    # Every column is filled, so there's no need to zero the rows first
+    with stats.stage('fill'):
+      rows = writer.new_rows(len(slab)*bl_len, zero=False)
+      fill_uv_slab(rows, slab, slab_uvws, bl_ids, julian_midnight, slab_elapsed,
+                   writer.complex_len, int_time, weights)
+    stats.add('fill', rows=len(rows))
+    
+    with stats.stage('write'):
+      writer.write(rows)
+    stats.add('write', rows=len(rows), bytes_written=rows.nbytes)
+    
+    del rows
+    stats.progress(t1, t_len)
+  
+  print('\nData reformatting complete')
+  print(reader.report())
+  
+  reader.close()
+  
+  return writer
+
+def pipeline_uv_data(reader, writer, antenna_array, source, queue_depth=2, stats=None, flagger=None,
+                     averager=None):
+  """ Streams UV_DATA rows from a HDF5 file to a FITS IDI file, overlapping reads, compute and writes.
+  
+  As stream_uv_data(), but reading slabs, filling rows and writing them run
+  in separate threads, joined by queues of queue_depth slabs. The time each
+  stage spends busy and waiting is printed at the end.
+  
+  Parameters
+  ----------
+  reader: HDF5Reader
+    reader for a HDF5 file with xeng_raw0, timestamp0 and bl_order nodes,
+    which sets the number of time dumps to read and write at once
+  writer: UVDataWriter
+    writer for the output FITS IDI file
+  antenna_array: Array
+    antenna array (pyEphem observer)
+  source: ephem.FixedBody
+    source to be phased to (use makeSource())
+  queue_depth: int
+    number of slabs that can wait between one stage and the next
+  stats: ConversionStats
+    counters to add the uvw, read, fill and write stage timings to. The
+    stage times are the time each thread spent busy, so overlap.
+  flagger: RFIFlagger
+    if given, each slab is flagged for RFI in a stage of its own, between
+    reading and filling, see write_rfi_flags()
+  averager: UVAverager
+    if given, each slab is averaged in time and frequency in a stage of its
+    own, before filling, leaving out any samples flagged. The writer must be
+    made with averager.config().
+  
+  Returns
+  -------
+  pipeline: Pipeline, with the timing counters of each stage
+  """
+  
+  if stats is None:
+    stats = ConversionStats()
+  if averager is not None:
+    averager.check_slab_size(reader.slab_size)
+  
+  with stats.stage('uvw'):
+    uvws, bl_ids, julian_midnight, elapsed = uv_metadata(reader, antenna_array, source)
+  
+  print('\nStreaming HDF5 format -> FITS IDI UV_DATA, with a pipeline of threads')
+  print('--------------------------------------------')
+  
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
+  
+  # The flag stage passes its mask on with the slab, for the averages
+  def flag_slab((t0, t1, slab)):
+    return t0, t1, slab, flagger.add(t0, slab, elapsed[t0:t1])
+  
+  def average_slab(item):
+    (t0, t1, slab), mask = item[:3], item[3] if len(item) > 3 else None
+    return t0, t1, _average_slab(averager, slab, uvws[t0:t1], elapsed[t0:t1], mask)
+  
+  def fill_rows((t0, t1, (slab, slab_uvws, slab_elapsed, int_time, weights))):
+    rows = writer.new_rows(len(slab)*bl_len, zero=False)
+    fill_uv_slab(rows, slab, slab_uvws, bl_ids, julian_midnight, slab_elapsed,
+                 writer.complex_len, int_time, weights)
+    return t1, rows
+  
+  def write_rows((t1, rows)):
+    writer.write(rows)
+    stats.progress(t1, t_len)
+  
+  # Without averaging, the fill stage just passes the slab through to fill_rows()
+  if averager is not None:
+    stages = [('average', average_slab), ('fill', fill_rows), ('write', write_rows)]
+  else:
+    stages = [('fill', lambda item: fill_rows(average_slab(item))), ('write', write_rows)]
+  if flagger is not None:
+    stages.insert(0, ('flag', flag_slab))
+  
+  pipeline = Pipeline(reader.slabs(), stages, queue_depth=queue_depth)
+  pipeline.run()
+  
+  num_rows = t_len * bl_len
+  for stage in pipeline.stages:
+    stats.add(stage.name, seconds=stage.busy, calls=stage.count, rows=num_rows)
+  stats.add('read', bytes_read=reader.bytes_read)
+  stats.add('write', bytes_written=writer.num_rows * writer.dtype.itemsize)
+  
+  print('\nData reformatting complete')
+  print(reader.report())
+  print(pipeline.report())
+  
+  reader.close()
+  
+  return pipeline
+
+def _convert_range(task):
+  """ Worker for parallel_uv_data(): converts one time range of dumps into its reserved rows """
+  
+  (hdffile, slab_size, t_start, t_stop, uvws, bl_ids, julian_midnight, elapsed,
+   fitsfile, offset, fits_dtype, complex_len, threshold, averager) = task
+  
+  # Each worker needs its own handle on the HDF5 file
+  reader = HDF5Reader(hdffile, slab_size=slab_size)
+  bl_len = reader.shape[2]
+  
+  # Fill the reserved rows in place, through a memory map of the output file.
+  # The index columns of the rows are sent back, for the writer's index, with
+  # any RFI flags found, already merged.
+  index = []
+  flagger = RFIFlagger(threshold) if threshold is not None else None
+  time_avg = averager.time_avg if averager is not None else 1
+  for t0, t1, slab in reader.slabs(t_start, t_stop):
+    mask = flagger.add(t0, slab) if flagger is not None else None
+    i0, i1 = t0 - t_start, t1 - t_start
+    (slab, slab_uvws, slab_elapsed, int_time, weights) = _average_slab(averager, slab, uvws[i0:i1],
+                                                                       elapsed[i0:i1], mask)
+    rows = mapRowsAt(fitsfile, offset + i0/time_avg*bl_len*fits_dtype.itemsize, len(slab)*bl_len,
+                     fits_dtype)
+    fill_uv_slab(rows.view(np.recarray), slab, slab_uvws, bl_ids, julian_midnight,
+                 slab_elapsed, complex_len, int_time, weights)
+    index.append(indexColumns(rows.view(np.recarray)))
+    rows.flush()
+    del rows
+  
+  reader.close()
+  
+  if flagger is None:
+    return reader.bytes_read, reader.read_time, np.concatenate(index), None, 0
+  return reader.bytes_read, reader.read_time, np.concatenate(index), flagger.ranges(), flagger.samples
+
+def parallel_uv_data(reader, writer, antenna_array, source, num_procs=None, stats=None, flagger=None,
+                     averager=None):
+  """ Converts UV_DATA rows from a HDF5 file to a FITS IDI file, with a pool of processes.
+  
+  The dumps are split into time ranges. Rows for all dumps are reserved in
+  the output file up front, and each worker reads its time range, computes
+  the rows and writes them straight into their place in the file.
+  
+  Parameters
+  ----------
+  reader: HDF5Reader
+    reader for a HDF5 file with xeng_raw0, timestamp0 and bl_order nodes,
+    which sets the number of time dumps to read and write at once
+  writer: UVDataWriter
+    writer for the output FITS IDI file
+  antenna_array: Array
+    antenna array (pyEphem observer)
+  source: ephem.FixedBody
+    source to be phased to (use makeSource())
+  num_procs: int
+    number of worker processes, defaults to the number of CPUs
+  stats: ConversionStats
+    counters to add the uvw and convert stage timings to. The convert stage
+    covers reading, filling and writing in the workers.
+  flagger: RFIFlagger
+    if given, each slab is flagged for RFI by the worker that converts it,
+    and the flags are collected here, see write_rfi_flags()
+  averager: UVAverager
+    if given, each slab is averaged in time and frequency by the worker that
+    converts it. The writer must be made with averager.config().
+  """
+  
+  if num_procs is None:
+    num_procs = multiprocessing.cpu_count()
+  if stats is None:
+    stats = ConversionStats()
+  if averager is not None:
+    averager.check_slab_size(reader.slab_size)
+  
+  with stats.stage('uvw'):
+    uvws, bl_ids, julian_midnight, elapsed = uv_metadata(reader, antenna_array, source)
+  
+  print('\nConverting HDF5 format -> FITS IDI UV_DATA with %i processes'%num_procs)
+  print('--------------------------------------------')
+  
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
+  hdffile, slab_size = reader.h5.filename, reader.slab_size
+  
+  # Don't share the open HDF5 file with the worker processes
+  reader.close()
+  
+  # Time ranges are a whole number of slabs, so a whole number of averaged dumps
+  time_avg = averager.time_avg if averager is not None else 1
+  start_row = writer.allocate((t_len + time_avg - 1) / time_avg * bl_len)
+  
+  # A few time ranges per process, so that they finish at about the same time.
+  # Ranges are a whole number of slabs.
+  range_len = int(np.ceil(float(t_len) / (num_procs * 4) / slab_size)) * slab_size
+  tasks = []
+  for t0 in range(0, t_len, range_len):
+    t1 = min(t0 + range_len, t_len)
+    offset = writer.offset(start_row + t0/time_avg*bl_len)
+    tasks.append((hdffile, slab_size, t0, t1, uvws[t0:t1], bl_ids, julian_midnight,
+                  elapsed[t0:t1], writer.fitsfile, offset, writer.dtype, writer.complex_len,
+                  flagger.threshold if flagger is not None else None, averager))
+  
+  pool = multiprocessing.Pool(num_procs)
+  try:
+    with stats.stage('convert'):
+      for i, (bytes_read, read_time, index, ranges, samples) in enumerate(pool.imap(_convert_range, tasks)):
+        print('processing time range %i/%i'%(i+1, len(tasks)))
+        reader.bytes_read += bytes_read
+        reader.read_time += read_time
+        writer.add_index(start_row + tasks[i][2]/time_avg*bl_len, index)
+        if flagger is not None:
+          flagger.add_runs(ranges, samples)
+          flagger.add_times(tasks[i][2], tasks[i][7])
+        stats.add('convert', rows=len(index), bytes_read=bytes_read,
+                  bytes_written=len(index) * writer.dtype.itemsize)
+        stats.progress(tasks[i][3], t_len)
+  finally:
+    pool.close()
+    pool.join()
+  
+  print('\nData reformatting complete')
+  print(reader.report())
+  
+  return writer
+
+def write_rfi_flags(fitsfile, flagger, bl_order, int_time=3.0, time_avg=1, chan_avg=1, config='config.xml'):
+  """ Writes the RFI flags found during a conversion to the FLAG table of a FITS IDI file.
+  
+  The rows are added with appendRows(), so the FLAG table must have had
+  rows reserved for it by UVDataWriter. If there are more flags than rows
+  reserved, only the earliest are written.
+  
+  Parameters
+  ----------
+  fitsfile: string
+    filename of the FITS IDI file, once its UV_DATA writer is closed
+  flagger: RFIFlagger
+    flagger passed to stream_uv_data(), pipeline_uv_data() or parallel_uv_data()
+  bl_order: numpy.array
+    (ant1, ant2) pair for each baseline, as in the HDF5 file (numbered from 0)
+  int_time: float
+    integration time of each dump in SECONDS, before any averaging. Each
+    time range flagged is widened by half a dump either side.
+  time_avg: int
+    number of dumps averaged into each UV_DATA dump (see UVAverager). Each
+    time range flagged is widened to the whole of the averaged dumps it
+    touches, so that it covers their (mean) times.
+  chan_avg: int
+    number of channels averaged into each UV_DATA channel (see UVAverager).
+    An averaged channel is flagged if any of its channels is.
+    Flags are split at the band edges, and written with the band they fall
+    in and channels counted from the start of that band.
+  config: string
+    filename of xml configuration file, defaults to 'config,xml'
+  
+  Returns
+  -------
+  num_rows: int, the number of FLAG rows written
+  """
+  
+  ranges = flagger.ranges()
+  times = flagger.times()
+  
+  reader = FitsidiReader(fitsfile)
+  chan_len = reader.header('UV_DATA')['NO_CHAN']
+  room = 0
+  if 'FLAG' in reader.extnames:
+    header = reader.header('FLAG')
+    room = header.get('PCOUNT', 0) / header['NAXIS1']
+  reader.close()
+  
+  # Flags are in dumps and channels as read, so are widened to the averaged
+  # dumps and channels they fall in.
+  averaged = np.zeros(len(ranges), dtype=range_dtype)
+  averaged['baseline'] = ranges['baseline']
+  averaged['t_start'] = ranges['t_start'] / time_avg * time_avg
+  averaged['t_stop'] = np.minimum((ranges['t_stop'] + time_avg - 1) / time_avg * time_avg, len(times))
+  averaged['chan_start'] = ranges['chan_start'] / chan_avg
+  averaged['chan_stop'] = (ranges['chan_stop'] + chan_avg - 1) / chan_avg
+  
+  # The channels run across all the bands, so a range crossing a band edge
+  # becomes one range in each band it touches
+  first_band = averaged['chan_start'] / chan_len
+  num_bands = (averaged['chan_stop'] - 1) / chan_len - first_band + 1
+  if np.any(num_bands > 1):
+    piece = np.arange(num_bands.sum()) - np.repeat(np.cumsum(num_bands) - num_bands, num_bands)
+    band = np.repeat(first_band, num_bands) + piece
+    averaged = np.repeat(averaged, num_bands)
+    averaged['chan_start'] = np.maximum(averaged['chan_start'], band * chan_len)
+    averaged['chan_stop'] = np.minimum(averaged['chan_stop'], (band + 1) * chan_len)
+  
+  # Ranges in the same averaged dumps and channels then become one
+  if time_avg > 1 or chan_avg > 1:
+    averaged = np.unique(averaged)
+    averaged = averaged[np.argsort(averaged['t_start'], kind='mergesort')]
+  ranges = averaged
+  
+  if len(ranges) > room:
+    print('Warning: %i RFI flags, but only room for %i in FLAG; the rest are dropped'
+          %(len(ranges), room))
+    ranges = ranges[:room]
+  if len(ranges) == 0:
+    return 0
+  
+  # FLAG bands and channels are numbered from 1, and the last channel is included
+  half_dump = int_time / 86400.0 / 2
+  ants = antennaNumbers(bl_order)[ranges['baseline']]
+  band = ranges['chan_start'] / chan_len
+  tbl = make_flag(config=config, num_rows=len(ranges))
+  fill_columns(tbl, flag_columns(times[ranges['t_start']] - half_dump,
+                                 times[ranges['t_stop'] - 1] + half_dump,
+                                 ants[:,0], ants[:,1],
+                                 ranges['chan_start'] - band * chan_len + 1,
+                                 ranges['chan_stop'] - band * chan_len,
+                                 band + 1,
+                                 reason='RFI MAD > %g SIGMA'%flagger.threshold))
+  appendRows(fitsfile, 'FLAG', tbl.data)
+  
+  return len(ranges)
 
 
 #####################
 ##       MAIN      ##
 #####################
 
-def main():
+def main(num_procs=1, append=False, queue_depth=0, stats_file=None, progress_interval=None,
+         flag_threshold=None, max_flags=10000, time_avg=1, chan_avg=1, compress=None):
   """
   Main function call. This is the conductor.
+  
+  Parameters
+  ----------
+  num_procs: int
+    number of processes to convert UV_DATA with. If 1, UV_DATA is streamed
+    from a single process.
+  append: bool
+    if True and the output file already exists, the dumps are added to the
+    end of its UV_DATA table, rather than the file being written from scratch
+  queue_depth: int
+    if more than 0, UV_DATA is streamed from a single process with reads,
+    compute and writes overlapped in threads, with queues this deep between them
+  stats_file: string
+    filename to write a JSON summary of the time spent in each stage to
+  progress_interval: float
+    if given, print progress every this many seconds
+  flag_threshold: float
+    if given, UV_DATA is flagged for RFI as it is converted, at this many
+    (MAD estimated) standard deviations, and the flags written to FLAG
+  max_flags: int
+    number of rows to reserve in the FLAG table for RFI flags
+  time_avg, chan_avg: int
+    if more than 1, UV_DATA is averaged over this many dumps and channels,
+    for a smaller quick-look file
+  compress: string
+    if given, UV_DATA is written as a tile compressed table, with this
+    compression algorithm ('GZIP_1' or 'GZIP_2'). See CompressedUVDataWriter.
   """
   
+  stats = ConversionStats(progress=printProgress if progress_interval else None,
+                          interval=progress_interval or 5.0)
+  
   print('\nInput and output filenames')
   print('--------------------------------')
   # What are the filenames for our datasets?
@@ -491,7 +1349,19 @@ def main():
   source.compute(medicina)
   print "Name: %s \nRA: %s \nDEC: %s"%(source.name,source.ra,source.dec)
   
+  with stats.stage('config'):
+    getConfig(configxml)
+  
+  # Averaged files have fewer, wider channels, so all the tables are made
+  # from a config to match
+  averager = None
+  if time_avg > 1 or chan_avg > 1:
+    averager = UVAverager(time_avg, chan_avg)
+    configxml = averager.config(configxml)
+    print(averager.report())
+  
   # Make a new blank FITS HDU
+  t_tables = time.time()
   print('\nCreating PRIMARY HDU')
   print('------------------------------------')
   hdu = make_primary(config=configxml)
@@ -524,48 +1394,124 @@ def main():
   tbl_antenna = config_antenna(tbl_antenna)
   print tbl_antenna.header.ascardlist()
   print('\n')
+  
+  # FLAG starts empty, with room for the RFI flags found during the conversion
+  tables = [hdu, tbl_array_geometry, tbl_frequency, tbl_antenna, tbl_source]
+  reserve = {}
+  flagger = None
+  if flag_threshold:
+    print('\nCreating FLAG')
+    print('------------------------------------')
+    tables.append(make_flag(config=configxml, num_rows=0))
+    reserve['FLAG'] = max_flags
+    flagger = RFIFlagger(flag_threshold)
+    print('Flagging RFI at %g sigma, with room for %i flags'%(flag_threshold, max_flags))
+  stats.add('tables', seconds=time.time() - t_tables, calls=1)
 
   print('\nCreating UV_DATA')
   print('------------------------------------')
   # Open hdf5 table
   print('Opening HDF5 table %s'%hdffile)
-  h5 = tb.openFile(hdffile)
+  # Averaged slabs are a whole number of averaged dumps
+  reader = HDF5Reader(hdffile, slab_size=int(np.ceil(16.0 / time_avg)) * time_avg)
   
   # Data is stored in multidimensional array called xeng_raw0
   # time, channels, baselines, polarisation, then data=(real, imaginary) 
-  (t_len, chan_len, bl_len, pol_len, ri_len) = h5.root.xeng_raw0.shape
+  (t_len, chan_len, bl_len, pol_len, ri_len) = reader.shape
   print('Data dimensions: %i dumps, %i chans, %i baselines, %i pols, %i data (real/imag)'\
   %(t_len, chan_len, bl_len, pol_len, ri_len))
   
-  print('Generating blank UV_DATA rows...')
-  tbl_uv_data = make_uv_data(config=configxml, num_rows=t_len*bl_len)
-
-  print('Now filling FITS file with data from HDF file...')
-  # The config function is in a seperate file, so import it
-  tbl_uv_data = config_uv_data(h5,tbl_uv_data, medicina, source)
-  print tbl_uv_data.header.ascardlist()
-  print('\n')
-
-  hdulist = pf.HDUList(
-              [hdu, 
-              tbl_array_geometry,
-              tbl_frequency,
-              tbl_antenna,
-              tbl_source, 
-              tbl_uv_data
-              ])
+  hdulist = pf.HDUList(tables)
   
   print('Verifying integrity...')            
   hdulist.verify()
   
-  if(os.path.isfile(fitsfile)):
-    print('Removing existing file...')
-    os.remove(fitsfile)
-  print('Writing to file...')
-  hdulist.writeto(fitsfile)
+  # Compressed tiles are made in order, so compressed UV_DATA is streamed from
+  # one process, and can't be appended to
+  if compress and num_procs > 1 and queue_depth == 0:
+    print('Compressed UV_DATA is written from a single process, ignoring %i processes'%num_procs)
+    num_procs = 1
+  if compress and append:
+    print('Compressed UV_DATA cannot be appended to, writing %s from scratch'%fitsfile)
+    append = False
+  
+  # UV_DATA is streamed to the end of the file, one slab of dumps at a time,
+  # so the whole table never has to fit in memory
+  with stats.stage('writeto'):
+    if compress:
+      print('Writing headers to file, UV_DATA compressed with %s...'%compress)
+      writer = CompressedUVDataWriter(fitsfile, hdulist, config=configxml, reserve=reserve,
+                                      algorithm=compress)
+    elif append and os.path.isfile(fitsfile):
+      print('Appending to existing file %s...'%fitsfile)
+      checkAntennaNumbers(fitsfile, reader.bl_order)
+      writer = UVDataWriter(fitsfile, None, config=configxml, append=True)
+    else:
+      print('Writing headers to file...')
+      writer = UVDataWriter(fitsfile, hdulist, config=configxml, reserve=reserve)
+  
+  print('Now filling FITS file with data from HDF file...')
+  bl_order = reader.bl_order
+  if queue_depth > 0:
+    pipeline_uv_data(reader, writer, medicina, source, queue_depth, stats=stats, flagger=flagger,
+                     averager=averager)
+  elif num_procs == 1:
+    stream_uv_data(reader, writer, medicina, source, stats=stats, flagger=flagger,
+                   averager=averager)
+  else:
+    parallel_uv_data(reader, writer, medicina, source, num_procs, stats=stats, flagger=flagger,
+                     averager=averager)
+  with stats.stage('close'):
+    writer.close()
+  print writer.header.ascardlist()
+  if compress:
+    print('UV_DATA compressed %.1fx'%(float(writer.num_rows * writer.dtype.itemsize) /
+                                      max(writer.bytes_compressed, 1)))
+  print('\n')
+  
+  if flagger is not None:
+    with stats.stage('flag_write'):
+      num_flags = write_rfi_flags(fitsfile, flagger, bl_order, time_avg=time_avg, chan_avg=chan_avg,
+                                  config=configxml)
+    stats.add('flag_write', rows=num_flags)
+    print(flagger.report())
+    print('%i FLAG rows written'%num_flags)
+  
+  print(stats.report())
+  if stats_file:
+    stats.to_json(stats_file)
+    print('Stats written to %s'%stats_file)
 
   print('Done.')
 
 
 if __name__ == '__main__':
-  main()
\ No newline at end of file
+  from optparse import OptionParser
+  parser = OptionParser()
+  parser.add_option('-n', '--num-procs', dest='num_procs', type='int', default=1,
+                    help='number of processes to convert UV_DATA with (default 1)')
+  parser.add_option('-a', '--append', dest='append', action='store_true', default=False,
+                    help='append to the output file if it already exists')
+  parser.add_option('-q', '--queue-depth', dest='queue_depth', type='int', default=0,
+                    help='overlap reads, compute and writes in threads, with queues this deep (default 0, off)')
+  parser.add_option('-s', '--stats', dest='stats_file', default=None,
+                    help='write a JSON summary of the time spent in each stage to this file')
+  parser.add_option('--progress', dest='progress_interval', type='float', default=None,
+                    help='print progress every this many seconds')
+  parser.add_option('-f', '--flag', dest='flag_threshold', type='float', default=None,
+                    help='flag RFI more than this many standard deviations from the median into FLAG')
+  parser.add_option('--max-flags', dest='max_flags', type='int', default=10000,
+                    help='number of rows to reserve in FLAG for RFI flags (default 10000)')
+  parser.add_option('-T', '--time-avg', dest='time_avg', type='int', default=1,
+                    help='average UV_DATA over this many dumps (default 1, off)')
+  parser.add_option('-C', '--chan-avg', dest='chan_avg', type='int', default=1,
+                    help='average UV_DATA over this many channels (default 1, off)')
+  parser.add_option('-z', '--compress', dest='compress', default=None, choices=['GZIP_1', 'GZIP_2'],
+                    help='write UV_DATA as a tile compressed table, with GZIP_1 or GZIP_2 '
+                         '(CASA needs it decompressed with decompressFits first)')
+  (options, args) = parser.parse_args()
+  
+  main(num_procs=options.num_procs, append=options.append, queue_depth=options.queue_depth,
+       stats_file=options.stats_file, progress_interval=options.progress_interval,
+       flag_threshold=options.flag_threshold, max_flags=options.max_flags,
+       time_avg=options.time_avg, chan_avg=options.chan_avg, compress=options.compress)
\ No newline at end of file
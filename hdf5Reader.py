@@ -0,0 +1,111 @@
+# encoding: utf-8
+"""
+hdf5Reader.py
+=============
+
+Reads correlator output from a HDF5 file, in large contiguous slabs of time
+dumps. The file is expected to have the layout written by the CASPER
+correlator:
+
+* xeng_raw0: visibilities, with axes (time, channels, baselines, polarisation, real/imag)
+* timestamp0: unix timestamp of each dump
+* bl_order: (ant1, ant2) pair for each baseline
+
+Reading xeng_raw0 one (time, baseline) pair at a time makes PyTables do lots
+of tiny strided reads. Reading a slab of whole dumps at once turns this into a
+few large sequential reads, and the slab can then be sliced as a numpy array.
+
+Module listing
+~~~~~~~~~~~~~~
+
+"""
+
+import sys, os, time
+import numpy as np, tables as tb
+
+
+class HDF5Reader(object):
+  """ Reads xeng_raw0 from a HDF5 file, a slab of time dumps at a time.
+
+  Keeps count of the bytes read from xeng_raw0 and the time spent reading,
+  so the read throughput can be reported.
+
+  Parameters
+  ----------
+  h5file: string or tables.File
+    HDF5 file to read from
+  slab_size: int
+    number of time dumps to read at once
+
+  Attributes
+  ----------
+  shape: tuple
+    shape of xeng_raw0, (t_len, chan_len, bl_len, pol_len, ri_len)
+  timestamps: numpy.array
+    unix timestamps, one for each dump
+  bl_order: numpy.array
+    (ant1, ant2) pairs, one for each baseline
+  """
+
+  def __init__(self, h5file, slab_size=16):
+    if isinstance(h5file, tb.File):
+      self.h5 = h5file
+    else:
+      self.h5 = tb.openFile(h5file)
+
+    self.slab_size = slab_size
+    self.xeng = self.h5.root.xeng_raw0
+    self.shape = self.xeng.shape
+    self.timestamps = np.array(self.h5.root.timestamp0[:], dtype='float64')
+    self.bl_order = np.array(self.h5.root.bl_order[:])
+
+    self.bytes_read = 0
+    self.read_time = 0.0
+
+  def __len__(self):
+    return self.shape[0]
+
+  def read(self, t0, t1):
+    """ Reads dumps t0 to t1 (exclusive) of xeng_raw0 in one go
+
+    Returns
+    -------
+    slab: numpy.array, with axes (time, channels, baselines, polarisation, real/imag)
+    """
+    t_start = time.time()
+    slab = self.xeng[t0:t1]
+    self.read_time += time.time() - t_start
+    self.bytes_read += slab.nbytes
+
+    return slab
+
+  def slabs(self, t_start=0, t_stop=None):
+    """ Iterates through xeng_raw0, yielding (t0, t1, slab) for each slab of dumps
+
+    Parameters
+    ----------
+    t_start: int
+      first dump to read
+    t_stop: int
+      last dump to read (exclusive), defaults to the end of the file
+    """
+    if t_stop is None:
+      t_stop = self.shape[0]
+
+    for t0 in range(t_start, t_stop, self.slab_size):
+      t1 = min(t0 + self.slab_size, t_stop)
+      yield t0, t1, self.read(t0, t1)
+
+  def throughput(self):
+    """ Read throughput so far, in bytes per second """
+    if self.read_time == 0:
+      return 0.0
+    return self.bytes_read / self.read_time
+
+  def report(self):
+    """ Returns a one line summary of the bytes read and throughput """
+    return 'Read %.1f MB in %.2fs (%.1f MB/s)'%(self.bytes_read / 1e6, self.read_time,
+                                               self.throughput() / 1e6)
+
+  def close(self):
+    self.h5.close()
@@ -8,6 +8,8 @@ Copyright (c) 2011 The University of Oxford. All rights reserved.
 
 This file is a collection of modules for creating blank FITS IDI files.
 It consists mainly of pretty basic functions to create blank tables.
+There is also a FitsidiReader, to memory map files once they are written.
+UV_DATA can be written tile compressed, see CompressedUVDataWriter.
 
 The FITS handling is all done by pyFits, and blank arrays are created
 with numpy. So you'll need to have both of these installed on your machine.
@@ -44,30 +46,571 @@ Module listing
 
 """
 
-import sys, os
+import sys, os, ast, copy, itertools, operator, shutil, tempfile, zlib
 import pyfits as pf, numpy as np
 from lxml import etree
 
-def parseConfig(tagname, config='config.xml'):
-  """ Finds tagname, in elementTree x, parses and returns dictionary of values
+# Syntax that is allowed in config values: literals, names, params['X'] lookups
+# and simple arithmetic. Anything else (calls, attributes, imports, powers...)
+# is refused. Powers are left out as a**b**c can't be bounded cheaply.
+_safe_nodes = (ast.Expression, ast.Num, ast.Str, ast.Name, ast.Load,
+               ast.Subscript, ast.Index, ast.Tuple, ast.List,
+               ast.BinOp, ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv,
+               ast.Mod, ast.UnaryOp, ast.UAdd, ast.USub)
+
+_binary_ops = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+               ast.Div: operator.div, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod}
+_unary_ops = {ast.UAdd: operator.pos, ast.USub: operator.neg}
+
+# Limits on the values config arithmetic can make: bits in an integer, and
+# items in a string, list or tuple (e.g. from 'A' * n)
+_max_int_bits = 1024
+_max_seq_len = 65536
+
+# FITS just uses T for True, python (and pyFITS) uses True
+_safe_names = {'T': True, 'F': False, 'True': True, 'False': False}
+
+_expr_cache = {}
+
+def compileExpr(text):
+  """ Checks a config value only uses safe syntax, and parses it.
   This is a helper function, and is not usually called directly.
   
-  Notes
-  -----
-  This function uses eval() to evaluate the text string inside a child tag. As such,
-  exercise caution! todo: block off certain modules to eval()
+  Parsed expressions are cached, so each distinct expression is only
+  checked and parsed once. They are not compiled to python code, as the
+  compiler folds constants (e.g. 'A' * 10000000000) before anything can
+  check them; evalExpr() evaluates them with limits instead.
+  
+  Parameters
+  ----------
+  text: string
+    python expression, e.g. 'MEDICINA' or params['NCHAN'] * 2
+  
+  Returns
+  -------
+  tree: ast.Expression
   """
   
-  xmlData = etree.parse(config) 
-  x = xmlData.getroot()
-  T = True # FITS just uses T for True, python (and pyFITS) uses True
+  tree = _expr_cache.get(text)
+  if tree is None:
+    tree = ast.parse(text.strip(), mode='eval')
+    for node in ast.walk(tree):
+      if not isinstance(node, _safe_nodes):
+        raise ValueError('%s is not allowed in config value: %s'%(type(node).__name__, text))
+      if isinstance(node, ast.Name) and node.id not in _safe_names and node.id != 'params':
+        raise ValueError('Unknown name %s in config value: %s'%(node.id, text))
+    _expr_cache[text] = tree
+  
+  return tree
+
+def evalExpr(text, params={}):
+  """ Evaluates a config value, with the restricted syntax allowed by compileExpr()
+  
+  Integers are limited to _max_int_bits bits and strings, lists and tuples
+  to _max_seq_len items, so a config value can't hang or exhaust memory.
   
-  # As we reference 'parameters', we need to search for this first
-  params = dict([ (child.tag, eval(child.text.strip())) for child in x.find('PARAMETERS').getchildren()])
+  Parameters
+  ----------
+  text: string
+    python expression, e.g. 'MEDICINA' or params['NCHAN'] * 2
+  params: dict
+    values that can be referenced as params['X']
+  """
   
-  # This line makes me very happy, but will probably infuriate others:
-  vals = dict([ (child.tag, eval(child.text.strip())) for child in x.find(tagname).getchildren()])
-  return vals
+  namespace = dict(_safe_names)
+  namespace['params'] = params
+  return _evalNode(compileExpr(text).body, namespace, text)
+
+def _evalNode(node, namespace, text):
+  """ Evaluates a node of a tree from compileExpr(), checking the size of each value made """
+  
+  if isinstance(node, ast.Num):
+    return node.n
+  if isinstance(node, ast.Str):
+    return node.s
+  if isinstance(node, ast.Name):
+    return namespace[node.id]
+  if isinstance(node, ast.Tuple):
+    return tuple(_evalNode(elt, namespace, text) for elt in node.elts)
+  if isinstance(node, ast.List):
+    return [_evalNode(elt, namespace, text) for elt in node.elts]
+  if isinstance(node, ast.Subscript):
+    return _evalNode(node.value, namespace, text)[_evalNode(node.slice.value, namespace, text)]
+  if isinstance(node, ast.UnaryOp):
+    return _unary_ops[type(node.op)](_evalNode(node.operand, namespace, text))
+  
+  left = _evalNode(node.left, namespace, text)
+  right = _evalNode(node.right, namespace, text)
+  
+  # Check the size of a product before making it, the only way to grow a value quickly
+  if isinstance(node.op, ast.Mult):
+    for seq, count in ((left, right), (right, left)):
+      if isinstance(seq, (str, unicode, list, tuple)) and isinstance(count, (int, long)) \
+          and len(seq) * count > _max_seq_len:
+        raise ValueError('Config value would be more than %i long: %s'%(_max_seq_len, text))
+    if isinstance(left, (int, long)) and isinstance(right, (int, long)) \
+        and abs(left).bit_length() + abs(right).bit_length() > _max_int_bits:
+      raise ValueError('Config value would be more than %i bits: %s'%(_max_int_bits, text))
+  
+  # % is arithmetic only, as string formatting can pad out to any width
+  if isinstance(node.op, ast.Mod) and isinstance(left, (str, unicode)):
+    raise ValueError('String formatting is not allowed in config value: %s'%text)
+  
+  try:
+    value = _binary_ops[type(node.op)](left, right)
+  except (TypeError, ZeroDivisionError, OverflowError) as e:
+    raise ValueError('%s in config value: %s'%(e, text))
+  
+  if isinstance(value, (str, unicode, list, tuple)) and len(value) > _max_seq_len:
+    raise ValueError('Config value would be more than %i long: %s'%(_max_seq_len, text))
+  
+  return value
+
+class Config(object):
+  """ A parsed XML config file.
+
+  The file is parsed once, and PARAMETERS evaluated once, when the object is
+  created. Other tags are evaluated the first time they are asked for, and
+  kept for next time. Use getConfig() rather than creating these directly, so
+  that all the table builders share the same object.
+
+  Parameters
+  ----------
+  config: string
+    filename of xml configuration file
+
+  Notes
+  -----
+  The text string inside a child tag is evaluated with evalExpr(), which only
+  allows literals, T, params['X'] references and simple arithmetic.
+  """
+
+  def __init__(self, config):
+    self.filename = os.path.abspath(config)
+    self.stamp = _file_stamp(self.filename)
+    self.root = etree.parse(self.filename).getroot()
+    self._tags = {}
+    self._overrides = {}
+
+    # As we reference 'parameters', we need to evaluate this first
+    self.params = {}
+    self.params = self['PARAMETERS']
+    
+    # Parameters added since older config files were written
+    for key, value in _default_params.items():
+      self.params.setdefault(key, value)
+
+  def __getitem__(self, tagname):
+    if tagname not in self._tags:
+      self._tags[tagname] = self._evaluate(tagname)
+    return self._tags[tagname]
+
+  def derive(self, params=None, values=None):
+    """ Returns a copy of this config, with some PARAMETERS and tag values replaced.
+
+    Tags are evaluated again with the new PARAMETERS, so e.g. NO_CHAN follows
+    NCHAN. The copy isn't cached by getConfig(), so pass it to the table
+    builders in place of the filename.
+
+    Parameters
+    ----------
+    params: dict
+      PARAMETERS to replace, e.g. {'NCHAN': 64}
+    values: dict
+      evaluated values to replace, by tag, e.g. {'COMMON': {'CHAN_BW': 312500.0}}
+    """
+
+    cfg = copy.copy(self)
+    cfg.params = dict(self.params)
+    cfg.params.update(params or {})
+    cfg._tags = {'PARAMETERS': cfg.params}
+
+    cfg._overrides = dict((tagname, dict(vals)) for (tagname, vals) in self._overrides.items())
+    for tagname, vals in (values or {}).items():
+      cfg._overrides.setdefault(tagname, {}).update(vals)
+
+    return cfg
+
+  def _evaluate(self, tagname):
+    """ Finds tagname and returns a dictionary of its evaluated children """
+    element = self.root.find(tagname)
+    if element is None:
+      raise KeyError('No <%s> tag in config file %s'%(tagname, self.filename))
+
+    vals = {}
+    for child in element.getchildren():
+      try:
+        vals[child.tag] = evalExpr(child.text, self.params)
+      except (SyntaxError, ValueError, NameError, KeyError) as e:
+        raise ValueError('Cannot evaluate <%s> in <%s>, %s: %s'%(child.tag, tagname, self.filename, e))
+    
+    vals.update(self._overrides.get(tagname, {}))
+    return vals
+
+_config_cache = {}
+
+# Defaults for PARAMETERS that a config file may leave out
+_default_params = {'NCOMPLEX': 2, 'NWEIGHT': 2}
+
+def _file_stamp(filename):
+  """ Modification time and size of a file, used to tell if it has changed """
+  stat = os.stat(filename)
+  return (stat.st_mtime, stat.st_size)
+
+def getConfig(config='config.xml'):
+  """ Returns the parsed Config for an XML config file.
+
+  Parsed files are cached by path, and are re-parsed if the file has been
+  modified since it was last read.
+
+  Parameters
+  ----------
+  config: string or Config
+    filename of xml configuration file, defaults to 'config,xml'.
+    If a Config is passed, it is returned unchanged.
+  """
+
+  if isinstance(config, Config):
+    return config
+
+  filename = os.path.abspath(config)
+  cfg = _config_cache.get(filename)
+  if cfg is None or cfg.stamp != _file_stamp(filename):
+    cfg = Config(filename)
+    _config_cache[filename] = cfg
+
+  return cfg
+
+def parseConfig(tagname, config='config.xml'):
+  """ Finds tagname, in elementTree x, parses and returns dictionary of values
+  This is a helper function, and is not usually called directly.
+
+  Notes
+  -----
+  The config file is only parsed once, and then cached; see getConfig().
+  """
+
+  return dict(getConfig(config)[tagname])
+
+# Table schemas
+# -------------
+# Each table is a list of columns, as (name, FITS format code, repeat, unit).
+# The repeat count is either a number, or a product of PARAMETERS from the
+# config file and numbers, e.g. 'NCHAN*NSTOKES*NBAND*2'. Columns with a
+# repeat count of 0 are left out of the table.
+table_schemas = {
+
+  'ARRAY_GEOMETRY': [
+    ('ANNAME',    'A', 8,       None),
+    ('STABXYZ',   'D', 3,       'METERS'),
+    ('DERXYZ',    'E', 3,       'METERS/SEC'),
+    ('ORBPARM',   'D', 'NORB',  None),
+    ('NOSTA',     'J', 1,       None),
+    ('MNTSTA',    'J', 1,       None),
+    ('STAXOF',    'E', 3,       'METERS'),
+    ('DIAMETER',  'E', 1,       'METERS'),
+  ],
+
+  'ANTENNA': [
+    ('TIME',          'D', 1,       'DAYS'),
+    ('TIME_INTERVAL', 'E', 1,       'DAYS'),
+    ('ANNAME',        'A', 8,       None),
+    ('ANTENNA_NO',    'J', 1,       None),
+    ('ARRAY',         'J', 1,       None),
+    ('FREQID',        'J', 1,       None),
+    ('NO_LEVELS',     'J', 1,       None),
+    ('POLTYA',        'A', 1,       None),
+    ('POLTYB',        'A', 1,       None),
+    ('POLAA',         'E', 'NBAND', 'DEGREES'),
+    ('POLAB',         'E', 'NBAND', 'DEGREES'),
+    # nb: Was encontering errors with CASA with these columns
+    #('POLCALA',      'E', 1,       None),
+    #('POLCALB',      'E', 1,       None),
+  ],
+
+  'FREQUENCY': [
+    ('FREQID',          'J', 1,       None),
+    ('BANDFREQ',        'D', 'NBAND', 'HZ'),
+    ('CH_WIDTH',        'E', 'NBAND', 'HZ'),
+    ('TOTAL_BANDWIDTH', 'E', 1,       'HZ'),
+    ('SIDEBAND',        'J', 'NBAND', None),
+    # Not really sure what this does, so commented it out
+    #('BB_CHAN',        'J', 1,       None),
+  ],
+
+  'SOURCE': [
+    ('SOURCE_ID', 'J', 1,       None),
+    ('SOURCE',    'A', 16,      None),
+    ('QUAL',      'J', 1,       None),
+    ('CALCODE',   'A', 4,       None),
+    ('FREQID',    'J', 1,       None),
+    ('IFLUX',     'E', 'NBAND', None),
+    ('QFLUX',     'E', 'NBAND', None),
+    ('UFLUX',     'E', 'NBAND', None),
+    ('VFLUX',     'E', 'NBAND', None),
+    ('ALPHA',     'E', 'NBAND', None),
+    ('FREQOFF',   'E', 'NBAND', None),
+    ('RAEPO',     'D', 1,       'DEGREES'),
+    ('DECEPO',    'D', 1,       'DEGREES'),
+    ('EQUINOX',   'A', 8,       None),
+    ('RAAPP',     'D', 1,       'DEGREES'),
+    ('DECAPP',    'D', 1,       'DEGREES'),
+    ('SYSVEL',    'D', 'NBAND', 'METERS/SEC'),
+    ('VELTYP',    'A', 8,       None),
+    ('VELDEF',    'A', 8,       None),
+    ('RESTFREQ',  'D', 'NBAND', 'HZ'),
+    ('PMRA',      'D', 1,       'DEGREES/DAY'),
+    ('PMDEC',     'D', 1,       'DEGREES/DAY'),
+    ('PARALLAX',  'E', 1,       'ARCSEC'),
+  ],
+
+  'UV_DATA': [
+    ('UU',        'E', 1, 'SECONDS'),
+    ('VV',        'E', 1, 'SECONDS'),
+    ('WW',        'E', 1, 'SECONDS'),
+    ('DATE',      'D', 1, 'DAYS'),
+    ('TIME',      'D', 1, 'DAYS'),
+    ('BASELINE',  'J', 1, None),
+    ('SOURCE',    'J', 1, None),
+    ('FREQID',    'J', 1, None),
+    ('INTTIM',    'E', 1, 'SECONDS'),
+    # The following depends on number of stokes, number of bands and number of channels.
+    # NWEIGHT 0 drops the WEIGHT column, for weights inside FLUX (NCOMPLEX 3)
+    ('WEIGHT',    'E', 'NCHAN*NSTOKES*NBAND*NWEIGHT', None),
+    ('FLUX',      'E', 'NCHAN*NSTOKES*NBAND*NCOMPLEX', 'UNCALIB'),  # 2= Real & Im, 3= Real, Im & Weight
+  ],
+
+  'INTERFEROMETER_MODEL': [
+    ('TIME',          'D', 1, 'DAYS'),
+    ('TIME_INTERVAL', 'E', 1, 'DAYS'),
+    ('SOURCE_ID',     'J', 1, None),
+    ('ANTENNA_NO',    'J', 1, None),
+    ('ARRAY',         'J', 1, None),
+    ('FREQID',        'J', 1, None),
+    ('I.FAR.ROT',     'E', 1, 'RAD/M**2'),
+    ('FREQ.VAR',      'E', 1, 'HZ'),
+    ('PDELAY_1',      'E', 1, 'TURNS'),
+    ('GDELAY_1',      'E', 1, 'SECONDS'),
+    ('PRATE_1',       'E', 1, 'HZ'),
+    ('GRATE_1',       'E', 1, 'SEC/SEC'),
+    ('DISP_1',        'E', 1, 'SECONDS'),
+    ('DDISP_1',       'E', 1, 'SEC/SEC'),
+  ],
+
+  'SYSTEM_TEMPERATURE': [
+    ('TIME',          'D', 1, 'DAYS'),
+    ('TIME_INTERVAL', 'E', 1, 'DAYS'),
+    ('SOURCE_ID',     'J', 1, None),
+    ('ANTENNA_NO',    'J', 1, None),
+    ('ARRAY',         'J', 1, None),
+    ('FREQID',        'J', 1, None),
+    ('TSYS_1',        'E', 1, 'KELVIN'),
+    ('TANT_1',        'E', 1, 'KELVIN'),
+  ],
+
+  'GAIN_CURVE': [
+    ('ANTENNA_NO',  'J', 1, None),
+    ('ARRAY',       'J', 1, None),
+    ('FREQID',      'J', 1, None),
+    ('TYPE_1',      'J', 1, None),
+    ('NTERM_1',     'J', 1, None),
+    ('X_TYP_1',     'J', 1, None),
+    ('Y_TYP_1',     'J', 1, None),
+    ('X_VAL_1',     'J', 1, None),
+    ('Y_VAL_1',     'J', 1, None),
+    ('GAIN_1',      'E', 1, None),
+    ('SENS_1',      'E', 1, 'K/JY'),
+  ],
+
+  'PHASE_CAL': [
+    ('TIME',          'D', 1, 'DAYS'),
+    ('TIME_INTERVAL', 'E', 1, 'DAYS'),
+    ('SOURCE_ID',     'J', 1, None),
+    ('ANTENNA_NO',    'J', 1, None),
+    ('ARRAY',         'J', 1, None),
+    ('FREQID',        'J', 1, None),
+    ('CABLE_CAL',     'E', 1, 'SECONDS'),
+    ('STATE_1',       'J', 1, 'PERCENT'),
+    ('PC_FREQ_1',     'J', 1, 'HZ'),
+    ('PC_REAL_1',     'J', 1, None),
+    ('PC_IMAG_1',     'J', 1, None),
+    ('PC_RATE_1',     'J', 1, 'SEC/SEC'),
+  ],
+
+  'FLAG': [
+    ('SOURCE_ID', 'J', 1,  None),
+    ('ARRAY',     'J', 1,  None),
+    ('ANTS',      'J', 2,  None),
+    ('FREQID',    'J', 1,  None),
+    ('TIMERANG',  'E', 2,  'DAYS'),
+    ('BANDS',     'J', 1,  None),
+    ('CHANS',     'J', 2,  None),
+    ('PFLAGS',    'J', 4,  None),
+    ('REASON',    'A', 24, None),
+    ('SEVERITY',  'J', 1,  None),
+  ],
+
+  'BANDPASS': [
+    ('TIME',          'D', 1,    'DAYS'),
+    ('TIME_INTERVAL', 'E', 1,    'DAYS'),
+    ('SOURCE_ID',     'J', 1,    None),
+    ('ANTENNA_NO',    'J', 1,    None),
+    ('ARRAY',         'J', 1,    None),
+    ('FREQID',        'J', 1,    None),
+    ('BANDWIDTH',     'E', 1,    'HZ'),
+    ('BAND_FREQ',     'D', 1,    'HZ'),
+    ('REFANT_1',      'J', 1,    None),
+    ('BREAL_1',       'E', 1024, None),
+    ('BIMAG_1',       'E', 1024, None),
+  ],
+}
+
+# numpy dtypes for FITS binary table format codes
+_fits_dtypes = {'L': 'bool', 'B': 'uint8', 'I': 'int16', 'J': 'int32', 'K': 'int64',
+                'E': 'float32', 'D': 'float64'}
+
+def _repeat(repeat, params):
+  """ Evaluates a column repeat count, e.g. 3 or 'NCHAN*NSTOKES*NBAND*2' """
+  if isinstance(repeat, int):
+    return repeat
+
+  count = 1
+  for factor in repeat.split('*'):
+    factor = factor.strip()
+    count *= int(factor) if factor.isdigit() else params[factor]
+  return count
+
+def table_columns(tablename, config='config.xml'):
+  """ Returns the columns of a table, as a list of (name, FITS format, numpy dtype, unit)
+
+  Parameters
+  ----------
+  tablename: string
+    name of table in table_schemas, e.g. 'UV_DATA'
+  config: string or Config
+    filename of xml configuration file, defaults to 'config,xml'
+  """
+
+  params = getConfig(config)['PARAMETERS']
+
+  columns = []
+  for (name, code, repeat, unit) in table_schemas[tablename]:
+    repeat = _repeat(repeat, params)
+    if repeat == 0:
+      continue
+    elif code == 'A':
+      dtype = 'a%i'%repeat
+    elif repeat == 1:
+      dtype = _fits_dtypes[code]
+    else:
+      dtype = (_fits_dtypes[code], (repeat,))
+    columns.append((name, '%i%s'%(repeat, code), dtype, unit))
+
+  return columns
+
+def make_table(tablename, config='config.xml', num_rows=1, zero=True, common_first=False):
+  """ Creates a vanilla table HDU from its schema in table_schemas.
+
+  The rows are allocated as a single record array, which the HDU uses
+  directly rather than copying. Header values come from the tablename and
+  COMMON tags of the config file, in that order, so COMMON values override
+  table ones (e.g. TABREV). With common_first, as for UV_DATA, the COMMON
+  values come first instead, both sets sorted by keyword, and table values
+  override them.
+
+  Parameters
+  ----------
+  tablename: string
+    name of table in table_schemas, e.g. 'UV_DATA'
+  config: string or Config
+    filename of xml configuration file, defaults to 'config,xml'
+  num_rows: int
+    number of rows to generate. Rows will be filled with numpy zeros.
+  zero: bool
+    if False, the rows are left uninitialised rather than zero filled. Use
+    this for big tables where every value is about to be overwritten anyway.
+  common_first: bool
+    write the COMMON header values first, and let the table's own override them
+  """
+
+  # Generate headers from config file
+  cfg    = getConfig(config)
+  cards  = cfg[tablename]
+  common = cfg['COMMON']
+
+  columns = table_columns(tablename, cfg)
+  dtype = [(name, dtype) for (name, format, dtype, unit) in columns]
+  if zero:
+    data = np.rec.array(np.zeros(num_rows, dtype=dtype))
+  else:
+    data = np.rec.array(np.empty(num_rows, dtype=dtype))
+
+  # Column definitions share their arrays with the record array
+  c = []
+  for (name, format, dtype, unit) in columns:
+    c.append(pf.Column(name=name, format=format, unit=unit, array=data.field(name)))
+
+  data = data.view(pf.FITS_rec)
+  data._coldefs = pf.ColDefs(c)
+  tblhdu = pf.BinTableHDU(data)
+
+  if common_first:
+    for key in sorted(common): tblhdu.header.update(key, common[key])
+    for key in sorted(cards): tblhdu.header.update(key, cards[key])
+  else:
+    for key in cards: tblhdu.header.update(key, cards[key])
+    for key in common: tblhdu.header.update(key, common[key])
+
+  return tblhdu
+
+def fill_columns(tbl, columns):
+  """ Fills whole columns of a table HDU, one assignment per column.
+
+  Parameters
+  ----------
+  tbl: pyfits.hdu
+    table to be filled, e.g. from make_table()
+  columns: dict
+    values to fill, by column name. Each value is broadcast to the column,
+    so it can be a single value for every row, or an array with one entry
+    (or one array of entries, for vector columns) for each row.
+  """
+
+  fill_rows(tbl.data, columns)
+
+  return tbl
+
+def fill_rows(rows, columns):
+  """ Fills whole columns of a record array of rows, e.g. from TableWriter.new_rows(). See fill_columns(). """
+
+  for name in columns:
+    rows.field(name)[:] = columns[name]
+
+  return rows
+
+def batchRecords(records, dtype, chunk_size=65536):
+  """ Groups an iterable of records into record arrays of up to chunk_size records.
+
+  Each record is a tuple of values, one for each field of dtype. A chunk of
+  tuples is converted to a record array in one go, so there is no per-record
+  work beyond pulling the records from the iterable.
+
+  Parameters
+  ----------
+  records: iterable
+    records as tuples, e.g. (time, antenna, tsys, tant)
+  dtype: numpy.dtype or list
+    fields of the records, e.g. [('time', 'f8'), ('antenna', 'i4'), ...]
+  chunk_size: int
+    number of records in each chunk
+  """
+
+  records = iter(records)
+  while True:
+    chunk = list(itertools.islice(records, chunk_size))
+    if not chunk:
+      return
+    yield np.rec.array(chunk, dtype=dtype)
 
 def make_primary(config='config.xml'):
   """  Creates the primary header data unit (HDU). 
@@ -84,9 +627,10 @@ def make_primary(config='config.xml'):
   hdu = pf.PrimaryHDU()
   
   # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  primary = parseConfig('PRIMARY', config)
-  common  = parseConfig('COMMON', config)
+  cfg    = getConfig(config)
+  params = cfg['PARAMETERS']
+  primary = cfg['PRIMARY']
+  common  = cfg['COMMON']
   
 
   for key in primary: hdu.header.update(key, primary[key])
@@ -122,50 +666,8 @@ def make_array_geometry(config='config.xml', num_rows=1):
     number of rows to generate. Rows will be filled with numpy zeros.
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  array_geometry = parseConfig('ARRAY_GEOMETRY', config)
-  common  = parseConfig('COMMON', config)
-  
-  # Generate the columns for the table header
-  c = []
-
-  c.append(pf.Column(name='ANNAME',  format='8A',\
-    array=np.zeros(num_rows,dtype='a8')))   
-  
-  c.append(pf.Column(name='STABXYZ', format='3D', \
-    unit='METERS',array=np.zeros(num_rows,dtype='3float64')))
-  
-  c.append(pf.Column(name='DERXYZ',  format='3E', \
-    unit='METERS/SEC', array=np.zeros(num_rows,dtype='3float32')))
-  
-  orb_format = '%iD'%params['NORB']
-  orb_dtype  = '%ifloat64'%params['NORB']
-  c.append(pf.Column(name='ORBPARM', format=orb_format,\
-    array=np.zeros(num_rows,dtype=orb_dtype)))
-  
-  c.append(pf.Column(name='NOSTA',   format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='MNTSTA',  format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='STAXOF',  format='3E', \
-    unit='METERS', array=np.zeros(num_rows,dtype='3float32')))
-
-  c.append(pf.Column(name='DIAMETER',  format='1E', \
-    unit='METERS', array=np.zeros(num_rows,dtype='float32')))
-
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-
-
+  return make_table('ARRAY_GEOMETRY', config, num_rows)
 
-  for key in array_geometry: tblhdu.header.update(key, array_geometry[key])
-  for key in common: tblhdu.header.update(key, common[key])
-  
-  return tblhdu
-    
 def make_antenna(config='config.xml', num_rows=1):
   """  Creates a vanilla ANTENNA table HDU
   
@@ -197,67 +699,7 @@ def make_antenna(config='config.xml', num_rows=1):
     number of rows to generate. Rows will be filled with numpy zeros.
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards  = parseConfig('ANTENNA', config)
-  common = parseConfig('COMMON', config)
-
-  nband = params['NBAND']
-  npcal = params['NPCAL']
-  
-  
-  c = []
-  
-  c.append(pf.Column(name='TIME', format='1D',\
-   unit='DAYS',array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='TIME_INTERVAL', format='1E',\
-    unit='DAYS', array=np.zeros(num_rows,dtype='float32')))
-  
-  c.append(pf.Column(name='ANNAME', format='8A',\
-    array=np.zeros(num_rows,dtype='a8')))
-  
-  c.append(pf.Column(name='ANTENNA_NO', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='ARRAY', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='FREQID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='NO_LEVELS',  format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='POLTYA', format='1A',\
-    array=np.zeros(num_rows,dtype='a1')))
-
-  c.append(pf.Column(name='POLTYB', format='1A',\
-    array=np.zeros(num_rows,dtype='a1')))
-      
-  pol_format = '%iE'%nband
-  pol_dtype  = '%ifloat32'%nband
-  c.append(pf.Column(name='POLAA', format=pol_format,\
-    unit='DEGREES', array=np.zeros(num_rows,dtype=pol_dtype)))
-  
-  c.append(pf.Column(name='POLAB', format=pol_format,\
-    unit='DEGREES', array=np.zeros(num_rows,dtype=pol_dtype)))
-
-  # nb: Was encontering errors with CASA with this column
-  #c.append(pf.Column(name='POLCALA', format='1E',\
-  #  array=np.zeros(32,dtype='float32')))
-  
-  # nb: Was encontering errors with CASA with this column  
-  #c.append(pf.Column(name='POLCALB', format='1E',\
-  #  array=np.zeros(32,dtype='float32')))
-  
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-  
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-
-  return tblhdu
+  return make_table('ANTENNA', config, num_rows)
 
 def make_frequency(config='config.xml', num_rows=1):
   """ Creates a vanilla FREQUENCY table HDU
@@ -281,48 +723,7 @@ def make_frequency(config='config.xml', num_rows=1):
     number of rows to generate. Rows will be filled with numpy zeros.
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards = parseConfig('FREQUENCY', config)
-  common  = parseConfig('COMMON', config)
-  
-  nband = params['NBAND']
-
-  c = []
-  
-  c.append(pf.Column(name='FREQID',   format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-
-  ba_format = '%iD'%nband
-  ba_dtype  = '%ifloat64'%nband    
-  c.append(pf.Column(name='BANDFREQ', format=ba_format,\
-    unit='HZ', array=np.zeros(num_rows,dtype=ba_dtype)))
-  
-  ch_format = '%iE'%nband
-  ch_dtype  = '%ifloat32'%nband
-  c.append(pf.Column(name='CH_WIDTH', format=ch_format,\
-    unit='HZ', array=np.zeros(num_rows,dtype=ch_dtype)))
-
-  c.append(pf.Column(name='TOTAL_BANDWIDTH', format='1E',\
-    unit='HZ', array=np.zeros(num_rows,dtype='float32')))
-  
-  si_format = '%iJ'%nband
-  si_dtype  = '%iint32'%nband
-  c.append(pf.Column(name='SIDEBAND', format=si_format,\
-    array=np.zeros(num_rows,dtype=si_dtype)))
-  
-  # Not really sure what this does, so commented it out
-  #c.append(pf.Column(name='BB_CHAN',  format='1J',\
-  #  array=np.zeros(num_rows,dtype='int32')))
-  
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-  
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-  
-  return tblhdu
-  
+  return make_table('FREQUENCY', config, num_rows)
 
 def make_source(config='config.xml', num_rows=1):
   """ Creates a vanilla SOURCE table HDU
@@ -363,108 +764,11 @@ num_rows: int
   number of rows to generate. Rows will be filled with numpy zeros.
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards  = parseConfig('SOURCE', config)
-  common = parseConfig('COMMON', config)
-  
-  nband = params['NBAND']
-  so_format = '%iE'%nband
-  so_dtype  = '%ifloat32'%nband
-
-  c=[]
-
-  c.append(pf.Column(name='SOURCE_ID',    format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='SOURCE',   format='16A',\
-    array=np.zeros(num_rows,dtype='16a')))
-    
-  c.append(pf.Column(name='QUAL',     format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='CALCODE',  format='4A',\
-    array=np.zeros(num_rows,dtype='4a')))
-    
-  c.append(pf.Column(name='FREQID',   format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='IFLUX',    format=so_format,\
-    array=np.zeros(num_rows,dtype=so_dtype)))
-  
-  c.append(pf.Column(name='QFLUX',    format=so_format,\
-    array=np.zeros(num_rows,dtype=so_dtype)))
-  
-  c.append(pf.Column(name='UFLUX',    format=so_format,\
-    array=np.zeros(num_rows,dtype=so_dtype)))
-  
-  c.append(pf.Column(name='VFLUX',    format=so_format,\
-    array=np.zeros(num_rows,dtype=so_dtype)))
-  
-  c.append(pf.Column(name='ALPHA',    format=so_format,\
-    array=np.zeros(num_rows,dtype=so_dtype)))
-  
-  c.append(pf.Column(name='FREQOFF',  format=so_format,
-    array=np.zeros(num_rows,dtype=so_dtype)))
-  
-  c.append(pf.Column(name='RAEPO',    format='1D',\
-   unit='DEGREES', array=np.zeros(num_rows,dtype='float64')))
-  
-  c.append(pf.Column(name='DECEPO',    format='1D',\
-   unit='DEGREES', array=np.zeros(num_rows, dtype='float64')))
-  
-  c.append(pf.Column(name='EQUINOX',    format='8A',\
-    array=np.zeros(num_rows,dtype='8a')))
-    
-  c.append(pf.Column(name='RAAPP',    format='1D',\
-   unit='DEGREES', array=np.zeros(num_rows,dtype='float64')))
-   
-  c.append(pf.Column(name='DECAPP',   format='1D',\
-   unit='DEGREES', array=np.zeros(num_rows,dtype='float64')))
-  
-  sv_format = '%iD'%nband
-  sv_dtype  = '%ifloat64'%nband
-  c.append(pf.Column(name='SYSVEL',   format=sv_format,\
-    unit='METERS/SEC', array=np.zeros(num_rows,dtype=sv_dtype)))
-  
-  c.append(pf.Column(name='VELTYP',   format='8A',\
-    array=np.zeros(num_rows,dtype='8a')))
-  
-  c.append(pf.Column(name='VELDEF',   format='8A',\
-    array=np.zeros(num_rows,dtype='8a')))
-
-  rf_format = '%iD'%nband
-  rf_dtype  = '%ifloat64'%nband
-  c.append(pf.Column(name='RESTFREQ', format=rf_format,\
-   unit='HZ', array=np.zeros(num_rows,dtype=rf_dtype)))
-  
-  c.append(pf.Column(name='PMRA',     format='1D',\
-   unit='DEGREES/DAY', array=np.zeros(num_rows,dtype='float64')))
-  
-  c.append(pf.Column(name='PMDEC',    format='1D',\
-   unit='DEGREES/DAY', array=np.zeros(num_rows,dtype='float64')))
-  
-  c.append(pf.Column(name='PARALLAX', format='1E',\
-   unit='ARCSEC', array=np.zeros(num_rows,dtype='float32')))
-
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-
+  return make_table('SOURCE', config, num_rows)
 
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-      
-  return tblhdu
-
-def make_uv_data(config='config.xml', num_rows=1):
+def make_uv_data(config='config.xml', num_rows=1, zero=True):
   """ Creates a vanilla UV_DATA table HDU
   
-  Parameters
-  ----------
-  num_rows
-    Number of rows in your UV dataset. For example, if you have 528 baselines 
-    (inc. autocorr), then for 10 time dumps, you'll need 10*528 rows
-  
   Notes
   -----
   Table is built with the following columns:
@@ -483,73 +787,37 @@ def make_uv_data(config='config.xml', num_rows=1):
   * GATEID       VLBA gate ID
   * FLUX         UV visibility data matrix
   
+  The size of the weights is set by two PARAMETERS in the config file.
+  NCOMPLEX is the length of the FLUX complex axis (MAXIS1): 2 for (real,
+  imag), or 3 for (real, imag, weight). NWEIGHT is the number of WEIGHT
+  values for each channel, stokes and band: 2 (the default), 1, or 0 to
+  leave the WEIGHT column out. NCOMPLEX 3 with NWEIGHT 0 makes the rows
+  about three quarters of the size of the default: FLUX grows by half, but
+  the WEIGHT column, as big as the default FLUX, goes.
+  
   Parameters
   ----------
   config: string
     filename of xml configuration file, defaults to 'config,xml'
   num_rows: int
-    number of rows to generate. Rows will be filled with numpy zeros.
+    number of rows to generate. Rows will be filled with numpy zeros. For
+    example, with 528 baselines (inc. autocorr), 10 time dumps need 10*528 rows.
+  zero: bool
+    if False, the rows are left uninitialised. Every column must then be
+    filled before the table is written.
     
   """
-  c = []                
-  
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards  = parseConfig('UV_DATA', config)
-  common = parseConfig('COMMON', config)
-
-
-                                          
-  c.append(pf.Column(name='UU', format='1E',\
-    unit='SECONDS', array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='VV',  format='1E',\
-    unit='SECONDS', array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='WW',  format='1E',\
-    unit='SECONDS', array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='DATE', format='1D',\
-    unit='DAYS', array=np.zeros(num_rows,dtype='float64')))
-   
-  c.append(pf.Column(name='TIME', format='1D',\
-    unit='DAYS', array=np.zeros(num_rows,dtype='float64')))
-   
-  c.append(pf.Column(name='BASELINE', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
 
-  c.append(pf.Column(name='SOURCE',  format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='FREQID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='INTTIM', format='1E',\
-    unit='SECONDS', array=np.zeros(num_rows,dtype='float32')))
-  
-  # The following depends on number of stokes, number of bands and number of channels
-  nchan   = params['NCHAN']
-  nstokes = params['NSTOKES']
-  nband   = params['NBAND']
+  tbl = make_table('UV_DATA', config, num_rows, zero, common_first=True)
   
-  nbits = nchan * nstokes * nband * 2 # 2= Real & Im
-  format = '%iE'%nbits
-  dtype  = '%ifloat32'%nbits
+  # TMATXn marks the FLUX column, which moves if WEIGHT is left out
+  flux_col = tbl.columns.names.index('FLUX') + 1
+  if 'TMATX%i'%flux_col not in tbl.header:
+    for key in [card.key for card in tbl.header.ascardlist() if card.key.startswith('TMATX')]:
+      del tbl.header[key]
+    tbl.header.update('TMATX%i'%flux_col, True)
   
-  c.append(pf.Column(name='WEIGHT', format=format,\
-    array=np.zeros(num_rows,dtype=dtype)))
-    
-  c.append(pf.Column(name='FLUX', format=format,\
-    unit='UNCALIB', array=np.zeros(num_rows,dtype=dtype)))  
-  
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-
-  for key in sorted(common): tblhdu.header.update(key, common[key])
-  for key in sorted(cards): tblhdu.header.update(key, cards[key])
-
-        
-  return tblhdu
+  return tbl
 
 def make_interferometer_model(config='config.xml', num_rows=1):
   """
@@ -586,63 +854,8 @@ def make_interferometer_model(config='config.xml', num_rows=1):
     
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards = parseConfig('INTERFEROMETER_MODEL', config)
-  common  = parseConfig('COMMON', config)
-  
-  c = []
-                                        
-  c.append(pf.Column(name='TIME', format='1D',\
-   unit='DAYS', array=np.zeros(num_rows,dtype='float64')))
-   
-  c.append(pf.Column(name='TIME_INTERVAL',format='1E',\
-   unit='DAYS', array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='SOURCE_ID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='ANTENNA_NO', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='ARRAY', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='FREQID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='I.FAR.ROT',    format='1E',\
-    unit='RAD/M**2', array=np.zeros(num_rows,dtype='float32')))
-    
-  c.append(pf.Column(name='FREQ.VAR',     format='1E',\
-    unit='HZ', array=np.zeros(num_rows,dtype='float32')))
-    
-  c.append(pf.Column(name='PDELAY_1',     format='1E',\
-   unit='TURNS', array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='GDELAY_1',     format='1E',\
-   unit='SECONDS',array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='PRATE_1', format='1E',\
-   unit='HZ', array=np.zeros(num_rows,dtype='float32')))
-  
-  c.append(pf.Column(name='GRATE_1', format='1E',\
-   unit='SEC/SEC', array=np.zeros(num_rows,dtype='float32')))
-  
-  c.append(pf.Column(name='DISP_1', format='1E',\
-   unit='SECONDS', array=np.zeros(num_rows,dtype='float32')))
-  
-  c.append(pf.Column(name='DDISP_1', format='1E',\
-   unit='SEC/SEC', array=np.zeros(num_rows,dtype='float32')))
-
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
+  return make_table('INTERFEROMETER_MODEL', config, num_rows)
 
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-       
-  return tblhdu      
-                                    
 def make_system_temperature(config='config.xml', num_rows=1):
   """ Creates a vanilla SYSTEM_TEMPERATURE table HDU
   
@@ -670,44 +883,7 @@ def make_system_temperature(config='config.xml', num_rows=1):
     number of rows to generate. Rows will be filled with numpy zeros.
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards = parseConfig('SYSTEM_TEMPERATURE', config)
-  common  = parseConfig('COMMON', config)
-
-  c = []
-  
-  c.append(pf.Column(name='TIME',  format='1D',\
-   unit='DAYS', array=np.zeros(num_rows,dtype='float64')))
-   
-  c.append(pf.Column(name='TIME_INTERVAL',  format='1E',\
-   unit='DAYS', array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='SOURCE_ID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='ANTENNA_NO', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='ARRAY', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='FREQID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='TSYS_1', format='1E',\
-   unit='KELVIN', array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='TANT_1', format='1E',\
-   unit='KELVIN', array=np.zeros(num_rows,dtype='int32')))
-
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-  
-  return tblhdu   
+  return make_table('SYSTEM_TEMPERATURE', config, num_rows)
 
 def make_gain_curve(config='config.xml', num_rows=1):
   """ Creates a vanilla GAIN_CURVE table HDU
@@ -740,53 +916,7 @@ def make_gain_curve(config='config.xml', num_rows=1):
     
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards = parseConfig('GAIN_CURVE', config)
-  common  = parseConfig('COMMON', config)
-
-  c = []
-  
-  c.append(pf.Column(name='ANTENNA_NO', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='ARRAY', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='FREQID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='TYPE_1', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='NTERM_1', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='X_TYP_1', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='Y_TYP_1', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='X_VAL_1', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='Y_VAL_1', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='GAIN_1', format='1E',\
-    array=np.zeros(num_rows,dtype='float32')))
-  
-  c.append(pf.Column(name='SENS_1', format='1E',\
-   unit='K/JY', array=np.zeros(num_rows,dtype='float32')))
-  
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-
-  return tblhdu
+  return make_table('GAIN_CURVE', config, num_rows)
 
 def make_phase_cal(config='config.xml', num_rows=1):
   """ Creates a vanilla PHASE-CAL table HDU
@@ -819,61 +949,12 @@ def make_phase_cal(config='config.xml', num_rows=1):
     number of rows to generate. Rows will be filled with numpy zeros.
     
   """
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards = parseConfig('PHASE_CAL', config)
-  common  = parseConfig('COMMON', config)
-  
-  c = []
-                                        
-  c.append(pf.Column(name='TIME', format='1D',\
-    array=np.zeros(num_rows,dtype='float64'), unit='DAYS'))
-    
-  c.append(pf.Column(name='TIME_INTERVAL', format='1E',\
-   unit='DAYS', array=np.zeros(num_rows,dtype='float32')))
-
-  c.append(pf.Column(name='SOURCE_ID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-
-  c.append(pf.Column(name='ANTENNA_NO', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
 
-  c.append(pf.Column(name='ARRAY', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
+  return make_table('PHASE_CAL', config, num_rows)
 
-  c.append(pf.Column(name='FREQID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-
-  c.append(pf.Column(name='CABLE_CAL', format='1E',\
-   unit='SECONDS', array=np.zeros(num_rows,dtype='float32')))
-
-  c.append(pf.Column(name='STATE_1', format='1J',\
-   unit='PERCENT', array=np.zeros(num_rows,dtype='int32')))
-
-  c.append(pf.Column(name='PC_FREQ_1', format='1J',\
-   unit='HZ', array=np.zeros(num_rows,dtype='int32')))
-
-  c.append(pf.Column(name='PC_REAL_1', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-
-  c.append(pf.Column(name='PC_IMAG_1', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-
-  c.append(pf.Column(name='PC_RATE_1', format='1J',\
-   unit='SEC/SEC', array=np.zeros(num_rows,dtype='int32')))
-
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-
-
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-    
-  return tblhdu
-
-def make_flag(config='config.xml', num_rows=1):
-  """ Creates a vanilla FLAG table HDU
-  
+def make_flag(config='config.xml', num_rows=1):
+  """ Creates a vanilla FLAG table HDU
+  
 
   Notes
   ----------
@@ -900,51 +981,7 @@ def make_flag(config='config.xml', num_rows=1):
     number of rows to generate. Rows will be filled with numpy zeros.
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards = parseConfig('FLAG', config)
-  common  = parseConfig('COMMON', config)
-
-  c = []
-    
-  c.append(pf.Column(name='SOURCE_ID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='ARRAY', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='ANTS', format='2J',\
-    array=np.zeros(num_rows,dtype='2int32')))
-  
-  c.append(pf.Column(name='FREQID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='TIMERANG', format='2E',\
-    unit='DAYS', array=np.zeros(num_rows,dtype='2float32')))
-  
-  c.append(pf.Column(name='BANDS', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-  
-  c.append(pf.Column(name='CHANS', format='2J',\
-    array=np.zeros(num_rows,dtype='2int32')))
-  
-  c.append(pf.Column(name='PFLAGS', format='4J',\
-    array=np.zeros(num_rows,dtype='4int32')))
-  
-  c.append(pf.Column(name='REASON', format='24A',\
-    array=np.zeros(num_rows,dtype='a24')))
-  
-  c.append(pf.Column(name='SEVERITY', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-  
-
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-    
-  return tblhdu
+  return make_table('FLAG', config, num_rows)
 
 def make_bandpass(config='config.xml', num_rows=1):
   """ Creates a vanilla BANDPASS table HDU
@@ -973,55 +1010,7 @@ def make_bandpass(config='config.xml', num_rows=1):
     number of rows to generate. Rows will be filled with numpy zeros.
   """
 
-  # Generate headers from config file
-  params = parseConfig('PARAMETERS', config)
-  cards = parseConfig('BANDPASS', config)
-  common  = parseConfig('COMMON', config)
-
-
-  c = []
-  
-  c.append(pf.Column(name='TIME', format='1D',\
-   unit='DAYS', array=np.zeros(num_rows,dtype='float64')))
-   
-  c.append(pf.Column(name='TIME_INTERVAL', format='1E',\
-   unit='DAYS',array=np.zeros(num_rows,dtype='float32')))
-   
-  c.append(pf.Column(name='SOURCE_ID', format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='ANTENNA_NO',format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='ARRAY',     format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='FREQID',    format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='BANDWIDTH', format='1E',\
-    unit='HZ', array=np.zeros(num_rows,dtype='float32')))
-    
-  c.append(pf.Column(name='BAND_FREQ', format='1D',\
-   unit='HZ', array=np.zeros(num_rows,dtype='float64')))
-   
-  c.append(pf.Column(name='REFANT_1',  format='1J',\
-    array=np.zeros(num_rows,dtype='int32')))
-    
-  c.append(pf.Column(name='BREAL_1',  format='1024E',\
-    array=np.zeros(num_rows,dtype='1024float32')))
-    
-  c.append(pf.Column(name='BIMAG_1',  format='1024E',\
-    array=np.zeros(num_rows,dtype='1024float32')))
-  
-  coldefs = pf.ColDefs(c)
-  tblhdu = pf.new_table(coldefs)
-  
-
-  for key in cards: tblhdu.header.update(key, cards[key])
-  for key in common: tblhdu.header.update(key, common[key])
-    
-  return tblhdu  
+  return make_table('BANDPASS', config, num_rows)
 
 def make_weather():
   """ Makes weather table
@@ -1064,4 +1053,1258 @@ def make_model_comps():
   
   Again, this table is currently not supported (on the todo list)
   """
-  pass
\ No newline at end of file
+  pass
+
+class UVDataWriter(object):
+  """ Streams UV_DATA rows to a FITS IDI file, chunk by chunk.
+  
+  The primary HDU and the other (small) tables are written up front, followed
+  by the UV_DATA header with NAXIS2 = 0. Rows are then appended to the end of
+  the file as they arrive, and NAXIS2 is patched in place when the writer is
+  closed. Only one chunk of rows needs to be held in memory at any time.
+  
+  Get a block of rows with new_rows(), fill it in and pass it to write(), as
+  many times as needed, then close() the writer to finish the file.
+  
+  Parameters
+  ----------
+  fitsfile: string
+    filename of FITS IDI file to create. Any existing file is overwritten.
+  hdus: list
+    the primary HDU and any tables to write before UV_DATA. If None, the
+    UV_DATA table is added to the end of fitsfile, which must already exist,
+    e.g. after tables streamed to it with TableWriter.
+  config: string
+    filename of xml configuration file, defaults to 'config,xml'
+  index: bool
+    if True, the (time, baseline, source) of each row written is kept, and
+    saved to a sidecar index file (see UVIndex) when the writer is closed
+  reserve: dict
+    number of rows to leave room for in other tables, by EXTNAME, e.g.
+    {'FLAG': 1000}. Rows can be added to these tables later with appendRows().
+  append: bool
+    if True, fitsfile must already exist, with UV_DATA as its last table.
+    New rows are then written after the existing ones, and hdus is ignored.
+  """
+  
+  def __init__(self, fitsfile, hdus, config='config.xml', index=True, reserve=None, append=False):
+    self.fitsfile = fitsfile
+    self.num_rows = 0
+    self.index = index
+    self._index_parts = []
+    self._first_row = 0
+    
+    # Use a one row table as a template for the header and row layout
+    template = make_uv_data(config=config, num_rows=1)
+    self.header = template.header.copy()
+    self.header.update('NAXIS2', 0)
+    
+    # FITS is big endian, whatever the machine is
+    self.dtype = template.data.dtype.newbyteorder('>')
+    self.native_dtype = template.data.dtype
+    
+    if append:
+      self._open_append()
+    else:
+      self._create(hdus, reserve or {})
+    
+    # Length of the FLUX complex axis, 3 if the weights are stored in FLUX
+    self.complex_len = self.header.get('MAXIS1', 2)
+  
+  def _create(self, hdus, reserve):
+    """ Writes the tables in hdus to a new file, followed by the UV_DATA header """
+    
+    if hdus is None:
+      if not os.path.isfile(self.fitsfile):
+        raise IOError('%s does not exist, so UV_DATA cannot be added to it'%self.fitsfile)
+      hdus = []
+    else:
+      if(os.path.isfile(self.fitsfile)):
+        os.remove(self.fitsfile)
+    
+    filename = indexFilename(self.fitsfile)
+    if(os.path.isfile(filename)):
+      os.remove(filename)
+    
+    # Tables with rows reserved are written after the others, with the room for
+    # their extra rows left in the (otherwise unused) heap
+    first_hdus = [hdu for hdu in hdus if hdu.header.get('EXTNAME') not in reserve]
+    if first_hdus:
+      pf.HDUList(first_hdus).writeto(self.fitsfile)
+    
+    self._fh = open(self.fitsfile, 'r+b')
+    self._fh.seek(0, os.SEEK_END)
+    for hdu in hdus:
+      if hdu.header.get('EXTNAME') in reserve:
+        self._fh.write(_reserved_table_block(hdu, reserve[hdu.header['EXTNAME']]))
+    
+    self._header_loc = self._fh.tell()
+    self._fh.write(_header_block(self.header))
+    self._data_loc = self._fh.tell()
+  
+  def _open_append(self):
+    """ Opens an existing file, ready to write rows after the end of its UV_DATA table """
+    
+    reader = FitsidiReader(self.fitsfile)
+    if reader.extnames[-1] != 'UV_DATA':
+      raise IOError('UV_DATA is not the last table in %s, so it cannot be appended to'%self.fitsfile)
+    if reader.header('UV_DATA').get('ZTABLE'):
+      raise IOError('UV_DATA in %s is compressed, so it cannot be appended to'%self.fitsfile)
+    if _table_dtype(reader.header('UV_DATA')) != self.dtype:
+      raise TypeError('UV_DATA columns in %s do not match the config file'%self.fitsfile)
+    
+    self.num_rows = self._first_row = reader.header('UV_DATA')['NAXIS2']
+    self._header_loc = reader.header_locs[-1]
+    self._data_loc = reader.data_locs[-1]
+    reader.close()
+    
+    self.header = pf.getheader(self.fitsfile, 'UV_DATA')
+    
+    # Carry on the index, if it is up to date
+    filename = indexFilename(self.fitsfile)
+    if self.index and _index_length(filename) != self.num_rows:
+      print('Warning: %s is missing or out of date, appended rows will not be indexed'%filename)
+      self.index = False
+    
+    # Drop the padding after the existing rows
+    self._fh = open(self.fitsfile, 'r+b')
+    self._fh.truncate(self.offset(self.num_rows))
+    self._fh.seek(0, os.SEEK_END)
+    
+  # Support the 'with' statement
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, type, value, traceback):
+    self.close()
+  
+  def new_rows(self, num_rows, zero=True):
+    """ Returns a blank record array of num_rows UV_DATA rows, to be filled and passed to write()
+    
+    The rows are already in the (big endian) FITS layout, so write() doesn't
+    need to convert them. If zero is False the rows are left uninitialised,
+    and every column must be filled before they are written.
+    """
+    if zero:
+      return np.rec.array(np.zeros(num_rows, dtype=self.dtype))
+    else:
+      return np.rec.array(np.empty(num_rows, dtype=self.dtype))
+  
+  def write(self, rows):
+    """ Appends rows to the end of the UV_DATA table.
+    
+    Parameters
+    ----------
+    rows: numpy.recarray
+      rows with the UV_DATA layout, e.g. from new_rows()
+    """
+    
+    _fits_rows(rows, self.dtype).tofile(self._fh)
+    self.add_index(self.num_rows, rows)
+    self.num_rows += np.size(rows)
+  
+  def allocate(self, num_rows):
+    """ Reserves space for num_rows rows at the end of the UV_DATA table.
+    
+    The reserved rows are zero, and can be filled in any order with write_at()
+    or in place with map_rows(), or from other processes with writeRowsAt() or
+    mapRowsAt() and offset(). Returns the index of the first reserved row.
+    """
+    
+    start_row = self.num_rows
+    self.num_rows += num_rows
+    self._fh.truncate(self.offset(self.num_rows))
+    self._fh.seek(0, os.SEEK_END)
+    
+    return start_row
+  
+  def offset(self, row):
+    """ Byte offset in the file of the start of a UV_DATA row """
+    return self._data_loc + row * self.dtype.itemsize
+  
+  def write_at(self, start_row, rows):
+    """ Writes rows into space already written or reserved with allocate()
+    
+    Parameters
+    ----------
+    start_row: int
+      index of the first row to write
+    rows: numpy.recarray
+      rows with the UV_DATA layout, e.g. from new_rows()
+    """
+    
+    if start_row + np.size(rows) > self.num_rows:
+      raise IOError('Attempt to write past the rows allocated in UV_DATA')
+    
+    self._fh.seek(self.offset(start_row))
+    _fits_rows(rows, self.dtype).tofile(self._fh)
+    self._fh.seek(0, os.SEEK_END)
+    self.add_index(start_row, rows)
+  
+  def add_index(self, start_row, rows):
+    """ Adds rows to the index. write() and write_at() do this themselves, but
+    rows filled with map_rows() or by other processes need to be added here.
+    
+    Parameters
+    ----------
+    start_row: int
+      index of the first row
+    rows: numpy.recarray
+      rows with (at least) the DATE, TIME, BASELINE and SOURCE columns, or
+      their index columns from indexColumns()
+    """
+    
+    if self.index:
+      self._index_parts.append((start_row, indexColumns(rows)))
+  
+  def map_rows(self, start_row, num_rows):
+    """ Memory maps rows already written or reserved with allocate()
+    
+    The returned rows are backed by the file itself, so they can be filled
+    in place without building them in memory first. See mapRowsAt().
+    """
+    
+    if start_row + num_rows > self.num_rows:
+      raise IOError('Attempt to map past the rows allocated in UV_DATA')
+    
+    self._fh.flush()
+    return mapRowsAt(self.fitsfile, self.offset(start_row), num_rows, self.dtype)
+    
+  def close(self):
+    """ Pads the data to a whole FITS block and writes the final row count into NAXIS2. """
+    
+    if self._fh is None:
+      return
+    
+    data_size = self._fh.tell() - self._data_loc
+    self._fh.write('\0' * _pad_length(data_size))
+    
+    self.header.update('NAXIS2', self.num_rows)
+    _patch_cards(self._fh, self._header_loc, {'NAXIS2': self.num_rows})
+    
+    self._fh.close()
+    self._fh = None
+    
+    if self.index:
+      self._save_index()
+  
+  def _save_index(self):
+    """ Saves (or appends) the index of the rows written to the sidecar file, if every row has been indexed """
+    
+    first_row = self._first_row
+    columns = np.zeros(self.num_rows - first_row, dtype=_index_dtype)
+    indexed = np.zeros(self.num_rows - first_row, dtype='bool')
+    for start_row, part in self._index_parts:
+      # Rows rewritten before the first appended row are already in the index
+      skip = max(first_row - start_row, 0)
+      start_row = max(start_row - first_row, 0)
+      columns[start_row:start_row+len(part)-skip] = part[skip:]
+      indexed[start_row:start_row+len(part)-skip] = True
+    
+    if not indexed.all():
+      print('Warning: only %i of %i UV_DATA rows were indexed, no index written'
+            %(indexed.sum(), indexed.size))
+      return
+    
+    saveIndexColumns(indexFilename(self.fitsfile), columns, append=(first_row > 0))
+    self._index_parts = []
+
+class TableWriter(object):
+  """ Streams rows of any table to the end of an existing FITS IDI file, chunk by chunk.
+  
+  Like UVDataWriter, the table header is written with NAXIS2 = 0, rows are
+  appended as they arrive, and NAXIS2 is patched when the writer is closed.
+  This is for big metadata tables, such as SYSTEM_TEMPERATURE and FLAG from
+  monitoring streams, so they never need to be held in memory whole. Only
+  one table can grow at a time, so close the writer before starting the
+  next table (or UV_DATA, with UVDataWriter(fitsfile, None)). The writer
+  can be used in a with block, which closes it.
+  
+  Parameters
+  ----------
+  fitsfile: string
+    filename of FITS IDI file to add the table to
+  extname: string
+    name of the table in table_schemas, e.g. 'FLAG'
+  config: string
+    filename of xml configuration file, defaults to 'config,xml'
+  """
+  
+  def __init__(self, fitsfile, extname, config='config.xml'):
+    self.fitsfile = fitsfile
+    self.extname = extname
+    self.num_rows = 0
+    
+    # Use a one row table as a template for the header and row layout
+    template = make_table(extname, config=config, num_rows=1)
+    self.header = template.header.copy()
+    self.header.update('NAXIS2', 0)
+    self.dtype = template.data.dtype.newbyteorder('>')
+    
+    self._fh = open(self.fitsfile, 'r+b')
+    self._fh.seek(0, os.SEEK_END)
+    self._header_loc = self._fh.tell()
+    self._fh.write(_header_block(self.header))
+    self._data_loc = self._fh.tell()
+  
+  # Support the 'with' statement
+  def __enter__(self):
+    return self
+  
+  def __exit__(self, type, value, traceback):
+    self.close()
+  
+  def new_rows(self, num_rows, zero=True):
+    """ Returns a blank record array of num_rows rows, in the FITS layout. See UVDataWriter.new_rows(). """
+    if zero:
+      return np.rec.array(np.zeros(num_rows, dtype=self.dtype))
+    else:
+      return np.rec.array(np.empty(num_rows, dtype=self.dtype))
+  
+  def write(self, rows):
+    """ Appends rows to the end of the table """
+    _fits_rows(rows, self.dtype).tofile(self._fh)
+    self.num_rows += np.size(rows)
+  
+  def close(self):
+    """ Pads the data to a whole FITS block and writes the final row count into NAXIS2. """
+    
+    if self._fh is None:
+      return
+    
+    data_size = self._fh.tell() - self._data_loc
+    self._fh.write('\0' * _pad_length(data_size))
+    
+    self.header.update('NAXIS2', self.num_rows)
+    _patch_cards(self._fh, self._header_loc, {'NAXIS2': self.num_rows})
+    
+    self._fh.close()
+    self._fh = None
+
+class CompressedUVDataWriter(UVDataWriter):
+  """ Streams UV_DATA rows to a FITS IDI file as a tile compressed table.
+  
+  Rows are gathered into tiles of tile_len rows, and each column of a tile
+  is compressed on its own, following the FITS tiled table compression
+  convention (ZTABLE). A column holds similar values, so it compresses much
+  better than whole rows do, and GZIP_2 shuffles the bytes of the values
+  first, so that e.g. the exponents of the FLUX values are compressed together.
+  
+  Compressed tiles are spooled to a temporary file as they are made. The
+  UV_DATA header, tile descriptors and compressed data are written when the
+  writer is closed, once the size of the table is known. Only one tile of
+  rows is held in memory.
+  
+  Rows can only be added with write(): they can't be allocated, rewritten or
+  memory mapped, so parallel_uv_data() can't use this writer, and nor can
+  compressed files be appended to.
+  
+  FitsidiReader (and CFITSIO) read these files; CASA doesn't, so use
+  decompressFits() to make a plain copy for it.
+  
+  Parameters
+  ----------
+  fitsfile, hdus, config, index, reserve:
+    as for UVDataWriter
+  tile_len: int
+    number of rows in each tile. Defaults to about 4 MB of rows.
+  algorithm: string
+    'GZIP_2' (shuffled bytes, then gzip) or 'GZIP_1' (gzip)
+  level: int
+    gzip compression level, from 1 (fastest) to 9 (smallest)
+  """
+  
+  def __init__(self, fitsfile, hdus, config='config.xml', index=True, reserve=None,
+               tile_len=None, algorithm='GZIP_2', level=1):
+    if algorithm not in _compression_types:
+      raise ValueError('Unknown compression %s, use one of %s'%(algorithm, ', '.join(_compression_types)))
+    
+    UVDataWriter.__init__(self, fitsfile, hdus, config=config, index=index, reserve=reserve)
+    
+    self.tile_len = tile_len or max(1, _tile_bytes / self.dtype.itemsize)
+    self.algorithm = algorithm
+    self.level = level
+    self.bytes_compressed = 0
+    
+    self._pending = []
+    self._num_pending = 0
+    self._descriptors = []
+    self._heap = tempfile.TemporaryFile()
+  
+  def _create(self, hdus, reserve):
+    """ Writes the tables in hdus to a new file. The UV_DATA header is left to close(). """
+    UVDataWriter._create(self, hdus, reserve)
+    self._fh.seek(self._header_loc)
+    self._fh.truncate()
+  
+  def write(self, rows):
+    """ Adds rows to the end of the UV_DATA table, compressing every tile that fills up.
+    
+    Parameters
+    ----------
+    rows: numpy.recarray
+      rows with the UV_DATA layout, e.g. from new_rows()
+    """
+    
+    self.add_index(self.num_rows, rows)
+    rows = _fits_rows(rows, self.dtype)
+    self.num_rows += rows.size
+    
+    # Top up a part filled tile first, then compress whole tiles straight from
+    # the rows given. Only the rows left over are copied, to wait for the next call.
+    start = 0
+    if self._num_pending:
+      start = min(self.tile_len - self._num_pending, rows.size)
+      self._pending.append(rows[:start].copy())
+      self._num_pending += start
+      if self._num_pending == self.tile_len:
+        self._write_tile(np.concatenate(self._pending))
+        self._pending, self._num_pending = [], 0
+    
+    while start + self.tile_len <= rows.size:
+      self._write_tile(rows[start:start+self.tile_len])
+      start += self.tile_len
+    
+    if start < rows.size:
+      self._pending.append(rows[start:].copy())
+      self._num_pending += rows.size - start
+  
+  def _write_tile(self, rows):
+    """ Compresses each column of a tile of rows to the heap """
+    descriptors = []
+    for name in self.dtype.names:
+      data = compressColumn(rows[name], self.algorithm, self.level)
+      descriptors.append((len(data), self.bytes_compressed))
+      self._heap.write(data)
+      self.bytes_compressed += len(data)
+    self._descriptors.append(descriptors)
+  
+  def allocate(self, num_rows):
+    raise IOError('Rows cannot be allocated in a compressed UV_DATA table')
+  
+  def write_at(self, start_row, rows):
+    raise IOError('Rows cannot be rewritten in a compressed UV_DATA table')
+  
+  def map_rows(self, start_row, num_rows):
+    raise IOError('Rows cannot be memory mapped in a compressed UV_DATA table')
+  
+  def offset(self, row):
+    raise IOError('Rows of a compressed UV_DATA table have no fixed offset')
+  
+  def close(self):
+    """ Compresses the last (short) tile, and writes the UV_DATA header, tile descriptors and heap """
+    
+    if self._fh is None:
+      return
+    
+    if self._num_pending:
+      self._write_tile(np.concatenate(self._pending))
+      self._pending, self._num_pending = [], 0
+    
+    num_cols = len(self.dtype.names)
+    descriptors = np.array(self._descriptors, dtype='>i4').reshape(-1, num_cols, 2)
+    max_lens = descriptors[:,:,0].max(axis=0) if len(descriptors) else np.zeros(num_cols, 'int')
+    
+    self.header.update('NAXIS2', self.num_rows)
+    header = _compressed_table_header(self.header, len(descriptors), self.tile_len,
+                                      self.algorithm, max_lens, self.bytes_compressed)
+    
+    self._fh.write(_header_block(header))
+    self._fh.write(descriptors.tostring())
+    self._heap.seek(0)
+    shutil.copyfileobj(self._heap, self._fh)
+    self._fh.write('\0' * _pad_length(descriptors.nbytes + self.bytes_compressed))
+    
+    self._heap.close()
+    self._fh.close()
+    self._fh = None
+    
+    if self.index:
+      self._save_index()
+
+def appendRows(fitsfile, extname, rows):
+  """ Appends rows to a table in an existing FITS IDI file, without rewriting the file.
+  
+  The rows are written straight after the existing rows of the table, and
+  its NAXIS2 is updated, so the cost only depends on the number of rows
+  added. This works for the last table in the file (normally UV_DATA), or
+  for a table that had rows reserved for it by UVDataWriter, until they
+  run out.
+  
+  Parameters
+  ----------
+  fitsfile: string
+    filename of FITS IDI file to append to
+  extname: string
+    EXTNAME of the table, e.g. 'FLAG'
+  rows: numpy.recarray
+    rows with the same columns as the table
+  
+  Returns
+  -------
+  start_row: int, the index of the first row appended
+  """
+  
+  reader = FitsidiReader(fitsfile)
+  i = reader.hdu_number(extname)
+  header = reader.headers[i]
+  header_loc, data_loc = reader.header_locs[i], reader.data_locs[i]
+  is_last = (i == len(reader.headers) - 1)
+  reader.close()
+  
+  if header.get('ZTABLE'):
+    raise IOError('%s in %s is compressed, so rows cannot be appended to it'%(extname, fitsfile))
+  
+  data = _fits_rows(rows, _table_dtype(header))
+  start_row = header['NAXIS2']
+  data_end = data_loc + start_row * header['NAXIS1']
+  room = header.get('PCOUNT', 0)
+  
+  cards = {'NAXIS2': start_row + data.size}
+  if not is_last:
+    if data.nbytes > room:
+      raise IOError('No room to append %i rows to %s in %s, reserve rows for it with UVDataWriter'
+                    %(data.size, extname, fitsfile))
+    cards['PCOUNT'] = room - data.nbytes
+  
+  fh = open(fitsfile, 'r+b')
+  try:
+    fh.seek(data_end)
+    data.tofile(fh)
+    if is_last:
+      data_size = fh.tell() - data_loc
+      fh.write('\0' * _pad_length(data_size))
+      fh.truncate()
+    _patch_cards(fh, header_loc, cards)
+  finally:
+    fh.close()
+  
+  # Keep the UV_DATA index up to date
+  filename = indexFilename(fitsfile)
+  if extname == 'UV_DATA' and _index_length(filename) == start_row:
+    saveIndexColumns(filename, indexColumns(np.asarray(rows).view(np.recarray)), append=True)
+  
+  return start_row
+
+def decompressFits(infile, outfile):
+  """ Writes a copy of a FITS IDI file with its compressed tables decompressed, e.g. for CASA.
+
+  Compressed tables are decompressed a tile at a time, and the other HDUs
+  are copied as they are. The sidecar index is copied too, if there is one.
+
+  Parameters
+  ----------
+  infile: string
+    filename of FITS IDI file with compressed tables, e.g. from CompressedUVDataWriter
+  outfile: string
+    filename of the plain FITS IDI file to write
+  """
+
+  reader = FitsidiReader(infile)
+  ends = reader.header_locs[1:] + [reader._map.size]
+
+  fh = open(outfile, 'wb')
+  try:
+    for i, header in enumerate(reader.headers):
+      if not header.get('ZTABLE'):
+        reader._map[reader.header_locs[i]:ends[i]].tofile(fh)
+        continue
+
+      fh.write(_header_block(_decompressed_table_header(pf.getheader(infile, i))))
+      data_size = 0
+      for start_row, rows in reader.tiles(reader.extnames[i-1]):
+        rows.tofile(fh)
+        data_size += rows.nbytes
+      fh.write('\0' * _pad_length(data_size))
+  finally:
+    fh.close()
+    reader.close()
+
+  if os.path.isfile(indexFilename(infile)):
+    shutil.copyfile(indexFilename(infile), indexFilename(outfile))
+
+def writeRowsAt(fitsfile, offset, rows, dtype):
+  """ Writes table rows into a region of an existing FITS file.
+  
+  This opens the file itself, so can be used from worker processes to fill
+  rows reserved with UVDataWriter.allocate().
+  
+  Parameters
+  ----------
+  fitsfile: string
+    filename of FITS file to write to
+  offset: int
+    byte offset to write the first row at, e.g. from UVDataWriter.offset()
+  rows: numpy.recarray
+    rows to write
+  dtype: numpy.dtype
+    big endian dtype of the table rows, e.g. UVDataWriter.dtype
+  """
+  
+  fh = open(fitsfile, 'r+b')
+  try:
+    fh.seek(offset)
+    _fits_rows(rows, dtype).tofile(fh)
+  finally:
+    fh.close()
+
+def mapRowsAt(fitsfile, offset, num_rows, dtype):
+  """ Memory maps table rows in a region of an existing FITS file.
+  
+  The rows are filled in place, so nothing is zero filled, copied or
+  converted on the way to disk. Call flush() on the returned array once the
+  rows are filled. Like writeRowsAt(), this can be used from worker processes.
+  
+  Parameters
+  ----------
+  fitsfile: string
+    filename of FITS file to map
+  offset: int
+    byte offset of the first row, e.g. from UVDataWriter.offset()
+  num_rows: int
+    number of rows to map
+  dtype: numpy.dtype
+    big endian dtype of the table rows, e.g. UVDataWriter.dtype
+  
+  Returns
+  -------
+  rows: numpy.memmap, use rows.view(np.recarray) for field access by attribute
+  """
+  
+  return np.memmap(fitsfile, dtype=dtype, mode='r+', offset=offset, shape=(num_rows,))
+
+def _fits_rows(rows, dtype):
+  """ Returns rows as a contiguous array with the given (big endian) FITS dtype
+  
+  Rows that are already in the FITS layout (e.g. from UVDataWriter.new_rows())
+  are returned as they are, without a copy.
+  """
+  rows = np.asarray(rows)
+  if rows.dtype.names != dtype.names:
+    raise TypeError('Rows do not match the table columns %s'%(dtype.names,))
+  
+  if rows.dtype == dtype:
+    return np.ascontiguousarray(rows)
+  return rows.astype(dtype)
+
+# Column compression algorithms (ZCTYPn) of the tiled table compression convention
+_compression_types = ('GZIP_1', 'GZIP_2')
+
+# Default size of the rows in a compressed tile, in bytes
+_tile_bytes = 4 * 1024**2
+
+def _element_size(dtype):
+  """ Size in bytes of each value of a column, which GZIP_2 shuffles by. Strings are shuffled as bytes. """
+  dtype = np.dtype(dtype).base
+  return 1 if dtype.kind == 'S' else dtype.itemsize
+
+def compressColumn(data, algorithm='GZIP_2', level=1):
+  """ Compresses the values of one column in a tile of rows, for the heap of a compressed table
+  
+  Parameters
+  ----------
+  data: numpy.array
+    column values for each row of the tile, in the (big endian) FITS layout
+  algorithm: string
+    'GZIP_1' to gzip the values as they are, or 'GZIP_2' to shuffle their
+    bytes first: all the first bytes of each value, then all the second...
+  level: int
+    gzip compression level, from 1 (fastest) to 9 (smallest)
+  
+  Returns
+  -------
+  data: string, in gzip format
+  """
+  
+  raw = np.ascontiguousarray(data).view('uint8').ravel()
+  size = _element_size(data.dtype)
+  if algorithm == 'GZIP_2' and size > 1:
+    raw = raw.reshape(-1, size).T.copy()
+  
+  # wbits of 31 gives gzip rather than zlib headers, as the convention asks for
+  compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+  return compressor.compress(raw.tostring()) + compressor.flush()
+
+def decompressColumn(data, dtype, algorithm='GZIP_2'):
+  """ Decompresses the values of one column in a tile, see compressColumn()
+  
+  Parameters
+  ----------
+  data: string
+    compressed column, from the heap of a compressed table
+  dtype: numpy.dtype
+    (big endian) dtype of the column, from its ZFORMn
+  algorithm: string
+    compression algorithm of the column, from its ZCTYPn
+  
+  Returns
+  -------
+  values: numpy.array, flat, with the base dtype of the column
+  """
+  
+  if algorithm not in _compression_types:
+    raise IOError('Unsupported column compression %s'%algorithm)
+  
+  raw = np.frombuffer(zlib.decompress(data, 31), dtype='uint8')
+  size = _element_size(dtype)
+  if algorithm == 'GZIP_2' and size > 1:
+    raw = raw.reshape(size, -1).T.copy()
+  
+  return np.frombuffer(raw.tostring(), dtype=np.dtype(dtype).base)
+
+def _compressed_table_header(header, num_tiles, tile_len, algorithm, max_lens, heap_len):
+  """ Converts the header of a binary table into the header of its tile compressed form.
+  
+  Each column becomes a descriptor (1PB) into the heap, and the original
+  layout is kept in the ZNAXISn, ZFORMn and ZCTYPn keywords.
+  """
+  
+  compressed = header.copy()
+  num_cols = header['TFIELDS']
+  
+  compressed.update('NAXIS1', 8 * num_cols)
+  compressed.update('NAXIS2', num_tiles)
+  compressed.update('PCOUNT', heap_len)
+  for i in range(1, num_cols + 1):
+    compressed.update('TFORM%i'%i, '1PB(%i)'%max_lens[i-1])
+  
+  compressed.update('ZTABLE', True, 'this is a compressed table')
+  compressed.update('ZTILELEN', tile_len, 'number of rows in each tile')
+  compressed.update('ZNAXIS1', header['NAXIS1'], 'length of uncompressed row')
+  compressed.update('ZNAXIS2', header['NAXIS2'], 'number of uncompressed rows')
+  compressed.update('ZPCOUNT', 0, 'size of uncompressed heap')
+  for i in range(1, num_cols + 1):
+    compressed.update('ZFORM%i'%i, header['TFORM%i'%i], 'original format of column')
+    compressed.update('ZCTYP%i'%i, algorithm, 'compression algorithm of column')
+  
+  return compressed
+
+def _decompressed_table_header(header):
+  """ Converts the header of a tile compressed table back into the header of the plain table """
+
+  header = header.copy()
+  num_cols = header['TFIELDS']
+
+  header.update('NAXIS1', header['ZNAXIS1'])
+  header.update('NAXIS2', header['ZNAXIS2'])
+  header.update('PCOUNT', header.get('ZPCOUNT', 0))
+  for i in range(1, num_cols + 1):
+    header.update('TFORM%i'%i, header['ZFORM%i'%i])
+
+  for key in ['ZTABLE', 'ZTILELEN', 'ZNAXIS1', 'ZNAXIS2', 'ZPCOUNT', 'THEAP']:
+    if key in header:
+      del header[key]
+  for i in range(1, num_cols + 1):
+    for key in ['ZFORM%i'%i, 'ZCTYP%i'%i]:
+      if key in header:
+        del header[key]
+
+  return header
+
+def _pad_length(nbytes):
+  """ Number of bytes needed to pad nbytes out to a whole 2880 byte FITS block """
+  return -nbytes % 2880
+
+def _header_block(header):
+  """ Converts a header into its 2880 byte padded FITS representation """
+  cards = ''.join([str(card) for card in header.ascardlist()]) + 'END'.ljust(80)
+  return cards + ' ' * _pad_length(len(cards))
+
+def _patch_cards(fh, header_loc, values):
+  """ Overwrites the values of header cards in place in an open FITS file.
+  
+  Parameters
+  ----------
+  fh: file
+    FITS file, opened for update
+  header_loc: int
+    byte offset of the start of the header
+  values: dict
+    new values by keyword, e.g. {'NAXIS2': 100}. The keywords must already
+    be in the header.
+  """
+  
+  values = dict(values)
+  offset = header_loc
+  while values:
+    fh.seek(offset)
+    card = fh.read(80)
+    if len(card) < 80 or card[:8].strip() == 'END':
+      raise KeyError('Keywords %s are not in the header'%(sorted(values),))
+    
+    key = card[:8].strip()
+    if key in values:
+      fh.seek(offset)
+      fh.write(str(pf.Card(key, values.pop(key))))
+    offset += 80
+  
+  fh.seek(0, os.SEEK_END)
+
+def _reserved_table_block(hdu, num_rows):
+  """ Converts a table HDU to its FITS representation, with room to append num_rows rows.
+  
+  The room is left in the heap (PCOUNT bytes), which is where a reader
+  expects to find it. Appending a row takes it out of the heap, so the size
+  of the table in the file, and the position of anything after it, never change.
+  """
+  
+  data = np.asarray(hdu.data)
+  dtype = data.dtype.newbyteorder('>')
+  rows = _fits_rows(data, dtype).tostring()
+  room = num_rows * dtype.itemsize
+  
+  header = hdu.header.copy()
+  header.update('PCOUNT', room)
+  
+  return _header_block(header) + rows + '\0' * (room + _pad_length(len(rows) + room))
+
+def _index_length(filename):
+  """ Number of rows in a sidecar index file, or None if there isn't one """
+  if not os.path.isfile(filename):
+    return None
+  return os.path.getsize(filename) / _index_dtype.itemsize
+
+# Index of UV_DATA rows: julian date (DATE + TIME), baseline and source of each row.
+# The sidecar index file is just these records, one per row, so it can be appended to.
+_index_dtype = np.dtype([('JD', '<f8'), ('BASELINE', '<i4'), ('SOURCE', '<i4')])
+
+def indexFilename(fitsfile):
+  """ Filename of the sidecar index file of a FITS IDI file """
+  return fitsfile + '.idx'
+
+def indexColumns(rows):
+  """ Returns the index columns (JD, BASELINE, SOURCE) of UV_DATA rows, as a compact record array
+  
+  Parameters
+  ----------
+  rows: numpy.recarray
+    rows with (at least) the DATE, TIME, BASELINE and SOURCE columns. Rows
+    that are already index columns are returned as they are.
+  """
+  
+  if rows.dtype.names == _index_dtype.names:
+    return rows
+  
+  columns = np.rec.array(np.zeros(np.size(rows), dtype=_index_dtype))
+  columns.JD[:] = rows.field('DATE')
+  columns.JD += rows.field('TIME')
+  columns.BASELINE[:] = rows.field('BASELINE')
+  columns.SOURCE[:] = rows.field('SOURCE')
+  
+  return columns
+
+class UVIndex(object):
+  """ Index of the UV_DATA rows by time, baseline and source.
+  
+  The index holds the julian date (DATE + TIME), BASELINE and SOURCE of
+  every row, plus the rows sorted by (baseline, time) and by time, so that
+  the rows for a baseline or a time range are found with a binary search
+  rather than a scan through the table. UVDataWriter saves an index next
+  to the FITS file when it is closed, which FitsidiReader.index() loads.
+  
+  Parameters
+  ----------
+  columns: numpy.recarray
+    JD, BASELINE and SOURCE of each row, in row order (see indexColumns())
+  """
+  
+  def __init__(self, columns):
+    self.jd = np.asarray(columns['JD'], dtype='float64')
+    self.baseline = np.asarray(columns['BASELINE'], dtype='int32')
+    self.source = np.asarray(columns['SOURCE'], dtype='int32')
+    
+    self._by_baseline = np.lexsort((self.jd, self.baseline))
+    self._baseline_sorted = self.baseline[self._by_baseline]
+    
+    self._by_time = np.argsort(self.jd, kind='mergesort')
+    self._jd_sorted = self.jd[self._by_time]
+  
+  def __len__(self):
+    return self.jd.size
+  
+  def baseline_rows(self, baseline, t_start=None, t_stop=None, source=None):
+    """ Rows of a baseline in time order, optionally between julian dates t_start and t_stop (exclusive)
+    
+    Parameters
+    ----------
+    baseline: int
+      baseline ID (256*ant1 + ant2)
+    t_start, t_stop: float
+      julian dates of the time range, defaults to all times
+    source: int
+      SOURCE ID to select, defaults to all sources
+    """
+    
+    lo = np.searchsorted(self._baseline_sorted, baseline, 'left')
+    hi = np.searchsorted(self._baseline_sorted, baseline, 'right')
+    rows = self._by_baseline[lo:hi]
+    
+    # Rows of a baseline are in time order, so the time range is a slice of them
+    jd = self.jd[rows]
+    if t_start is not None:
+      rows = rows[np.searchsorted(jd, t_start, 'left'):]
+      jd = self.jd[rows]
+    if t_stop is not None:
+      rows = rows[:np.searchsorted(jd, t_stop, 'left')]
+    
+    if source is not None:
+      rows = rows[self.source[rows] == source]
+    
+    return rows
+  
+  def time_rows(self, t_start, t_stop, source=None):
+    """ Rows of all baselines between julian dates t_start and t_stop (exclusive), in time order
+    
+    Parameters
+    ----------
+    t_start, t_stop: float
+      julian dates of the time range
+    source: int
+      SOURCE ID to select, defaults to all sources
+    """
+    
+    lo = np.searchsorted(self._jd_sorted, t_start, 'left')
+    hi = np.searchsorted(self._jd_sorted, t_stop, 'left')
+    rows = self._by_time[lo:hi]
+    
+    if source is not None:
+      rows = rows[self.source[rows] == source]
+    
+    return rows
+  
+  def save(self, filename):
+    """ Saves the index columns to a sidecar index file """
+    saveIndexColumns(filename, self.columns())
+  
+  def columns(self):
+    """ Returns the index columns, in row order (as from indexColumns()) """
+    columns = np.rec.array(np.zeros(len(self), dtype=_index_dtype))
+    columns.JD[:] = self.jd
+    columns.BASELINE[:] = self.baseline
+    columns.SOURCE[:] = self.source
+    return columns
+
+def saveIndexColumns(filename, columns, append=False):
+  """ Writes index columns to a sidecar index file, or appends them to the end of it """
+  fh = open(filename, 'ab' if append else 'wb')
+  try:
+    np.asarray(columns, dtype=_index_dtype).tofile(fh)
+  finally:
+    fh.close()
+
+def loadIndex(filename):
+  """ Loads a UVIndex from a sidecar index file """
+  return UVIndex(np.fromfile(filename, dtype=_index_dtype))
+
+# numpy dtypes for FITS binary table format codes, as stored on disk (big endian)
+_fits_disk_dtypes = {'L': 'S1', 'B': 'u1', 'I': '>i2', 'J': '>i4', 'K': '>i8',
+                     'E': '>f4', 'D': '>f8', 'C': '>c8', 'M': '>c16'}
+
+class FitsidiReader(object):
+  """ Memory maps an existing FITS IDI file, giving numpy views of its tables.
+  
+  Only the headers are read when the file is opened. Tables are returned as
+  read-only record arrays that point straight into the memory map, so data
+  is only read from disk when (and where) it is used.
+  
+  Tile compressed tables (e.g. from CompressedUVDataWriter) are read too, but
+  table() has to decompress the whole table into memory; tiles() reads them
+  a tile at a time.
+  
+  flux() gives the UV_DATA FLUX column shaped (nrow, nband, nchan, nstokes,
+  ncomplex), and read_baseline() and read_time() pick rows out of UV_DATA
+  with the index (see index()).
+  
+  Parameters
+  ----------
+  fitsfile: string
+    filename of FITS IDI file to read
+  
+  Attributes
+  ----------
+  extnames: list
+    EXTNAME of each extension, in the order they are in the file
+  headers: list
+    header of each HDU (primary first), as a dictionary of keyword: value
+  header_locs, data_locs: list
+    byte offsets of the header and data of each HDU
+  """
+  
+  def __init__(self, fitsfile):
+    self.fitsfile = fitsfile
+    self._map = np.memmap(fitsfile, dtype='uint8', mode='r')
+    self._index = None
+    self._decompressed = {}
+    
+    self.headers = []
+    self.header_locs = []
+    self.data_locs = []
+    
+    offset = 0
+    while offset < self._map.size:
+      self.header_locs.append(offset)
+      header, offset = _read_header(self._map, offset)
+      self.headers.append(header)
+      self.data_locs.append(offset)
+      
+      data_size = _data_size(header)
+      offset += data_size + _pad_length(data_size)
+    
+    self.extnames = [header.get('EXTNAME') for header in self.headers[1:]]
+  
+  def header(self, extname):
+    """ Returns the header of an extension, as a dictionary of keyword: value """
+    return self.headers[self.hdu_number(extname)]
+  
+  def table(self, extname):
+    """ Returns a zero copy, read-only view of a binary table extension
+    
+    A compressed table is decompressed into memory instead, the first time
+    it is asked for.
+    
+    Parameters
+    ----------
+    extname: string
+      EXTNAME of the table, e.g. 'UV_DATA'
+    
+    Returns
+    -------
+    table: numpy.recarray, with big endian fields as they are on disk
+    """
+    
+    i = self.hdu_number(extname)
+    header = self.headers[i]
+    
+    if header.get('ZTABLE'):
+      if extname not in self._decompressed:
+        table = np.zeros(header['ZNAXIS2'], dtype=_table_dtype(header, 'ZFORM'))
+        for start_row, rows in self.tiles(extname):
+          table[start_row:start_row+len(rows)] = rows
+        self._decompressed[extname] = table.view(np.recarray)
+      return self._decompressed[extname]
+    
+    dtype = _table_dtype(header)
+    if dtype.itemsize != header['NAXIS1']:
+      raise IOError('Row length of %s is %i, expected %i from its columns'
+                    %(extname, header['NAXIS1'], dtype.itemsize))
+    
+    table = np.ndarray(shape=(header['NAXIS2'],), dtype=dtype,
+                       buffer=self._map, offset=self.data_locs[i])
+    
+    return table.view(np.recarray)
+  
+  def tiles(self, extname, tile_len=None):
+    """ Reads a binary table a chunk of rows at a time
+    
+    Parameters
+    ----------
+    extname: string
+      EXTNAME of the table, e.g. 'UV_DATA'
+    tile_len: int
+      number of rows in each chunk. Compressed tables are always read a
+      whole tile (ZTILELEN rows) at a time, so this is ignored for them.
+    
+    Returns
+    -------
+    generator of (start_row, rows), where rows is a numpy.recarray. Rows of
+    plain tables are views of the memory map, like table().
+    """
+    
+    i = self.hdu_number(extname)
+    header = self.headers[i]
+    
+    if not header.get('ZTABLE'):
+      table = self.table(extname)
+      tile_len = tile_len or max(1, _tile_bytes / table.dtype.itemsize)
+      for start_row in range(0, len(table), tile_len):
+        yield start_row, table[start_row:start_row+tile_len]
+      return
+    
+    dtype = _table_dtype(header, 'ZFORM')
+    num_cols = len(dtype.names)
+    num_tiles, num_rows, tile_len = header['NAXIS2'], header['ZNAXIS2'], header['ZTILELEN']
+    
+    descriptors = np.ndarray(shape=(num_tiles, num_cols, 2), dtype='>i4',
+                             buffer=self._map, offset=self.data_locs[i])
+    heap_loc = self.data_locs[i] + header.get('THEAP', header['NAXIS1'] * num_tiles)
+    algorithms = [header.get('ZCTYP%i'%(j + 1), 'GZIP_1') for j in range(num_cols)]
+    
+    for tile in range(num_tiles):
+      start_row = tile * tile_len
+      rows = np.zeros(min(tile_len, num_rows - start_row), dtype=dtype)
+      for j, name in enumerate(dtype.names):
+        length, offset = descriptors[tile, j]
+        data = self._map[heap_loc+offset:heap_loc+offset+length].tostring()
+        values = decompressColumn(data, dtype.fields[name][0], algorithms[j])
+        rows[name] = values.reshape(rows[name].shape)
+      
+      yield start_row, rows.view(np.recarray)
+  
+  def num_rows(self, extname):
+    """ Number of rows in a table, before any compression """
+    header = self.header(extname)
+    return header.get('ZNAXIS2', header['NAXIS2'])
+  
+  def uv_data(self):
+    """ Returns a zero copy, read-only view of the UV_DATA table (or a decompressed copy, see table()) """
+    return self.table('UV_DATA')
+  
+  def flux(self):
+    """ Returns a view of the UV_DATA FLUX column with shape (nrow, nband, nchan, nstokes, ncomplex)
+    
+    The axes come from the NO_BAND, NO_CHAN, NO_STKD and MAXIS1 keywords of
+    the UV_DATA header. The last axis is (real, imaginary), or (real,
+    imaginary, weight) if the weights are stored in FLUX.
+    """
+    
+    header = self.header('UV_DATA')
+    shape = (self.num_rows('UV_DATA'), header['NO_BAND'], header['NO_CHAN'], header['NO_STKD'],
+             header.get('MAXIS1', 2))
+    
+    flux = self.uv_data().field('FLUX').view(np.ndarray)
+    if flux.ndim == 1:
+      flux = flux[:, np.newaxis]
+    if flux.shape[1] != np.prod(shape[1:]):
+      raise IOError('FLUX has %i values per row, expected %i from the UV_DATA header'
+                    %(flux.shape[1], np.prod(shape[1:])))
+    
+    # Reshape without a copy. Assigning to shape raises an error rather than copying.
+    flux = flux.view()
+    flux.shape = shape
+    
+    return flux
+  
+  def index(self):
+    """ Returns the UVIndex of the UV_DATA table
+    
+    The sidecar index written by UVDataWriter is used if there is one for
+    all the rows, otherwise the index is built by scanning the table.
+    """
+    
+    if self._index is None:
+      filename = indexFilename(self.fitsfile)
+      num_rows = self.num_rows('UV_DATA')
+      if os.path.isfile(filename):
+        self._index = loadIndex(filename)
+        if len(self._index) != num_rows:
+          print('Warning: index %s is out of date, rebuilding it'%filename)
+          self._index = None
+      if self._index is None:
+        self._index = UVIndex(indexColumns(self.uv_data()))
+    
+    return self._index
+  
+  def read_rows(self, rows):
+    """ Reads UV_DATA rows from disk, in the order given
+    
+    Only the pages of the memory map holding the rows are read from disk.
+    Returns a copy, as a numpy.recarray.
+    """
+    
+    return self.uv_data()[np.asarray(rows, dtype='int64')]
+  
+  def read_baseline(self, baseline, t_start=None, t_stop=None, source=None):
+    """ Reads the time series of a baseline from UV_DATA. See UVIndex.baseline_rows() """
+    return self.read_rows(self.index().baseline_rows(baseline, t_start, t_stop, source))
+  
+  def read_time(self, t_start, t_stop, source=None):
+    """ Reads all baselines between julian dates t_start and t_stop from UV_DATA. See UVIndex.time_rows() """
+    return self.read_rows(self.index().time_rows(t_start, t_stop, source))
+  
+  def close(self):
+    """ Releases the memory map. It is unmapped once any views from the reader are deleted too. """
+    self._map = None
+    self._decompressed = {}
+  
+  def hdu_number(self, extname):
+    """ Index into headers of the extension with this EXTNAME """
+    try:
+      return self.extnames.index(extname) + 1
+    except ValueError:
+      raise KeyError('No %s extension in %s'%(extname, self.fitsfile))
+
+def _read_header(data, offset):
+  """ Reads the FITS header starting at offset, returning (header, data offset) """
+  
+  header = {}
+  while True:
+    if offset + 2880 > data.size:
+      raise IOError('Header at byte %i has no END card'%offset)
+    
+    block = data[offset:offset+2880].tostring()
+    offset += 2880
+    
+    for i in range(0, 2880, 80):
+      card = block[i:i+80]
+      key = card[:8].strip()
+      if key == 'END':
+        return header, offset
+      if card[8:10] == '= ':
+        header[key] = _card_value(card[10:])
+
+def _card_value(text):
+  """ Converts the value part of a FITS header card to a python value """
+  
+  text = text.strip()
+  if text.startswith("'"):
+    # Strings are quoted with single quotes, which are doubled inside the string
+    value, i = '', 1
+    while i < len(text):
+      if text[i] == "'":
+        if text[i+1:i+2] == "'":
+          value += "'"
+          i += 2
+          continue
+        break
+      value += text[i]
+      i += 1
+    return value.rstrip()
+  
+  text = text.split('/')[0].strip()
+  if text == 'T':
+    return True
+  if text == 'F':
+    return False
+  try:
+    return int(text)
+  except ValueError:
+    pass
+  try:
+    return float(text.replace('D', 'E'))
+  except ValueError:
+    return text
+
+def _data_size(header):
+  """ Size in bytes of the data of a HDU, not including padding """
+  
+  if header.get('NAXIS', 0) == 0:
+    return 0
+  
+  size = 1
+  for i in range(1, header['NAXIS'] + 1):
+    size *= header['NAXIS%i'%i]
+  
+  return abs(header['BITPIX']) / 8 * header.get('GCOUNT', 1) * (header.get('PCOUNT', 0) + size)
+
+def _table_dtype(header, form_key='TFORM'):
+  """ Big endian numpy dtype of the rows of a binary table, from its TTYPEn and TFORMn cards.
+  Use a form_key of 'ZFORM' for the uncompressed rows of a compressed table. """
+  
+  fields = []
+  for i in range(1, header['TFIELDS'] + 1):
+    name = header['TTYPE%i'%i]
+    tform = header['%s%i'%(form_key, i)].strip()
+    
+    repeat, code = tform[:-1], tform[-1]
+    repeat = int(repeat) if repeat else 1
+    
+    if code == 'A':
+      fields.append((name, 'S%i'%repeat))
+    elif code not in _fits_disk_dtypes:
+      raise TypeError('Column %s has unsupported format %s'%(name, tform))
+    elif repeat == 1:
+      fields.append((name, _fits_disk_dtypes[code]))
+    else:
+      fields.append((name, _fits_disk_dtypes[code], (repeat,)))
+  
+  return np.dtype(fields)
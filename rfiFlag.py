@@ -0,0 +1,204 @@
+# encoding: utf-8
+"""
+rfiFlag.py
+==========
+
+Automatic RFI flagging, run on the slabs of dumps as they are converted, so
+that the data don't need a second pass in CASA.
+
+For each channel, baseline and polarisation, the median amplitude over the
+dumps in a slab is taken as the clean level, and the median absolute
+deviation (MAD) from it as the noise. Samples more than threshold times the
+(Gaussian equivalent) MAD away are flagged. Working along time, the bandpass
+and the different baseline sensitivities drop out, so no model of either is
+needed. Slabs should be several dumps long for the statistics to mean much;
+the MAD of each channel is floored at the median MAD of its baseline, so that
+a few dumps that happen to agree closely don't flag the rest.
+
+Flagged samples are merged into runs of channels, and runs that repeat on
+consecutive dumps into time ranges, so a burst of RFI is one FLAG row rather
+than one per sample.
+
+RFIFlagger.add() is called with each slab as it is converted; ranges() and
+times() then give what to write to the FLAG table.
+
+Module listing
+~~~~~~~~~~~~~~
+
+"""
+
+import numpy as np
+
+# A flagged range: baseline index, dumps t_start to t_stop and channels
+# chan_start to chan_stop (both exclusive)
+range_dtype = np.dtype([('baseline', 'int32'), ('t_start', 'int32'), ('t_stop', 'int32'),
+                        ('chan_start', 'int32'), ('chan_stop', 'int32')])
+
+# MAD of a Gaussian is 0.6745 sigma
+mad_sigma = 1.4826
+
+
+def madMask(slab, threshold=5.0):
+  """ Flags outliers in a slab of dumps, by median absolute deviation over time.
+
+  Parameters
+  ----------
+  slab: numpy.array
+    dumps of xeng_raw0, with axes (time, channels, baselines, polarisation, real/imag)
+  threshold: float
+    number of (MAD estimated) standard deviations from the median to flag at
+
+  Returns
+  -------
+  mask: numpy.array of bool, with axes (time, channels, baselines). A sample
+  is flagged if any of its polarisations is.
+  """
+
+  amp = np.hypot(slab[...,0].astype('float32'), slab[...,1].astype('float32'))
+
+  median = np.median(amp, axis=0)
+  deviation = np.abs(amp - median)
+  mad = np.median(deviation, axis=0)
+
+  # With only a slab of dumps, some channels' MADs come out far too small by
+  # chance, so the MAD is floored at the median over channels for that baseline
+  mad = np.maximum(mad, np.median(mad, axis=0))
+
+  # Where the MAD is zero (e.g. constant data) nothing can be said, so nothing is flagged
+  limit = np.where(mad > 0, threshold * mad_sigma * mad, np.inf)
+  mask = deviation > limit
+
+  return mask.any(axis=-1)
+
+def channelRuns(mask, t0=0):
+  """ Finds runs of flagged channels in a mask, one for each (dump, baseline)
+
+  Parameters
+  ----------
+  mask: numpy.array of bool
+    flags with axes (time, channels, baselines), e.g. from madMask()
+  t0: int
+    dump number of the first dump in the mask
+
+  Returns
+  -------
+  runs: numpy.array of range_dtype, each covering a single dump
+  """
+
+  (t_len, chan_len, bl_len) = mask.shape
+
+  # Pad the channel axis with unflagged channels, so every run has a start and a stop
+  padded = np.zeros((t_len, bl_len, chan_len + 2), dtype='int8')
+  padded[:,:,1:-1] = mask.transpose((0,2,1))
+  edges = np.diff(padded, axis=2)
+
+  # Starts and stops come out in the same (time, baseline, channel) order, so pair up
+  t, bl, chan_start = np.nonzero(edges == 1)
+  chan_stop = np.nonzero(edges == -1)[2]
+
+  runs = np.zeros(len(t), dtype=range_dtype)
+  runs['baseline'] = bl
+  runs['t_start'] = t + t0
+  runs['t_stop'] = t + t0 + 1
+  runs['chan_start'] = chan_start
+  runs['chan_stop'] = chan_stop
+
+  return runs
+
+def mergeRuns(runs):
+  """ Merges runs of the same channels on the same baseline in consecutive dumps into time ranges
+
+  Parameters
+  ----------
+  runs: numpy.array of range_dtype
+    single dump runs, e.g. from channelRuns()
+
+  Returns
+  -------
+  ranges: numpy.array of range_dtype, sorted by start time
+  """
+
+  if len(runs) == 0:
+    return np.zeros(0, dtype=range_dtype)
+
+  runs = runs[np.lexsort((runs['t_start'], runs['chan_stop'], runs['chan_start'], runs['baseline']))]
+
+  # A run carries on the range before it if it is on the same baseline and
+  # channels, and starts where that one stopped
+  carries_on = np.zeros(len(runs), dtype='bool')
+  carries_on[1:] = ((runs['baseline'][1:] == runs['baseline'][:-1]) &
+                    (runs['chan_start'][1:] == runs['chan_start'][:-1]) &
+                    (runs['chan_stop'][1:] == runs['chan_stop'][:-1]) &
+                    (runs['t_start'][1:] == runs['t_stop'][:-1]))
+
+  first = np.nonzero(~carries_on)[0]
+  last = np.append(first[1:], len(runs)) - 1
+
+  ranges = runs[first]
+  ranges['t_stop'] = runs['t_stop'][last]
+
+  return ranges[np.argsort(ranges['t_start'], kind='mergesort')]
+
+class RFIFlagger(object):
+  """ Collects RFI flags from slabs of dumps, as they are converted.
+
+  Only the runs of flagged channels are kept, not the masks, so memory use
+  depends on the amount of RFI rather than the size of the data.
+
+  Parameters
+  ----------
+  threshold: float
+    number of (MAD estimated) standard deviations from the median to flag at
+
+  Attributes
+  ----------
+  samples: int
+    number of (dump, channel, baseline) samples looked at
+  flagged: int
+    number of those samples flagged
+  """
+
+  def __init__(self, threshold=5.0):
+    self.threshold = threshold
+    self.samples = 0
+    self.flagged = 0
+    self._runs = []
+    self._times = {}
+
+  def add(self, t0, slab, times=None):
+    """ Flags a slab of dumps, the first of which is dump number t0, with the given time for each dump.
+    Returns the mask of the slab, see madMask(), e.g. to leave flagged samples out of averages. """
+    (t_len, chan_len, bl_len, pol_len, ri_len) = slab.shape
+    mask = madMask(slab, self.threshold)
+    self.add_runs(channelRuns(mask, t0), t_len * chan_len * bl_len)
+    if times is not None:
+      self.add_times(t0, times)
+    return mask
+
+  def add_runs(self, runs, samples):
+    """ Adds runs (or ranges) found elsewhere, e.g. in a worker process, covering this many samples """
+    self._runs.append(runs)
+    self.samples += samples
+    self.flagged += int(((runs['chan_stop'] - runs['chan_start']) * (runs['t_stop'] - runs['t_start'])).sum())
+
+  def add_times(self, t0, times):
+    """ Records the times of dumps t0, t0+1..., for times() """
+    for i, time in enumerate(times):
+      self._times[t0 + i] = time
+
+  def times(self):
+    """ Returns an array of the time of each dump, indexed by dump number, as given to add() """
+    times = np.zeros(max(self._times) + 1 if self._times else 0)
+    times[self._times.keys()] = self._times.values()
+    return times
+
+  def ranges(self):
+    """ Returns the flags as merged time and channel ranges, see mergeRuns() """
+    if not self._runs:
+      return np.zeros(0, dtype=range_dtype)
+    return mergeRuns(np.concatenate(self._runs))
+
+  def report(self):
+    """ Returns a one line summary of the samples flagged """
+    return 'Flagged %i of %i samples (%.2f%%)'%(self.flagged, self.samples,
+                                                 100.0 * self.flagged / max(self.samples, 1))
@@ -0,0 +1,176 @@
+# encoding: utf-8
+"""
+threadedPipeline.py
+===================
+
+A simple pipeline of threads, joined by bounded queues, so that reading,
+computing and writing can overlap. Each stage runs in its own thread and
+keeps timing counters, so the stage that is holding the rest up can be
+found from report().
+
+numpy, PyTables and file writes all release the GIL for big operations, so
+while one stage is waiting on the disk another can get on with its work.
+
+Pipeline.run() returns once the last item is through, or raises the first
+exception from any stage after stopping the others.
+
+Module listing
+~~~~~~~~~~~~~~
+
+"""
+
+import sys, time, threading, Queue
+
+# Put on a queue after the last item
+_done = object()
+
+
+class Stage(object):
+  """ One stage of a Pipeline, and its timing counters.
+
+  Attributes
+  ----------
+  name: string
+    name of the stage, for reports
+  count: int
+    number of items processed
+  busy: float
+    seconds spent processing items
+  wait_in: float
+    seconds spent waiting for an item from the stage before
+  wait_out: float
+    seconds spent waiting for room in the queue to the stage after
+  """
+
+  def __init__(self, name, func):
+    self.name = name
+    self.func = func
+    self.count = 0
+    self.busy = 0.0
+    self.wait_in = 0.0
+    self.wait_out = 0.0
+
+  def summary(self):
+    """ Returns the counters as a dictionary """
+    return {'count': self.count, 'busy': self.busy,
+            'wait_in': self.wait_in, 'wait_out': self.wait_out}
+
+class Pipeline(object):
+  """ Runs items from a source through a list of stages, each in its own thread.
+
+  Parameters
+  ----------
+  source: iterable
+    gives the items to process. This is iterated over in its own thread too,
+    as the first stage.
+  stages: list
+    (name, func) for each stage. Each func is called with the output of the
+    stage before; the output of the last stage is thrown away.
+  queue_depth: int
+    number of items that can wait between one stage and the next. Bigger
+    queues smooth out bumps in the stages' speeds, at the cost of memory.
+  source_name: string
+    name of the source stage, for reports
+
+  Attributes
+  ----------
+  stages: list
+    a Stage for each stage, starting with the source
+  """
+
+  def __init__(self, source, stages, queue_depth=2, source_name='read'):
+    self.source = source
+    self.queue_depth = queue_depth
+    self.stages = [Stage(source_name, None)] + [Stage(name, func) for (name, func) in stages]
+    self.elapsed = 0.0
+
+    self._abort = threading.Event()
+    self._errors = []
+
+  def run(self):
+    """ Runs the pipeline until the source is exhausted. Any exception from a stage is raised here. """
+
+    queues = [Queue.Queue(self.queue_depth) for stage in self.stages[1:]]
+
+    threads = [threading.Thread(target=self._run_source, args=(self.stages[0], queues[0]))]
+    for i, stage in enumerate(self.stages[1:]):
+      queue_out = queues[i+1] if i+1 < len(queues) else None
+      threads.append(threading.Thread(target=self._run_stage, args=(stage, queues[i], queue_out)))
+
+    t_start = time.time()
+    for thread in threads:
+      thread.daemon = True
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.elapsed = time.time() - t_start
+
+    if self._errors:
+      exc_type, exc_value, exc_tb = self._errors[0]
+      raise exc_type, exc_value, exc_tb
+
+  def _run_source(self, stage, queue_out):
+    try:
+      items = iter(self.source)
+      while not self._abort.is_set():
+        t_start = time.time()
+        try:
+          item = items.next()
+        except StopIteration:
+          break
+        t_got = time.time()
+        queue_out.put(item)
+        stage.busy += t_got - t_start
+        stage.wait_out += time.time() - t_got
+        stage.count += 1
+    except:
+      self._fail()
+    queue_out.put(_done)
+
+  def _run_stage(self, stage, queue_in, queue_out):
+    try:
+      while True:
+        t_start = time.time()
+        item = queue_in.get()
+        stage.wait_in += time.time() - t_start
+        if item is _done or self._abort.is_set():
+          break
+
+        t_start = time.time()
+        item = stage.func(item)
+        t_done = time.time()
+        stage.busy += t_done - t_start
+        stage.count += 1
+
+        if queue_out is not None:
+          queue_out.put(item)
+          stage.wait_out += time.time() - t_done
+    except:
+      self._fail()
+
+    # Let the stages before run down, so they don't block on a full queue
+    while item is not _done:
+      item = queue_in.get()
+
+    if queue_out is not None:
+      queue_out.put(_done)
+
+  def _fail(self):
+    """ Records the current exception, and tells the other stages to stop """
+    self._errors.append(sys.exc_info())
+    self._abort.set()
+
+  def bottleneck(self):
+    """ Returns the name of the stage that spent longest busy """
+    return max(self.stages, key=lambda stage: stage.busy).name
+
+  def report(self):
+    """ Returns a table of the stage timings, one line per stage """
+
+    lines = ['%-10s %8s %10s %10s %10s'%('stage', 'items', 'busy (s)', 'wait in', 'wait out')]
+    for stage in self.stages:
+      lines.append('%-10s %8i %10.3f %10.3f %10.3f'
+                   %(stage.name, stage.count, stage.busy, stage.wait_in, stage.wait_out))
+    lines.append('Total %.3fs, bottleneck: %s'%(self.elapsed, self.bottleneck()))
+
+    return '\n'.join(lines)
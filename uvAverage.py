@@ -0,0 +1,176 @@
+# encoding: utf-8
+"""
+uvAverage.py
+============
+
+Time and frequency averaging of UV_DATA as it is converted, for quick-look
+files. Every time_avg dumps and chan_avg channels are averaged into one, so
+the output is time_avg * chan_avg times smaller, in the same single pass
+over the data as a full resolution conversion.
+
+Averages are weighted: each sample counts in proportion to its weight (1 for
+raw correlator data), and the weight of an averaged sample is the sum of the
+weights that went into it. The UVWs and times of a dump are the means over
+its bin, and INTTIM covers the whole bin.
+
+The table headers change to match: NO_CHAN and the UV_DATA FLUX axis shrink,
+and CHAN_BW (and so the FREQUENCY table) grows, which config() takes care of.
+
+UVAverager.average() is called on each slab in turn, with the slab's UVWs
+and times.
+
+Module listing
+~~~~~~~~~~~~~~
+
+"""
+
+import numpy as np
+
+from pyFitsidi import getConfig
+
+
+def binCounts(length, bin_len):
+  """ Returns the start of each bin of bin_len along an axis, and the number of samples in each.
+  The last bin is short if bin_len doesn't divide length. """
+  starts = np.arange(0, length, bin_len)
+  return starts, np.diff(np.append(starts, length))
+
+def averageSlab(slab, time_avg=1, chan_avg=1, weights=None):
+  """ Averages a slab of dumps over bins of time_avg dumps and chan_avg channels.
+
+  Parameters
+  ----------
+  slab: numpy.array
+    dumps of xeng_raw0, with axes (time, channels, baselines, polarisation, real/imag)
+  time_avg: int
+    number of dumps to average. If it doesn't divide the slab, the last bin is short.
+  chan_avg: int
+    number of channels to average, which must divide the number of channels
+  weights: numpy.array
+    weight of each sample, with axes (time, channels, baselines). Samples
+    with a weight of 0 are left out. Defaults to 1 for every sample.
+
+  Returns
+  -------
+  (averages, weights): averages is a float32 array with the axes of slab, and
+  weights the sum of the weights in each bin, with axes (time, channels,
+  baselines). Bins with no weight at all are zero.
+  """
+
+  (t_len, chan_len, bl_len, pol_len, ri_len) = slab.shape
+  if chan_len % chan_avg:
+    raise ValueError('%i channels cannot be averaged %i at a time'%(chan_len, chan_avg))
+
+  starts, counts = binCounts(t_len, time_avg)
+  bin_shape = (len(starts), chan_len / chan_avg, chan_avg, bl_len)
+
+  # Sum over time with reduceat, which copes with a short last bin, then over
+  # channels by splitting the channel axis in two
+  if weights is None:
+    sums = np.add.reduceat(slab, starts, axis=0, dtype='float32')
+    weight_sums = np.zeros(bin_shape[:2] + bin_shape[3:], dtype='float32')
+    weight_sums += (counts * chan_avg)[:,None,None]
+  else:
+    weights = np.asarray(weights, dtype='float32')
+    sums = np.add.reduceat(slab * weights[...,None,None], starts, axis=0)
+    weight_sums = np.add.reduceat(weights, starts, axis=0).reshape(bin_shape).sum(axis=2)
+
+  sums = sums.reshape(bin_shape + (pol_len, ri_len)).sum(axis=2)
+
+  scale = np.zeros_like(weight_sums)
+  np.divide(1, weight_sums, out=scale, where=weight_sums > 0)
+  sums *= scale[...,None,None]
+
+  return sums, weight_sums
+
+class UVAverager(object):
+  """ Averages slabs of dumps in time and frequency, as they are converted.
+
+  Slabs must start on a bin boundary, i.e. reader slab sizes must be a
+  multiple of time_avg, so that no bin is split between two slabs.
+
+  Parameters
+  ----------
+  time_avg: int
+    number of dumps to average
+  chan_avg: int
+    number of channels to average, which must divide NCHAN
+  int_time: float
+    integration time of each dump in SECONDS, before averaging
+  """
+
+  def __init__(self, time_avg=1, chan_avg=1, int_time=3.0):
+    if time_avg < 1 or chan_avg < 1:
+      raise ValueError('Cannot average %i dumps and %i channels'%(time_avg, chan_avg))
+    self.time_avg = time_avg
+    self.chan_avg = chan_avg
+    self.int_time = int_time
+
+  def check_slab_size(self, slab_size):
+    """ Raises ValueError unless slabs of slab_size dumps start on bin boundaries """
+    if slab_size % self.time_avg:
+      raise ValueError('Slabs of %i dumps cannot be averaged %i dumps at a time, use a multiple'
+                       %(slab_size, self.time_avg))
+
+  def config(self, config='config.xml'):
+    """ Returns a Config for the averaged tables: fewer, wider channels.
+
+    Parameters
+    ----------
+    config: string or Config
+      xml configuration file for the full resolution data
+
+    Returns
+    -------
+    config: Config, see Config.derive()
+    """
+
+    cfg = getConfig(config)
+    params = cfg['PARAMETERS']
+    if params['NCHAN'] % self.chan_avg:
+      raise ValueError('%i channels cannot be averaged %i at a time'%(params['NCHAN'], self.chan_avg))
+
+    # An averaged channel is centred on the middle of the channels in it, so
+    # the first channel (the reference pixel) moves up by half the ones added
+    common, uv_data = cfg['COMMON'], cfg['UV_DATA']
+    shift = (self.chan_avg - 1) / 2.0
+
+    return cfg.derive(
+      params={'NCHAN': params['NCHAN'] / self.chan_avg},
+      values={'COMMON':  {'CHAN_BW':  common['CHAN_BW'] * self.chan_avg,
+                          'REF_FREQ': common['REF_FREQ'] + shift * common['CHAN_BW']},
+              'UV_DATA': {'CDELT3':   uv_data['CDELT3'] * self.chan_avg,
+                          'CRVAL3':   uv_data['CRVAL3'] + shift * uv_data['CDELT3']}})
+
+  def average(self, slab, uvws, elapsed, weights=None):
+    """ Averages a slab of dumps, and the UVWs and times that go with them.
+
+    Parameters
+    ----------
+    slab: numpy.array
+      dumps of xeng_raw0, with axes (time, channels, baselines, polarisation, real/imag)
+    uvws: numpy.array
+      UVW coordinates, with shape (n_t, bl_len, 3)
+    elapsed: numpy.array
+      time of each dump
+    weights: numpy.array
+      weight of each sample, see averageSlab()
+
+    Returns
+    -------
+    (slab, uvws, elapsed, int_time, weights), for fill_uv_slab(), with one
+    dump for each bin of time_avg dumps. int_time is the integration time of
+    each averaged dump.
+    """
+
+    starts, counts = binCounts(len(slab), self.time_avg)
+    slab, weights = averageSlab(slab, self.time_avg, self.chan_avg, weights)
+    uvws = np.add.reduceat(uvws, starts, axis=0) / counts[:,None,None]
+    elapsed = np.add.reduceat(np.asarray(elapsed, dtype='float64'), starts) / counts
+
+    return slab, uvws, elapsed, self.int_time * counts, weights
+
+  def report(self):
+    """ Returns a one line summary of the averaging """
+    return 'Averaging %i dumps x %i channels, %ix fewer visibilities, %gs dumps'%(
+      self.time_avg, self.chan_avg, self.time_avg * self.chan_avg, self.int_time * self.time_avg)